@@ -0,0 +1,184 @@
+"""
+Admission Control
+Bounded, priority-ordered access to the recognition pipeline
+
+Only max_concurrent model calls run at once; up to max_queue more wait in
+priority order (clock-in/out before enrolment before test recognitions).
+When the queue is full a new request either displaces the lowest-priority
+waiter or is turned away immediately with 503 + Retry-After, and a request
+whose client deadline has passed is dropped instead of being processed for
+a kiosk that already gave up.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# Lower value = served first
+PRIORITY_PUNCH = 0
+PRIORITY_ENROLL = 1
+PRIORITY_TEST = 2
+PRIORITY_NAMES = {PRIORITY_PUNCH: "punch", PRIORITY_ENROLL: "enroll", PRIORITY_TEST: "test"}
+
+
+class AdmissionRejected(Exception):
+    """Request not admitted; reason is 'deadline_expired', 'queue_full' or 'shed'"""
+
+    def __init__(self, reason, retry_after=1):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_deadline(value):
+    """
+    Client deadline header -> time.time() seconds, or None
+
+    Accepts Unix epoch seconds or milliseconds (as sent by Date.now()).
+    """
+    if not value:
+        return None
+    try:
+        deadline = float(value)
+    except ValueError:
+        return None
+    return deadline / 1000.0 if deadline > 1e11 else deadline
+
+
+class AdmissionController:
+    """Concurrency limiter with a priority queue and load shedding"""
+
+    def __init__(self, max_concurrent=2, max_queue=16):
+        """
+        Args:
+            max_concurrent: model calls allowed to run at the same time
+            max_queue: requests allowed to wait for a slot
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters = []  # heap of [priority, seq, future, deadline]
+        self._seq = itertools.count()
+        self._service_time = 0.5  # EWMA seconds per admitted call, for Retry-After
+        self.stats_counters = {"admitted": 0, "rejected": {}}
+
+    @property
+    def queued(self):
+        return sum(1 for w in self._waiters if not w[2].done())
+
+    def _reject(self, reason, priority):
+        rejected = self.stats_counters["rejected"]
+        rejected[reason] = rejected.get(reason, 0) + 1
+        logger.warning(f"Admission rejected ({reason}) for {PRIORITY_NAMES.get(priority, priority)} request")
+        return AdmissionRejected(reason, self.retry_after())
+
+    def retry_after(self):
+        """Seconds until the current backlog is likely worked off"""
+        backlog = self.active + self.queued
+        return max(1, round(backlog * self._service_time / max(self.max_concurrent, 1)))
+
+    def _shed_for(self, priority):
+        """Drop the newest waiter of lower priority than `priority`, if any"""
+        victim = None
+        for waiter in self._waiters:
+            if waiter[2].done() or waiter[0] <= priority:
+                continue
+            if victim is None or (waiter[0], waiter[1]) > (victim[0], victim[1]):
+                victim = waiter
+        if victim is None:
+            return False
+        victim[2].set_exception(self._reject("shed", victim[0]))
+        return True
+
+    def _wake_next(self):
+        """Hand a free slot to the best live waiter"""
+        now = time.time()
+        while self._waiters and self.active < self.max_concurrent:
+            priority, _, future, deadline = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            if deadline is not None and deadline <= now:
+                future.set_exception(self._reject("deadline_expired", priority))
+                continue
+            self.active += 1
+            future.set_result(None)
+
+    async def _acquire(self, priority, deadline):
+        if deadline is not None and deadline <= time.time():
+            raise self._reject("deadline_expired", priority)
+
+        if self.active < self.max_concurrent and not self.queued:
+            self.active += 1
+            return
+
+        if self.queued >= self.max_queue and not self._shed_for(priority):
+            raise self._reject("queue_full", priority)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, [priority, next(self._seq), future, deadline])
+        timeout = deadline - time.time() if deadline is not None else None
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Deadline hit or the client went away while waiting
+            if not future.done():
+                future.cancel()
+            elif future.exception() is not None:
+                raise future.exception()
+            else:
+                # Granted at the same moment; give the slot back
+                self._release()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise self._reject("deadline_expired", priority)
+
+    def _release(self):
+        self.active -= 1
+        self._wake_next()
+
+    @asynccontextmanager
+    async def slot(self, priority, deadline=None):
+        """
+        Hold one pipeline slot for the body of the `async with`
+
+        Raises:
+            AdmissionRejected: deadline passed, or queue full and nothing to shed
+        """
+        await self._acquire(priority, deadline)
+        self.stats_counters["admitted"] += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._service_time = 0.8 * self._service_time + 0.2 * (time.monotonic() - started)
+            self._release()
+
+    @property
+    def overloaded(self):
+        return self.queued >= self.max_queue
+
+    def stats(self):
+        """Current load, for /api/health"""
+        queued_by_priority = {}
+        for waiter in self._waiters:
+            if not waiter[2].done():
+                name = PRIORITY_NAMES.get(waiter[0], str(waiter[0]))
+                queued_by_priority[name] = queued_by_priority.get(name, 0) + 1
+        capacity = self.max_concurrent + self.max_queue
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "queued_by_priority": queued_by_priority,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "load": round((self.active + self.queued) / capacity, 3) if capacity else 1.0,
+            "accepting": not self.overloaded,
+            "avg_service_ms": round(self._service_time * 1000, 1),
+            "admitted": self.stats_counters["admitted"],
+            "rejected": dict(self.stats_counters["rejected"])
+        }
@@ -3,16 +3,38 @@ Face Recognition API Server
 FastAPI server for face recognition using FaceNet with OpenCV optimizations
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request, Depends, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-import numpy as np
-from PIL import Image
-import io
+import asyncio
+import json
+import os
 import logging
-import cv2
+import time
+from datetime import datetime
 from facenet_model import FaceNetRecognitionModel
+from attendance_store import AttendanceStore, AttendanceWriter
+from data_store import VersionedJsonStore, make_etag
+from events import EventBroadcaster
+from gallery_shards import load_shard_config, build_shards, resolve_shard
+from gallery_maintenance import GalleryJobs
+from user_ids import UserRecordIndex, backfill_user_ids, gallery_user_ids, punch_uid, to_uid
+from face_image_store import FaceImageStore
+from payroll import PayrollEngine
+from auth import UserIndex, SessionTokens, load_secret, hash_password, public_user
+from http_encoding import CompressionMiddleware, FastJSONResponse, COLUMNAR_MEDIA_TYPE, dumps, wants_columnar
+from attendance_grid import build_status_grid, STATUS_CODES
+from attendance_analytics import AttendanceAnalytics
+from work_calendar import WorkCalendar
+from upload_limits import UploadLimitMiddleware, DEFAULT_MAX_UPLOAD_BYTES, DEFAULT_MAX_IMAGE_PIXELS
+from image_ingest import ImagePipeline
+from profiling import SamplingProfiler
+from tracing import TraceBuffer, TraceMiddleware, record_span, span
+from admission import (
+    AdmissionController, AdmissionRejected, parse_deadline, PRIORITY_PUNCH, PRIORITY_ENROLL, PRIORITY_TEST
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -22,7 +44,8 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Face Recognition API",
     description="API for face recognition using FaceNet with OpenCV optimizations",
-    version="3.0.0"
+    version="3.0.0",
+    default_response_class=FastJSONResponse
 )
 
 # Configure CORS - allow all origins for development
@@ -34,6 +57,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Content-addressed enrollment images and thumbnails (served under /media)
+image_store = FaceImageStore("registered_faces", source_dirs=("datasets",))
+
+# Opt-in gzip/brotli for large admin payloads (RESPONSE_COMPRESSION=1)
+if os.environ.get("RESPONSE_COMPRESSION", "0") == "1":
+    app.add_middleware(CompressionMiddleware)
+
+# Request bodies above UPLOAD_MAX_BYTES are refused with 413 while streaming
+app.add_middleware(
+    UploadLimitMiddleware, max_bytes=int(os.environ.get("UPLOAD_MAX_BYTES", DEFAULT_MAX_UPLOAD_BYTES))
+)
+
+# On-demand stack sampler for /api/admin/profile
+profiler = SamplingProfiler()
+
+# validate -> read -> open -> orient -> rgb -> bgr, shared by every image endpoint
+image_pipeline = ImagePipeline(max_pixels=int(os.environ.get("UPLOAD_MAX_PIXELS", DEFAULT_MAX_IMAGE_PIXELS)))
+
 # Mount static file directories to serve images
 app.mount("/datasets", StaticFiles(directory="datasets"), name="datasets")
 app.mount("/registered_faces", StaticFiles(directory="registered_faces"), name="registered_faces")
@@ -41,19 +82,223 @@ app.mount("/registered_faces", StaticFiles(directory="registered_faces"), name="
 # Global variable for model
 face_model = None
 
+# JSON data files, cached in memory with change counters for ETags
+users_store = VersionedJsonStore("users.json")
+statuses_store = VersionedJsonStore("attendance_statuses.json")
+salaries_store = VersionedJsonStore("salaries.json")
+payroll_rules_store = VersionedJsonStore("payroll_rules.json", default=dict)
+
+# Working days (weekends + public holidays) shared by the grid, payroll and analytics
+work_calendar = WorkCalendar(VersionedJsonStore("work_calendar.json", default=dict))
+
+# Attendance punches, partitioned by month, go through one group-commit writer
+attendance_store = AttendanceStore(
+    "attendance", legacy_path="attendance.json",
+    cache_size=int(os.environ.get("ATTENDANCE_MONTH_CACHE", "6"))
+)
+attendance_writer = AttendanceWriter(attendance_store)
+
+# Status overrides grouped by integer user ID
+override_index = UserRecordIndex(statuses_store)
+
+# Range reports (late arrivals, attendance rate) over columnar punches
+attendance_analytics = AttendanceAnalytics(
+    attendance_store, users_store, late_after=os.environ.get("LATE_AFTER", "08:30"), calendar=work_calendar
+)
+
+# Recognition calls run in the threadpool, a bounded number at a time
+# (detection and landmarks are serialized inside the model, embedding and
+# matching overlap); kiosks may send X-Request-Deadline (epoch s or ms) to
+# skip stale work
+admission = AdmissionController(
+    max_concurrent=int(os.environ.get("VISION_CONCURRENCY", "2")),
+    max_queue=int(os.environ.get("VISION_QUEUE_DEPTH", "16"))
+)
+DEADLINE_HEADER = "X-Request-Deadline"
+
+# Live attendance deltas pushed to dashboards over server-sent events
+event_broadcaster = EventBroadcaster()
+
+# Salary slips computed from attendance, memoized per (user, month)
+payroll_engine = PayrollEngine(
+    attendance_store, users_store, salaries_store, statuses_store, payroll_rules_store, calendar=work_calendar
+)
+
+
+async def run_vision(request, priority, fn, *args, **kwargs):
+    """
+    Run a model call in the threadpool once admission control lets it in
+    
+    Keeps the event loop free for admin / portal requests while recognition
+    is busy. Requests that are shed, find the queue full or outlive their
+    deadline get a 503 with Retry-After.
+    """
+    deadline = parse_deadline(request.headers.get(DEADLINE_HEADER))
+    queued = time.perf_counter()
+    try:
+        async with admission.slot(priority, deadline):
+            record_span("admission.wait", queued, (time.perf_counter() - queued) * 1000)
+            with span("vision"):
+                return await run_in_threadpool(fn, *args, **kwargs)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Recognition busy ({e.reason}), please retry",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+
+def not_modified(request, etag):
+    """
+    304 response if the client already has this version, otherwise None
+    
+    Called before any data is loaded, so a matching poll costs no file I/O
+    and no serialization.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+# Login index and signed session tokens for the admin / portal clients
+user_index = UserIndex(users_store)
+session_tokens = SessionTokens(load_secret())
+AUTH_REQUIRED = os.environ.get("AUTH_REQUIRED", "0") == "1"
+
+
+async def portal_session(authorization: str = Header(None)):
+    """
+    Verify the session token sent by the admin / portal clients
+    
+    A Bearer token from /api/auth/login is checked by its signature only, no
+    data file is read. Requests without a token are still accepted unless
+    AUTH_REQUIRED=1, so older clients keep working during the rollout.
+    """
+    if authorization and authorization.startswith("Bearer "):
+        claims = session_tokens.verify(authorization[len("Bearer "):])
+        if claims is None:
+            raise HTTPException(status_code=401, detail="Invalid or expired session")
+        return claims
+    
+    if AUTH_REQUIRED:
+        raise HTTPException(status_code=401, detail="Login required")
+    return None
+
+
+async def admin_session(authorization: str = Header(None)):
+    """
+    Require an admin session token, whatever AUTH_REQUIRED says
+    
+    Profiles and traces expose internals of the running server, so these
+    endpoints never fall back to accepting anonymous requests. Admin is the
+    "role" in users.json, granted with `python auth.py set-role <phone> admin`.
+    """
+    claims = await portal_session(authorization)
+    if claims is None:
+        raise HTTPException(status_code=401, detail="Login required")
+    if claims.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Admin role required")
+    return claims
+
+
+def is_admin_authorization(authorization):
+    """True for an 'Authorization: Bearer' header holding a valid admin token"""
+    if not authorization or not authorization.startswith("Bearer "):
+        return False
+    claims = session_tokens.verify(authorization[len("Bearer "):])
+    return claims is not None and claims.get("role") == "admin"
+
+
+# Request IDs on every response; a TRACE_SAMPLE_RATE share of requests (and
+# admin requests sent with X-Trace: 1) also record stage spans, see
+# /api/admin/traces. Added last, so it wraps every other middleware.
+trace_buffer = TraceBuffer(capacity=int(os.environ.get("TRACE_BUFFER_SIZE", "500")))
+app.add_middleware(
+    TraceMiddleware, buffer=trace_buffer, sample_rate=float(os.environ.get("TRACE_SAMPLE_RATE", "0")),
+    can_force=is_admin_authorization
+)
+
+
+# Re-embedding, compaction and attendance relabeling run in the background
+gallery_jobs = GalleryJobs()
+
+# Gallery shards (cohort / kiosk) used as recognition hints
+shard_config = load_shard_config("gallery_shards.json")
+
+
+def refresh_gallery_shards():
+    """Rebuild gallery shards (NIM prefixes) and user IDs from users.json"""
+    if face_model is None:
+        return
+    try:
+        users = users_store.load()
+        face_model.set_shards(build_shards(users, shard_config), gallery_user_ids(users))
+    except Exception as e:
+        logger.error(f"Error building gallery shards: {str(e)}")
+
+
+# Seconds between checks for gallery snapshots published by other processes
+# (0 disables the watcher; POST /api/gallery/reload still works)
+GALLERY_WATCH_INTERVAL = float(os.environ.get("GALLERY_WATCH_INTERVAL", "5"))
+gallery_watch_task = None
+
+
+async def watch_gallery_snapshots():
+    """Hot-reload the gallery when the snapshot manifest moves"""
+    while True:
+        await asyncio.sleep(GALLERY_WATCH_INTERVAL)
+        if face_model is None:
+            continue
+        try:
+            await run_in_threadpool(face_model.check_for_snapshot)
+        except Exception as e:
+            logger.error(f"Error reloading gallery snapshot: {str(e)}")
+
+
+def punch_record(match, punch_type, timestamp):
+    """Attendance record for a recognized face, keyed by integer user ID"""
+    record = {
+        "name": match['name'],
+        "type": punch_type,
+        "timestamp": timestamp,
+        "confidence": match['confidence']
+    }
+    if match.get('user_id') is not None:
+        record["userId"] = match['user_id']
+    return record
+
 
 @app.on_event("startup")
 async def load_models():
     """Load face recognition model on startup"""
     global face_model
     
+    user_index.migrate_plaintext_passwords()
+    backfill_user_ids(attendance_store, statuses_store, users_store)
+    
     try:
         logger.info("Initializing FaceNet model with OpenCV optimizations...")
-        face_model = FaceNetRecognitionModel()
+        face_model = FaceNetRecognitionModel(image_store=image_store, image_pipeline=image_pipeline)
         logger.info("Face recognition model loaded successfully!")
+        refresh_gallery_shards()
         
     except Exception as e:
         logger.error(f"Error loading model: {str(e)}")
+    
+    attendance_writer.start()
+    
+    global gallery_watch_task
+    if GALLERY_WATCH_INTERVAL > 0:
+        gallery_watch_task = asyncio.get_running_loop().create_task(watch_gallery_snapshots())
+
+
+@app.on_event("shutdown")
+async def flush_attendance():
+    """Flush pending attendance punches before the server exits"""
+    if gallery_watch_task is not None:
+        gallery_watch_task.cancel()
+    gallery_jobs.shutdown()
+    await attendance_writer.stop()
 
 
 @app.get("/")
@@ -68,25 +313,52 @@ async def root():
 
 
 @app.get("/api/health")
-async def health_check():
-    """Health check endpoint"""
+async def health_check(response: Response):
+    """
+    Health check endpoint
+    
+    Answers 503 with status 'overloaded' while the recognition queue is
+    full, so a load balancer can route kiosks elsewhere.
+    """
     model_loaded = face_model is not None
     num_registered = len(face_model.registered_faces) if face_model else 0
+    load = admission.stats()
+    
+    if not model_loaded:
+        status = "unhealthy"
+    elif not load["accepting"]:
+        status = "overloaded"
+        response.status_code = 503
+    else:
+        status = "healthy"
     
     return {
-        "status": "healthy" if model_loaded else "unhealthy",
+        "status": status,
         "model_loaded": model_loaded,
-        "registered_faces": num_registered
+        "registered_faces": num_registered,
+        "gallery_shards": len(face_model.gallery.shards) if face_model else 0,
+        "gallery_snapshot": face_model.snapshot_version if face_model else None,
+        "calibration_stale": bool((face_model.calibration or {}).get("stale")) if face_model else None,
+        "gallery_compression": face_model.gallery.compact.describe() if face_model and face_model.gallery.compact else None,
+        "quality_gate": face_model.quality_gate.stats if face_model else None,
+        "replay_guard": face_model.replay_guard.stats if face_model else None,
+        "event_subscribers": event_broadcaster.subscriber_count,
+        "load": load,
+        "ingest_ms": image_pipeline.stats(),
+        "tracing": trace_buffer.stats()
     }
 
 
 @app.post("/api/recognize")
-async def recognize_face(file: UploadFile = File(...)):
+async def recognize_face(request: Request, file: UploadFile = File(...), kiosk_id: str = None, cohort: str = None):
     """
     Recognize face from uploaded image
     
+    Args:
+        kiosk_id / cohort: Optional gallery shard hint (see gallery_shards.py)
+    
     Returns:
-        - status: 'recognized', 'unrecognized', or 'undetected'
+        - status: 'recognized', 'unrecognized', 'low_quality', 'spoof_suspected', or 'undetected'
         - message: Human-readable message
         - name: Person's name (if recognized)
         - confidence: Similarity score
@@ -98,49 +370,22 @@ async def recognize_face(file: UploadFile = File(...)):
             detail="Model not loaded. Please check server logs."
         )
     
-    # Validate file type
-    if not file.content_type.startswith('image/'):
-        raise HTTPException(
-            status_code=400,
-            detail="File must be an image (JPEG, PNG)"
-        )
-    
     try:
-        # Read and convert image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
+        # Validate, open (header-checked), orient and decode off the event loop
+        ingested = await run_in_threadpool(image_pipeline.ingest_upload, file)
+        img_bgr = ingested.bgr
         
         # Log image info from upload
         logger.info(f"=== RECOGNIZE REQUEST ===")
-        logger.info(f"📁 File: {file.filename}")
-        logger.info(f"📦 Content type: {file.content_type}")
-        logger.info(f"📏 File size: {len(contents) / 1024:.2f} KB")
-        logger.info(f"📐 Image mode: {image.mode}")
-        logger.info(f"📐 Image size (before EXIF): {image.size}")
-        
-        # FIX: Apply EXIF orientation to handle portrait/landscape correctly
-        from PIL import ImageOps
-        try:
-            # This automatically rotates the image based on EXIF orientation tag
-            image = ImageOps.exif_transpose(image)
-            logger.info(f"✅ EXIF orientation applied")
-            logger.info(f"📐 Image size (after EXIF): {image.size}")
-        except Exception as e:
-            logger.warning(f"⚠️ Could not apply EXIF orientation: {e}")
-        
-        # Convert to RGB if needed
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Convert to OpenCV format (BGR)
-        img_array = np.array(image)
-        img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
-        
-        logger.info(f"🖼️ NumPy array shape: {img_array.shape}")
-        logger.info(f"🎨 Mean pixel value (BGR): {img_bgr.mean(axis=(0,1))}")
+        logger.info(f"📁 File: {file.filename} ({(file.size or 0) / 1024:.2f} KB, {file.content_type})")
+        logger.info(f"📐 Image size (after EXIF): {ingested.size}")
+        logger.info(f"⏱️ Ingest stages (ms): {ingested.timings}")
         
         # Recognize face
-        result = face_model.recognize(img_bgr)
+        result = await run_vision(
+            request, PRIORITY_TEST, face_model.recognize, img_bgr,
+            shard=resolve_shard(shard_config, kiosk_id, cohort)
+        )
         
         logger.info(f"📊 Recognition result:")
         logger.info(f"  Status: {result['status']}")
@@ -154,6 +399,8 @@ async def recognize_face(file: UploadFile = File(...)):
             **result
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}")
         raise HTTPException(
@@ -163,7 +410,7 @@ async def recognize_face(file: UploadFile = File(...)):
 
 
 @app.post("/api/clock-in")
-async def clock_in(file: UploadFile = File(...)):
+async def clock_in(request: Request, file: UploadFile = File(...), kiosk_id: str = None, cohort: str = None):
     """
     Clock-in with face recognition
     """
@@ -174,64 +421,28 @@ async def clock_in(file: UploadFile = File(...)):
             detail="Model not loaded. Please check server logs."
         )
     
-    # Validate file type
-    if not file.content_type.startswith('image/'):
-        raise HTTPException(
-            status_code=400,
-            detail="File must be an image (JPEG, PNG)"
-        )
-    
     try:
-        # Read and convert image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        # Apply EXIF orientation (portrait/landscape fix)
-        from PIL import ImageOps
-        try:
-            image = ImageOps.exif_transpose(image)
-        except:
-            pass  # If no EXIF data, continue
-        
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        img_array = np.array(image)
-        img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
+        # Validate, open (header-checked), orient and decode off the event loop
+        ingested = await run_in_threadpool(image_pipeline.ingest_upload, file)
+        img_bgr = ingested.bgr
         
         # Recognize face
-        result = face_model.recognize(img_bgr)
+        result = await run_vision(
+            request, PRIORITY_PUNCH, face_model.recognize, img_bgr,
+            shard=resolve_shard(shard_config, kiosk_id, cohort)
+        )
         
         # Only proceed if face is recognized
         if result['status'] == 'recognized':
             # Record clock-in time
-            from datetime import datetime
-            import json
-            import os
-            
             timestamp = datetime.now().isoformat()
             
-            # Load or create attendance records
-            attendance_file = "attendance.json"
-            if os.path.exists(attendance_file):
-                with open(attendance_file, "r") as f:
-                    attendance_data = json.load(f)
-            else:
-                attendance_data = []
-            
             # Add clock-in record
-            clock_in_record = {
-                "name": result['name'],
-                "type": "clock-in",
-                "timestamp": timestamp,
-                "confidence": result['confidence']
-            }
+            clock_in_record = punch_record(result, "clock-in", timestamp)
             
-            attendance_data.append(clock_in_record)
-            
-            # Save to file
-            with open(attendance_file, "w") as f:
-                json.dump(attendance_data, f, indent=2)
+            await attendance_writer.append([clock_in_record])
+            payroll_engine.invalidate_punch(clock_in_record)
+            event_broadcaster.publish("punch", clock_in_record)
             
             logger.info(f"Clock-in recorded for {result['name']} at {timestamp}")
             
@@ -255,6 +466,8 @@ async def clock_in(file: UploadFile = File(...)):
                 "confidence": result.get('confidence', 0)
             }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}")
         raise HTTPException(
@@ -264,7 +477,7 @@ async def clock_in(file: UploadFile = File(...)):
 
 
 @app.post("/api/clock-out")
-async def clock_out(file: UploadFile = File(...)):
+async def clock_out(request: Request, file: UploadFile = File(...), kiosk_id: str = None, cohort: str = None):
     """
     Clock-out with face recognition
     """
@@ -275,64 +488,28 @@ async def clock_out(file: UploadFile = File(...)):
             detail="Model not loaded. Please check server logs."
         )
     
-    # Validate file type
-    if not file.content_type.startswith('image/'):
-        raise HTTPException(
-            status_code=400,
-            detail="File must be an image (JPEG, PNG)"
-        )
-    
     try:
-        # Read and convert image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        # Apply EXIF orientation (portrait/landscape fix)
-        from PIL import ImageOps
-        try:
-            image = ImageOps.exif_transpose(image)
-        except:
-            pass  # If no EXIF data, continue
-        
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        img_array = np.array(image)
-        img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
+        # Validate, open (header-checked), orient and decode off the event loop
+        ingested = await run_in_threadpool(image_pipeline.ingest_upload, file)
+        img_bgr = ingested.bgr
         
         # Recognize face
-        result = face_model.recognize(img_bgr)
+        result = await run_vision(
+            request, PRIORITY_PUNCH, face_model.recognize, img_bgr,
+            shard=resolve_shard(shard_config, kiosk_id, cohort)
+        )
         
         # Only proceed if face is recognized
         if result['status'] == 'recognized':
             # Record clock-out time
-            from datetime import datetime
-            import json
-            import os
-            
             timestamp = datetime.now().isoformat()
             
-            # Load or create attendance records
-            attendance_file = "attendance.json"
-            if os.path.exists(attendance_file):
-                with open(attendance_file, "r") as f:
-                    attendance_data = json.load(f)
-            else:
-                attendance_data = []
-            
             # Add clock-out record
-            clock_out_record = {
-                "name": result['name'],
-                "type": "clock-out",
-                "timestamp": timestamp,
-                "confidence": result['confidence']
-            }
-            
-            attendance_data.append(clock_out_record)
+            clock_out_record = punch_record(result, "clock-out", timestamp)
             
-            # Save to file
-            with open(attendance_file, "w") as f:
-                json.dump(attendance_data, f, indent=2)
+            await attendance_writer.append([clock_out_record])
+            payroll_engine.invalidate_punch(clock_out_record)
+            event_broadcaster.publish("punch", clock_out_record)
             
             logger.info(f"Clock-out recorded for {result['name']} at {timestamp}")
             
@@ -356,6 +533,8 @@ async def clock_out(file: UploadFile = File(...)):
                 "confidence": result.get('confidence', 0)
             }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}")
         raise HTTPException(
@@ -364,50 +543,104 @@ async def clock_out(file: UploadFile = File(...)):
         )
 
 
-@app.post("/api/register")
-async def register_face(name: str, file: UploadFile = File(...)):
+@app.post("/api/recognize/group")
+async def recognize_group(request: Request, file: UploadFile = File(...), record: str = None,
+                          kiosk_id: str = None, cohort: str = None):
     """
-    Register a new face
+    Recognize every face in a group / classroom photo
     
     Args:
-        name: Person's name
-        file: Image file with clear face
+        file: Wide photo containing several faces
+        record: Optional 'clock-in' or 'clock-out' to record attendance for
+                everyone recognized, written in a single storage update
+        kiosk_id / cohort: Optional gallery shard hint
+    
+    Returns:
+        - status: 'recognized', 'unrecognized', 'low_quality', 'spoof_suspected', or 'undetected'
+        - faces: List of {box, status, name, confidence} per detected face
+        - recorded: Names that got an attendance record (if record is set)
     """
     if face_model is None:
         raise HTTPException(
             status_code=503,
-            detail="Model not loaded"
+            detail="Model not loaded. Please check server logs."
         )
     
-    if not file.content_type.startswith('image/'):
+    if record not in (None, "clock-in", "clock-out"):
         raise HTTPException(
             status_code=400,
-            detail="File must be an image"
+            detail="record must be 'clock-in' or 'clock-out'"
         )
     
     try:
-        # Read and convert image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
+        # Validate, open (header-checked), orient and decode off the event loop
+        ingested = await run_in_threadpool(image_pipeline.ingest_upload, file)
+        img_bgr = ingested.bgr
         
-        # Apply EXIF orientation (portrait/landscape fix)
-        from PIL import ImageOps
-        try:
-            image = ImageOps.exif_transpose(image)
-        except:
-            pass  # If no EXIF data, continue
+        # Recognize all faces in one batch
+        result = await run_vision(
+            request, PRIORITY_PUNCH if record else PRIORITY_TEST, face_model.recognize_all, img_bgr,
+            shard=resolve_shard(shard_config, kiosk_id, cohort)
+        )
         
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        recorded = []
+        timestamp = None
+        if record and result['recognized_count'] > 0:
+            timestamp = datetime.now().isoformat()
+            records = [punch_record(face, record, timestamp) for face in result['faces'] if face['name']]
+            await attendance_writer.append(records)
+            for r in records:
+                payroll_engine.invalidate_punch(r)
+                event_broadcaster.publish("punch", r)
+            recorded = [r["name"] for r in records]
+            logger.info(f"Group {record} recorded for {len(recorded)} people at {timestamp}")
         
-        img_array = np.array(image)
-        img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
+        return {
+            "success": True,
+            **result,
+            "recorded": recorded,
+            "timestamp": timestamp
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing group image: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error processing image: {str(e)}"
+        )
+
+
+@app.post("/api/register")
+async def register_face(request: Request, name: str, file: UploadFile = File(...)):
+    """
+    Register a new face
+    
+    Args:
+        name: Person's name
+        file: Image file with clear face
+    """
+    if face_model is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Model not loaded"
+        )
+    
+    try:
+        # Same ingest path; the original bytes are kept for the image store
+        ingested = await run_in_threadpool(image_pipeline.ingest_upload, file, True)
         
         # Register face
-        result = face_model.register_face(img_bgr, name)
+        result = await run_vision(
+            request, PRIORITY_ENROLL, face_model.register_face, ingested.bgr, name,
+            original_bytes=ingested.original_bytes
+        )
         
         return result
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error registering face: {str(e)}")
         raise HTTPException(
@@ -417,7 +650,7 @@ async def register_face(name: str, file: UploadFile = File(...)):
 
 
 @app.get("/api/registered-faces")
-async def get_registered_faces():
+async def get_registered_faces(request: Request, response: Response):
     """Get list of registered faces"""
     if face_model is None:
         raise HTTPException(
@@ -425,91 +658,285 @@ async def get_registered_faces():
             detail="Model not loaded"
         )
     
+    etag = make_etag(face_model.gallery_version)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
+    names = list(face_model.registered_faces.keys())
+    faces = await run_in_threadpool(
+        lambda: [{"name": name, **(image_store.enrollment_urls(name) or {})} for name in names]
+    )
+    
+    response.headers["ETag"] = etag
     return {
         "success": True,
-        "registered_faces": list(face_model.registered_faces.keys()),
-        "count": len(face_model.registered_faces)
+        "registered_faces": names,
+        "faces": faces,
+        "count": len(names)
     }
 
 
+@app.get("/media/{filename}")
+async def get_media(filename: str, request: Request):
+    """
+    Serve a content-addressed image (face crop, thumbnail or original)
+    
+    The file name is the SHA-256 of the content, so responses never change
+    and can be cached forever by clients and proxies.
+    """
+    digest = filename.rsplit(".", 1)[0]
+    path = image_store.object_path(digest)
+    if path is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    headers = {
+        "ETag": f'"{digest}"',
+        "Cache-Control": "public, max-age=31536000, immutable"
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    
+    media_type = await run_in_threadpool(image_store.media_type, digest)
+    return FileResponse(path, media_type=media_type, headers=headers)
 
 
-# ============= NEW ENDPOINTS FOR ADMIN AND PORTAL =============
+def user_name(user_id):
+    """Registered name of a user ID, 404 if there is no such user"""
+    user = next((u for u in users_store.load() if u["id"] == user_id), None)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user["name"]
 
 
-@app.get("/api/users")
-async def get_users():
-    """Get all users with their attendance summary"""
-    import json
-    import os
-    from datetime import datetime
+def relabel_attendance(job, old_name, new_name):
+    """Background job: move punches recorded under a user's old name"""
+    job.progress(0, 1)
+    renamed = attendance_store.rename(old_name, new_name)
+    if renamed:
+        payroll_engine.invalidate_all()
+    job.progress(1)
+    return {"renamed_records": renamed}
+
+
+def relabel_identity(old_name, new_name):
+    """
+    Move the gallery entry, enrollment images and punches to a new name
+    
+    The gallery and image store change immediately; the attendance rewrite
+    runs as a background job. Returns the job, or None if nothing to move.
+    """
+    if face_model is not None and face_model.relabel_identity(old_name, new_name):
+        image_store.rename_enrollment(old_name, new_name)
+        schedule_compaction()
+    return gallery_jobs.submit("relabel_attendance", relabel_attendance, old_name=old_name, new_name=new_name)
+
+
+def schedule_compaction():
+    """Rewrite the snapshot once enough deletes / relabels have piled up"""
+    if face_model is not None and face_model.needs_compaction:
+        return gallery_jobs.submit("compact", face_model.compact_gallery)
+    return None
+
+
+@app.delete("/api/gallery/users/{user_id}", dependencies=[Depends(portal_session)])
+async def delete_gallery_identity(user_id: str):
+    """Remove a user's face from the gallery (the user account stays)"""
+    if face_model is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    
+    name = user_name(user_id)
+    deleted = await run_in_threadpool(face_model.delete_identity, name)
+    if not deleted:
+        raise HTTPException(status_code=404, detail=f"No registered face for user {user_id}")
+    image_store.delete_enrollment(name)
+    compaction = schedule_compaction()
+    
+    return {
+        "success": True,
+        "message": f"Deleted face for {name}",
+        "registered_faces": len(face_model.registered_faces),
+        "compaction_job": compaction.id if compaction else None
+    }
+
+
+@app.post("/api/gallery/users/{user_id}/relabel", dependencies=[Depends(portal_session)])
+async def relabel_gallery_identity(user_id: str, from_name: str):
+    """
+    Re-attach a face and punches recorded under `from_name` to this user
+    
+    Repairs links broken by renames made before relabeling was automatic.
+    """
+    if face_model is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
     
-    users_file = "users.json"
-    attendance_file = "attendance.json"
+    name = user_name(user_id)
+    if name == from_name:
+        raise HTTPException(status_code=400, detail="User already has this name")
+    try:
+        job = await run_in_threadpool(relabel_identity, from_name, name)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    refresh_gallery_shards()
     
-    if not os.path.exists(users_file):
-        return {"success": False, "message": "Users file not found"}
+    return {"success": True, "name": name, "job": job.to_dict()}
+
+
+@app.post("/api/gallery/reembed", dependencies=[Depends(portal_session)])
+async def reembed_gallery():
+    """Recompute every template from stored enrollment images (after a model upgrade)"""
+    if face_model is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
     
-    with open(users_file, "r") as f:
-        users = json.load(f)
+    job = gallery_jobs.submit("reembed", face_model.reembed_all)
+    return {"success": True, "job": job.to_dict()}
+
+
+@app.post("/api/gallery/compact", dependencies=[Depends(portal_session)])
+async def compact_gallery():
+    """Write a fresh snapshot without tombstones or journal"""
+    if face_model is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
     
+    job = gallery_jobs.submit("compact", face_model.compact_gallery)
+    return {"success": True, "job": job.to_dict()}
+
+
+@app.get("/api/gallery/jobs", dependencies=[Depends(portal_session)])
+async def list_gallery_jobs():
+    """Recent gallery jobs with progress"""
+    return {"success": True, "jobs": gallery_jobs.list()}
+
+
+@app.get("/api/gallery/jobs/{job_id}", dependencies=[Depends(portal_session)])
+async def get_gallery_job(job_id: str):
+    """Progress of one gallery job"""
+    job = gallery_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"success": True, "job": job.to_dict()}
+
+
+@app.get("/api/gallery/snapshots", dependencies=[Depends(portal_session)])
+async def get_gallery_snapshots():
+    """List gallery snapshot versions and the one being served"""
+    if face_model is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+
+    manifest = await run_in_threadpool(face_model.snapshots.manifest)
+    return {
+        "success": True,
+        "serving": face_model.snapshot_version,
+        "current": manifest.get("current"),
+        "versions": manifest.get("versions", [])
+    }
+
+
+@app.post("/api/gallery/reload", dependencies=[Depends(portal_session)])
+async def reload_gallery():
+    """Pick up a snapshot published by another process without a restart"""
+    if face_model is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+
+    try:
+        reloaded = await run_in_threadpool(face_model.check_for_snapshot)
+    except Exception as e:
+        logger.error(f"Error reloading gallery: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error reloading gallery: {str(e)}")
+
+    return {
+        "success": True,
+        "reloaded": reloaded,
+        "version": face_model.snapshot_version,
+        "registered_faces": len(face_model.registered_faces)
+    }
+
+
+@app.post("/api/gallery/rollback/{version}", dependencies=[Depends(portal_session)])
+async def rollback_gallery(version: int):
+    """Serve an earlier gallery snapshot (and make it current for every process)"""
+    if face_model is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+
+    try:
+        await run_in_threadpool(face_model.rollback_gallery, version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Gallery snapshot {version} not found")
+
+    return {
+        "success": True,
+        "version": face_model.snapshot_version,
+        "registered_faces": len(face_model.registered_faces)
+    }
+
+
+
+
+# ============= NEW ENDPOINTS FOR ADMIN AND PORTAL =============
+
+
+@app.get("/api/users", dependencies=[Depends(portal_session)])
+async def get_users(request: Request, response: Response):
+    """Get all users with their attendance summary"""
     # Get today's attendance if available
     today = datetime.now().date().isoformat()
-    attendance_data = []
     
-    if os.path.exists(attendance_file):
-        with open(attendance_file, "r") as f:
-            attendance_data = json.load(f)
-    
-    # Load status overrides
-    statuses_file = "attendance_statuses.json"
-    status_overrides = []
-    if os.path.exists(statuses_file):
-        with open(statuses_file, "r") as f:
-            status_overrides = json.load(f)
+    this_month = today[:7]
+    etag = make_etag(users_store.version, attendance_store.month_version(this_month), statuses_store.version, today)
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
+    # Copies, since today's status and thumbnails are added per user
+    users = [dict(u) for u in users_store.load()]
+    name_to_uid = gallery_user_ids(users)
+    present_today = set()
+    for record in reversed(attendance_store.load_month(this_month)):
+        record_date = record.get("timestamp", "")[:10]
+        if record_date == today:
+            present_today.add(punch_uid(record, name_to_uid))
+        elif record_date < today:
+            break
+    overrides = override_index.groups()
     
     # Add today's attendance status to each user
     for user in users:
+        uid = to_uid(user["id"])
         today_attendance = None
         
         # First, check if there's a status override for today
-        for override in status_overrides:
-            if override["userId"] == user["id"] and override["date"] == today:
+        for override in overrides.get(uid, ()):
+            if override["date"] == today:
                 today_attendance = override["status"]
                 break
         
-        # If no override, check clock-in records
-        if today_attendance is None:
-            for record in attendance_data:
-                if record.get("name") == user["name"]:
-                    record_date = record.get("timestamp", "")[:10]
-                    if record_date == today:
-                        today_attendance = "attend"
-                        break
+        # If no override, check today's clock-in records
+        if today_attendance is None and uid in present_today:
+            today_attendance = "attend"
         
         # Default to alpha if no attendance found
         user["todayAbsention"] = today_attendance or "alpha"
     
+    # Small cached thumbnails so the admin list doesn't load full photos
+    def add_thumbnails():
+        for user in users:
+            face_image = user.get("faceImage", "")
+            user["faceThumbnail"] = image_store.thumbnail_url_for_file(face_image) if face_image else None
+    
+    await run_in_threadpool(add_thumbnails)
+    
+    response.headers["ETag"] = etag
     return {
         "success": True,
-        "users": users,
+        "users": [public_user(u) for u in users],
         "count": len(users)
     }
 
 
-@app.get("/api/users/{user_id}")
+@app.get("/api/users/{user_id}", dependencies=[Depends(portal_session)])
 async def get_user(user_id: str):
     """Get user details by ID"""
-    import json
-    import os
-    
-    users_file = "users.json"
-    
-    if not os.path.exists(users_file):
-        raise HTTPException(status_code=404, detail="Users file not found")
-    
-    with open(users_file, "r") as f:
-        users = json.load(f)
+    users = users_store.load()
     
     user = next((u for u in users if u["id"] == user_id), None)
     
@@ -518,23 +945,14 @@ async def get_user(user_id: str):
     
     return {
         "success": True,
-        "user": user
+        "user": public_user(user)
     }
 
 
-@app.post("/api/users")
+@app.post("/api/users", dependencies=[Depends(portal_session)])
 async def create_user(name: str, phone: str, password: str, faceImage: str = ""):
     """Create a new user"""
-    import json
-    import os
-    
-    users_file = "users.json"
-    
-    if not os.path.exists(users_file):
-        users = []
-    else:
-        with open(users_file, "r") as f:
-            users = json.load(f)
+    users = users_store.load_copy()
     
     # Generate new user ID
     max_id = max([int(u["id"]) for u in users], default=0)
@@ -544,78 +962,68 @@ async def create_user(name: str, phone: str, password: str, faceImage: str = "")
         "id": new_id,
         "name": name,
         "phone": phone,
-        "password": password,
+        "passwordHash": hash_password(password),
         "faceImage": faceImage or "/images/avatar-placeholder.png"
     }
     
     users.append(new_user)
+    users_store.save(users)
     
-    with open(users_file, "w") as f:
-        json.dump(users, f, indent=2)
+    refresh_gallery_shards()
     
     return {
         "success": True,
         "message": "User created successfully",
-        "user": new_user
+        "user": public_user(new_user)
     }
 
 
-@app.put("/api/users/{user_id}")
+@app.put("/api/users/{user_id}", dependencies=[Depends(portal_session)])
 async def update_user(user_id: str, name: str = None, phone: str = None, password: str = None, faceImage: str = None):
     """Update user information"""
-    import json
-    import os
-    
-    users_file = "users.json"
-    
-    if not os.path.exists(users_file):
-        raise HTTPException(status_code=404, detail="Users file not found")
-    
-    with open(users_file, "r") as f:
-        users = json.load(f)
+    users = users_store.load_copy()
     
     user = next((u for u in users if u["id"] == user_id), None)
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
+    old_name = user["name"]
+    
     # Update fields if provided
     if name:
         user["name"] = name
     if phone:
         user["phone"] = phone
     if password:
-        user["password"] = password
+        user["passwordHash"] = hash_password(password)
+        user.pop("password", None)
     if faceImage:
         user["faceImage"] = faceImage
     
-    with open(users_file, "w") as f:
-        json.dump(users, f, indent=2)
+    users_store.save(users)
+    
+    # Keep the face and the punches attached to the renamed user
+    if name and name != old_name:
+        try:
+            relabel_identity(old_name, name)
+        except ValueError as e:
+            logger.warning(f"Face not relabeled for user {user_id}: {str(e)}")
+    
+    if name or phone:
+        refresh_gallery_shards()
     
     return {
         "success": True,
         "message": "User updated successfully",
-        "user": user
+        "user": public_user(user)
     }
 
 
-@app.get("/api/attendance/all")
+@app.get("/api/attendance/all", dependencies=[Depends(portal_session)])
 async def get_all_attendance():
     """Get all attendance records"""
-    import json
-    import os
-    
-    attendance_file = "attendance.json"
-    
-    if not os.path.exists(attendance_file):
-        return {
-            "success": True,
-            "records": [],
-            "message": "No attendance records found"
-        }
-    
-    with open(attendance_file, "r") as f:
-        attendance_data = json.load(f)
+    attendance_data = attendance_store.load()
     
     return {
         "success": True,
@@ -624,24 +1032,10 @@ async def get_all_attendance():
     }
 
 
-@app.get("/api/attendance/{name}")
+@app.get("/api/attendance/{name}", dependencies=[Depends(portal_session)])
 async def get_attendance(name: str):
     """Get attendance records for a specific person"""
-    import json
-    import os
-    
-    attendance_file = "attendance.json"
-    
-    if not os.path.exists(attendance_file):
-        return {
-            "success": True,
-            "name": name,
-            "records": [],
-            "message": "No attendance records found"
-        }
-    
-    with open(attendance_file, "r") as f:
-        attendance_data = json.load(f)
+    attendance_data = attendance_store.load()
     
     # Filter records for the specified person
     person_records = [
@@ -657,43 +1051,24 @@ async def get_attendance(name: str):
     }
 
 
-@app.get("/api/attendance/user/{user_id}")
+@app.get("/api/attendance/user/{user_id}", dependencies=[Depends(portal_session)])
 async def get_user_attendance(user_id: str):
     """Get attendance records for a specific user by ID"""
-    import json
-    import os
-    
-    users_file = "users.json"
-    attendance_file = "attendance.json"
-    
     # Get user name from ID
-    if not os.path.exists(users_file):
-        raise HTTPException(status_code=404, detail="Users file not found")
-    
-    with open(users_file, "r") as f:
-        users = json.load(f)
+    users = users_store.load()
     
     user = next((u for u in users if u["id"] == user_id), None)
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    if not os.path.exists(attendance_file):
-        return {
-            "success": True,
-            "userId": user_id,
-            "userName": user["name"],
-            "records": [],
-            "message": "No attendance records found"
-        }
-    
-    with open(attendance_file, "r") as f:
-        attendance_data = json.load(f)
-    
-    # Filter records for this user
+    # Full history: every monthly partition is read in turn
+    uid = to_uid(user_id)
     user_records = [
-        record for record in attendance_data 
-        if record.get("name") == user["name"]
+        record
+        for month in attendance_store.months()
+        for record in attendance_store.load_month(month)
+        if record.get("userId") == uid
     ]
     
     return {
@@ -705,46 +1080,30 @@ async def get_user_attendance(user_id: str):
     }
 
 
-@app.get("/api/attendance/user/{user_id}/month/{month}")
-async def get_user_attendance_by_month(user_id: str, month: str):
+@app.get("/api/attendance/user/{user_id}/month/{month}", dependencies=[Depends(portal_session)])
+async def get_user_attendance_by_month(user_id: str, month: str, request: Request, response: Response):
     """Get attendance records for a specific user and month (format: YYYY-MM)"""
-    import json
-    import os
-    
-    users_file = "users.json"
-    attendance_file = "attendance.json"
+    etag = make_etag(users_store.version, month, attendance_store.month_version(month))
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
     
     # Get user name from ID
-    if not os.path.exists(users_file):
-        raise HTTPException(status_code=404, detail="Users file not found")
-    
-    with open(users_file, "r") as f:
-        users = json.load(f)
+    users = users_store.load()
     
     user = next((u for u in users if u["id"] == user_id), None)
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    if not os.path.exists(attendance_file):
-        return {
-            "success": True,
-            "userId": user_id,
-            "userName": user["name"],
-            "month": month,
-            "records": [],
-            "message": "No attendance records found"
-        }
-    
-    with open(attendance_file, "r") as f:
-        attendance_data = json.load(f)
-    
-    # Filter records for this user and month
+    # Only this month's partition is opened
+    uid = to_uid(user_id)
     user_records = [
-        record for record in attendance_data 
-        if record.get("name") == user["name"] and record.get("timestamp", "").startswith(month)
+        record for record in attendance_store.load_month(month)
+        if record.get("userId") == uid
     ]
     
+    response.headers["ETag"] = etag
     return {
         "success": True,
         "userId": user_id,
@@ -755,53 +1114,61 @@ async def get_user_attendance_by_month(user_id: str, month: str):
     }
 
 
-@app.get("/api/attendance/status/month/{month}")
-async def get_attendance_with_status(month: str):
-    """Get all attendance with status for a specific month"""
-    import json
-    import os
-    from datetime import datetime, timedelta
-    
-    users_file = "users.json"
-    attendance_file = "attendance.json"
-    statuses_file = "attendance_statuses.json"
-    
-    # Load users
-    if not os.path.exists(users_file):
-        raise HTTPException(status_code=404, detail="Users file not found")
-    
-    with open(users_file, "r") as f:
-        users = json.load(f)
-    
-    # Load attendance
-    attendance_data = []
-    if os.path.exists(attendance_file):
-        with open(attendance_file, "r") as f:
-            attendance_data = json.load(f)
-    
-    # Load status overrides
-    status_overrides = []
-    if os.path.exists(statuses_file):
-        with open(statuses_file, "r") as f:
-            status_overrides = json.load(f)
-    
-    # Parse month
-    year, month_num = map(int, month.split('-'))
-    
-    # Calculate working days in month (Mon-Fri)
-    from calendar import monthrange
-    _, days_in_month = monthrange(year, month_num)
+@app.get("/api/attendance/status/month/{month}", dependencies=[Depends(portal_session)])
+async def get_attendance_with_status(month: str, request: Request):
+    """
+    Get all attendance with status for a specific month
     
-    working_days = []
-    for day in range(1, days_in_month + 1):
-        date_obj = datetime(year, month_num, day)
-        # 0 = Monday, 6 = Sunday
-        if date_obj.weekday() < 5:  # Mon-Fri
-            working_days.append(date_obj.strftime("%Y-%m-%d"))
+    Send 'Accept: application/vnd.pam.columnar+json' to get the compact
+    columnar form: one row of small integer status codes per user plus a
+    legend, instead of a nested dict per user per day.
+    """
+    users = users_store.load()
     
-    # Build status records for each user
+    try:
+        month_calendar = work_calendar.month(month)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if wants_columnar(request):
+        status_overrides = statuses_store.load()
+        working_days, grid = build_status_grid(
+            users, attendance_store.load_month(month), status_overrides, month, calendar=work_calendar
+        )
+        user_rows = {to_uid(u["id"]): i for i, u in enumerate(users)}
+        day_cols = {d: i for i, d in enumerate(working_days)}
+        reasons = [
+            [user_rows[o["userId"]], day_cols[o["date"]], o.get("reason", "")]
+            for o in status_overrides
+            if o.get("reason") and o["userId"] in user_rows and o["date"] in day_cols
+        ]
+        content = {
+            "success": True,
+            "month": month,
+            "legend": list(STATUS_CODES.keys()),
+            "workingDays": working_days,
+            "holidays": month_calendar.holidays,
+            "userIds": [u["id"] for u in users],
+            "userNames": [u["name"] for u in users],
+            "status": grid.tolist(),
+            "reasons": reasons
+        }
+        return Response(dumps(content), media_type=COLUMNAR_MEDIA_TYPE, headers={"Vary": "Accept"})
+    
+    # Working days (weekends and public holidays excluded), cached per month
+    working_days = month_calendar.days
+    
+    # Build status records for each user from this month's partition
+    name_to_uid = gallery_user_ids(users)
+    punches = {}
+    for record in attendance_store.load_month(month):
+        uid = punch_uid(record, name_to_uid)
+        if uid is not None:
+            punches.setdefault(uid, []).append(record)
+    overrides = override_index.groups()
     result = []
     for user in users:
+        uid = to_uid(user["id"])
         user_data = {
             "userId": user["id"],
             "userName": user["name"],
@@ -817,23 +1184,21 @@ async def get_attendance_with_status(month: str):
             }
         
         # Mark clock-in days as attend
-        for record in attendance_data:
-            if record.get("name") == user["name"]:
-                timestamp = record.get("timestamp", "")
-                if timestamp.startswith(month):
-                    date = timestamp[:10]  # YYYY-MM-DD
-                    if date in user_data["days"]:
-                        user_data["days"][date]["status"] = "attend"
-                        user_data["days"][date]["timestamp"] = timestamp
-                        user_data["days"][date]["type"] = record.get("type")
+        for record in punches.get(uid, ()):
+            timestamp = record.get("timestamp", "")
+            if timestamp.startswith(month):
+                date = timestamp[:10]  # YYYY-MM-DD
+                if date in user_data["days"]:
+                    user_data["days"][date]["status"] = "attend"
+                    user_data["days"][date]["timestamp"] = timestamp
+                    user_data["days"][date]["type"] = record.get("type")
         
         # Apply status overrides
-        for override in status_overrides:
-            if override["userId"] == user["id"]:
-                date = override["date"]
-                if date in user_data["days"]:
-                    user_data["days"][date]["status"] = override["status"]
-                    user_data["days"][date]["reason"] = override.get("reason", "")
+        for override in overrides.get(uid, ()):
+            date = override["date"]
+            if date in user_data["days"]:
+                user_data["days"][date]["status"] = override["status"]
+                user_data["days"][date]["reason"] = override.get("reason", "")
         
         result.append(user_data)
     
@@ -841,50 +1206,40 @@ async def get_attendance_with_status(month: str):
         "success": True,
         "month": month,
         "workingDays": working_days,
+        "holidays": month_calendar.holidays,
         "records": result
     }
 
 
-@app.get("/api/salary/{user_id}")
-async def get_user_salary(user_id: str):
+@app.get("/api/salary/{user_id}", dependencies=[Depends(portal_session)])
+async def get_user_salary(user_id: str, request: Request, response: Response):
     """Get salary information for a user"""
-    import json
-    import os
-    from datetime import datetime
-    
-    salaries_file = "salaries.json"
-    users_file = "users.json"
+    # Slips depend on the month so far, hence today's date in the ETag
+    etag = make_etag(
+        users_store.version, salaries_store.version, attendance_store.version, statuses_store.version,
+        payroll_rules_store.version, work_calendar.version, datetime.now().date().isoformat()
+    )
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
     
     # Get user info
-    if not os.path.exists(users_file):
-        raise HTTPException(status_code=404, detail="Users file not found")
-    
-    with open(users_file, "r") as f:
-        users = json.load(f)
+    users = users_store.load()
     
     user = next((u for u in users if u["id"] == user_id), None)
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    if not os.path.exists(salaries_file):
-        return {
-            "success": True,
-            "userId": user_id,
-            "userName": user["name"],
-            "salaries": [],
-            "message": "No salary records found"
-        }
+    salaries = salaries_store.load()
     
-    with open(salaries_file, "r") as f:
-        salaries = json.load(f)
-    
-    # Filter salaries for this user
-    user_salaries = [
-        salary for salary in salaries 
-        if salary.get("userId") == user_id
-    ]
+    # Months this user has salary data for, computed from attendance
+    months = sorted({s.get("month") for s in salaries if s.get("userId") == user_id})
+    user_salaries = await run_in_threadpool(
+        lambda: [slip for slip in (payroll_engine.slip(user_id, m) for m in months) if slip]
+    )
     
+    response.headers["ETag"] = etag
     return {
         "success": True,
         "userId": user_id,
@@ -893,38 +1248,19 @@ async def get_user_salary(user_id: str):
     }
 
 
-@app.get("/api/salary/{user_id}/slip/{month}")
+@app.get("/api/salary/{user_id}/slip/{month}", dependencies=[Depends(portal_session)])
 async def get_salary_slip(user_id: str, month: str):
     """Get salary slip for a specific user and month (format: YYYY-MM)"""
-    import json
-    import os
-    
-    salaries_file = "salaries.json"
-    users_file = "users.json"
-    
     # Get user info
-    if not os.path.exists(users_file):
-        raise HTTPException(status_code=404, detail="Users file not found")
-    
-    with open(users_file, "r") as f:
-        users = json.load(f)
+    users = users_store.load()
     
     user = next((u for u in users if u["id"] == user_id), None)
     
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    if not os.path.exists(salaries_file):
-        raise HTTPException(status_code=404, detail="Salary records not found")
-    
-    with open(salaries_file, "r") as f:
-        salaries = json.load(f)
-    
-    # Find salary for this user and month
-    salary = next(
-        (s for s in salaries if s.get("userId") == user_id and s.get("month") == month),
-        None
-    )
+    # Computed from the attendance month grid (memoized)
+    salary = await run_in_threadpool(payroll_engine.slip, user_id, month)
     
     if not salary:
         raise HTTPException(status_code=404, detail="Salary slip not found for this month")
@@ -938,73 +1274,149 @@ async def get_salary_slip(user_id: str, month: str):
     }
 
 
-@app.post("/api/auth/login")
-async def login(phone: str, password: str):
-    """Login endpoint for admin and portal"""
-    import json
-    import os
-    
-    users_file = "users.json"
+@app.get("/api/payroll/{month}", dependencies=[Depends(portal_session)])
+async def get_payroll(month: str):
+    """Get computed salary slips of all users for a month (format: YYYY-MM)"""
+    slips = await run_in_threadpool(payroll_engine.month_slips, month)
     
-    if not os.path.exists(users_file):
-        raise HTTPException(status_code=404, detail="Users file not found")
+    return {
+        "success": True,
+        "month": month,
+        "slips": slips,
+        "count": len(slips)
+    }
+
+
+ANALYTICS_REPORTS = {
+    "users": attendance_analytics.per_user,
+    "days": attendance_analytics.per_day,
+    "weeks": attendance_analytics.per_week
+}
+
+
+@app.get("/api/analytics/{report}", dependencies=[Depends(portal_session)])
+async def get_attendance_analytics(report: str, start: str, end: str, request: Request, response: Response,
+                                   late_after: str = None):
+    """
+    Attendance aggregates over a date range (YYYY-MM-DD, inclusive)
     
-    with open(users_file, "r") as f:
-        users = json.load(f)
+    report: 'users' (rate, late days, average clock-in per user), 'days' or
+    'weeks'. late_after ('HH:MM') overrides the default lateness cut-off.
+    """
+    if report not in ANALYTICS_REPORTS:
+        raise HTTPException(status_code=404, detail=f"Unknown report: {report}")
     
-    # Find user by phone and password
-    user = next(
-        (u for u in users if u.get("phone") == phone and u.get("password") == password),
-        None
+    etag = make_etag(
+        attendance_store.version, users_store.version, work_calendar.version, report, start, end, late_after
     )
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    
+    try:
+        rows = await run_in_threadpool(ANALYTICS_REPORTS[report], start, end, late_after)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid range or time: {str(e)}")
+    
+    response.headers["ETag"] = etag
+    return {
+        "success": True,
+        "report": report,
+        "start": start,
+        "end": end,
+        "lateAfter": late_after or attendance_analytics.late_after,
+        "rows": rows,
+        "count": len(rows)
+    }
+
+
+@app.post("/api/auth/login")
+async def login(phone: str, password: str):
+    """
+    Login endpoint for admin and portal
+    
+    Returns a signed session token; send it as 'Authorization: Bearer <token>'
+    on later requests instead of the credentials.
+    """
+    # In-memory phone index + salted hash check, run off the event loop
+    user = await run_in_threadpool(user_index.authenticate, phone, password)
     
     if not user:
         raise HTTPException(status_code=401, detail="Invalid phone or password")
     
-    # Return user data (excluding password)
-    user_data = {k: v for k, v in user.items() if k != "password"}
+    token, expires_at = session_tokens.issue(user)
     
     return {
         "success": True,
         "message": "Login successful",
-        "user": user_data
+        "user": public_user(user),
+        "token": token,
+        "expiresAt": expires_at
     }
 
 
-@app.post("/api/attendance/status/update")
-async def update_attendance_status(userId: str, date: str, status: str, reason: str = ""):
-    """Update attendance status for a specific user and date"""
-    import json
-    import os
+@app.get("/api/auth/me")
+async def get_session(session: dict = Depends(portal_session)):
+    """Return the claims of the current session token"""
+    if session is None:
+        raise HTTPException(status_code=401, detail="Login required")
     
-    statuses_file = "attendance_statuses.json"
+    return {
+        "success": True,
+        "session": session
+    }
+
+
+@app.get("/api/events", dependencies=[Depends(portal_session)])
+async def attendance_events():
+    """
+    Server-sent event stream of attendance changes for dashboards
     
+    Events (JSON data):
+        - punch: {name, type, timestamp, confidence} after a clock-in/out is stored
+        - status: {userId, date, status} after a status override is saved
+        - resync: the client fell behind; reload with a normal GET and reconnect
+    """
+    subscriber = event_broadcaster.subscribe()
+    
+    return StreamingResponse(
+        event_broadcaster.stream(subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.post("/api/attendance/status/update", dependencies=[Depends(portal_session)])
+async def update_attendance_status(userId: str, date: str, status: str, reason: str = ""):
+    """Update attendance status for a specific user and date"""
     # Validate status
     if status not in ["alpha", "permission", "sick"]:
         raise HTTPException(status_code=400, detail="Invalid status. Must be alpha, permission, or sick")
     
+    uid = to_uid(userId)
+    if uid is None:
+        raise HTTPException(status_code=400, detail="Invalid userId")
+    
     # Load existing statuses
-    if os.path.exists(statuses_file):
-        with open(statuses_file, "r") as f:
-            statuses = json.load(f)
-    else:
-        statuses = []
+    statuses = statuses_store.load()
     
     # Remove existing status for this user/date
-    statuses = [s for s in statuses if not (s["userId"] == userId and s["date"] == date)]
+    statuses = [s for s in statuses if not (s["userId"] == uid and s["date"] == date)]
     
     # Add new status (only if not attend - attend is determined by clock-in)
     if status != "attend":
         statuses.append({
-            "userId": userId,
+            "userId": uid,
             "date": date,
             "status": status,
             "reason": reason
         })
     
     # Save statuses
-    with open(statuses_file, "w") as f:
-        json.dump(statuses, f, indent=2)
+    statuses_store.save(statuses)
+    
+    payroll_engine.invalidate(date[:7], str(uid))
+    event_broadcaster.publish("status", {"userId": userId, "date": date, "status": status})
     
     return {
         "success": True,
@@ -1012,6 +1424,52 @@ async def update_attendance_status(userId: str, date: str, status: str, reason:
     }
 
 
+@app.post("/api/admin/profile/start", dependencies=[Depends(admin_session)])
+async def start_profile(seconds: float = 30, memory: bool = False):
+    """
+    Start sampling every thread's stack for `seconds` (at most 300)
+    
+    memory=true also traces allocations with tracemalloc for the window,
+    which slows the server down noticeably while it runs.
+    """
+    try:
+        status = profiler.start(seconds, memory)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"success": True, "profile": status}
+
+
+@app.post("/api/admin/profile/stop", dependencies=[Depends(admin_session)])
+async def stop_profile():
+    """Stop the profiler early and return its report"""
+    report = await run_in_threadpool(profiler.stop)
+    if report is None:
+        raise HTTPException(status_code=404, detail="No profile has been recorded")
+    return {"success": True, "report": report}
+
+
+@app.get("/api/admin/profile", dependencies=[Depends(admin_session)])
+async def get_profile():
+    """Profiler state and the report of the last finished window"""
+    return {"success": True, "profile": profiler.status(), "report": profiler.last_report}
+
+
+@app.get("/api/admin/traces", dependencies=[Depends(admin_session)])
+async def list_traces(limit: int = 50, path: str = None, min_ms: float = None):
+    """Recent request traces, newest first, optionally by path prefix and minimum duration"""
+    traces = trace_buffer.recent(max(1, min(limit, 500)), path, min_ms)
+    return {"success": True, "traces": traces, "count": len(traces), "buffer": trace_buffer.stats()}
+
+
+@app.get("/api/admin/traces/{request_id}", dependencies=[Depends(admin_session)])
+async def get_trace(request_id: str):
+    """Spans of one traced request (by its X-Request-ID)"""
+    trace = trace_buffer.get(request_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found (not sampled or already evicted)")
+    return {"success": True, "trace": trace}
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=5000, log_level="info")
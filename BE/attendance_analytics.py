@@ -0,0 +1,277 @@
+"""
+Attendance Analytics
+Range reports over attendance kept as NumPy columns
+
+Each monthly attendance partition is decoded once per version into parallel
+arrays (int32 user ID, int64 timestamp, int8 type), sorted by time, together
+with the first clock-in of every user-day. A date range is then two binary
+searches per month it covers, and per-user / per-day / per-week aggregates
+are bincounts over the slices, so a multi-month query costs milliseconds
+instead of a scan over dicts with string timestamps.
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import date
+
+import numpy as np
+
+from user_ids import gallery_user_ids, punch_uid, to_uid
+from work_calendar import DEFAULT_CALENDAR
+
+TYPE_CODES = {"clock-in": 0, "clock-out": 1}
+DAY = 86400
+MAX_RANGE_DAYS = 366
+
+
+def _epoch_seconds(timestamps):
+    """ISO timestamps (local time, as recorded) -> int64 seconds"""
+    if not timestamps:
+        return np.zeros(0, dtype=np.int64)
+    return np.array([t[:19] for t in timestamps], dtype="datetime64[s]").astype(np.int64)
+
+
+def _day_number(day):
+    """YYYY-MM-DD -> days since 1970-01-01 (same scale as ts // DAY)"""
+    return int(np.datetime64(day, "D").astype(np.int64))
+
+
+def _clock(seconds):
+    """Seconds since midnight -> 'HH:MM', or None"""
+    if seconds is None or np.isnan(seconds):
+        return None
+    seconds = int(round(seconds))
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}"
+
+
+def parse_clock(value):
+    """'HH:MM' -> seconds since midnight"""
+    hours, minutes = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60
+
+
+class AttendanceColumns:
+    """Punches as parallel arrays sorted by timestamp"""
+
+    def __init__(self, records, name_to_uid=None):
+        """
+        Args:
+            records: punch dicts with integer userId
+            name_to_uid: name -> integer user ID for punches that only
+                         carry a name; punches matching no user are left out
+        """
+        uids = [punch_uid(r, name_to_uid or {}) for r in records]
+        kept = [(r, uid) for r, uid in zip(records, uids) if isinstance(uid, int) and r.get("timestamp")]
+        ts = _epoch_seconds([r["timestamp"] for r, _ in kept])
+        order = np.argsort(ts, kind="stable")
+
+        self.ts = ts[order]
+        self.user_id = np.array([uid for _, uid in kept], dtype=np.int32)[order]
+        self.type = np.array([TYPE_CODES.get(r.get("type"), -1) for r, _ in kept], dtype=np.int8)[order]
+
+        # Earliest clock-in per (user, day): rows are time-sorted, so the
+        # first occurrence of each key is that day's arrival
+        clock_in = np.nonzero(self.type == TYPE_CODES["clock-in"])[0]
+        day = self.ts[clock_in] // DAY
+        _, first = np.unique(self.user_id[clock_in].astype(np.int64) * 1_000_000 + day, return_index=True)
+        arrivals = np.sort(clock_in[first])
+        self.arrival_ts = self.ts[arrivals]
+        self.arrival_user_id = self.user_id[arrivals]
+
+    def __len__(self):
+        return len(self.ts)
+
+    @staticmethod
+    def _range(ts, start_day, end_day):
+        lo = np.searchsorted(ts, start_day * DAY, side="left")
+        hi = np.searchsorted(ts, (end_day + 1) * DAY, side="left")
+        return slice(lo, hi)
+
+    def range(self, start_day, end_day):
+        """Slice of punch rows from start_day through end_day (inclusive day numbers)"""
+        return self._range(self.ts, start_day, end_day)
+
+    def arrival_range(self, start_day, end_day):
+        """Slice of the first-clock-in arrays for the same range"""
+        return self._range(self.arrival_ts, start_day, end_day)
+
+
+class AttendanceAnalytics:
+    """
+    Vectorized attendance aggregates over any date range
+
+    A user's day counts as present when it has a clock-in; the first
+    clock-in of the day decides lateness and feeds the average arrival time.
+    Attendance rates only count presence on working days, the same days
+    their denominator counts.
+    """
+
+    def __init__(self, attendance_store, users_store, late_after="08:30", cache_months=24, calendar=None):
+        """
+        Args:
+            attendance_store: month-partitioned AttendanceStore with integer
+                              userId punches
+            users_store: VersionedJsonStore for users.json
+            late_after: default 'HH:MM' after which a first clock-in is late
+            cache_months: months of decoded columns kept in memory
+            calendar: WorkCalendar for working-day counts (default Mon-Fri)
+        """
+        self.attendance_store = attendance_store
+        self.users_store = users_store
+        self.late_after = late_after
+        self.cache_months = cache_months
+        self.calendar = calendar or DEFAULT_CALENDAR
+        self._columns = OrderedDict()  # month -> ((partition, users version), columns)
+        self._lock = threading.Lock()
+
+    def columns(self, month):
+        """
+        Columns for one month, rebuilt when its partition changes (or the
+        users, which name-only punches are matched against)
+        """
+        version = (self.attendance_store.month_version(month), self.users_store.version)
+        with self._lock:
+            cached = self._columns.get(month)
+            if cached is not None and cached[0] == version:
+                self._columns.move_to_end(month)
+                return cached[1]
+
+        columns = AttendanceColumns(
+            self.attendance_store.load_month(month), gallery_user_ids(self.users_store.load())
+        )
+        with self._lock:
+            self._columns[month] = (version, columns)
+            self._columns.move_to_end(month)
+            while len(self._columns) > self.cache_months:
+                self._columns.popitem(last=False)
+        return columns
+
+    def _first_clock_ins(self, start, end):
+        """
+        (user_id, day, seconds of day) of each user's first clock-in per day
+        within [start, end] given as YYYY-MM-DD
+
+        Raises:
+            ValueError: malformed dates, end before start, or a range longer
+                        than MAX_RANGE_DAYS
+        """
+        start_day, end_day = _day_number(start), _day_number(end)
+        if end_day < start_day:
+            raise ValueError("end is before start")
+        if end_day - start_day + 1 > MAX_RANGE_DAYS:
+            raise ValueError(f"range is longer than {MAX_RANGE_DAYS} days")
+
+        first = np.datetime64(start, "M")
+        last = np.datetime64(end, "M")
+        stored = set(self.attendance_store.months())
+        ts_parts, user_parts = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int32)]
+        for month in map(str, np.arange(first, last + 1)):
+            if month not in stored:
+                continue
+            cols = self.columns(month)
+            window = cols.arrival_range(start_day, end_day)
+            ts_parts.append(cols.arrival_ts[window])
+            user_parts.append(cols.arrival_user_id[window])
+
+        ts = np.concatenate(ts_parts)
+        day = ts // DAY
+        return np.concatenate(user_parts).astype(np.int64), day, ts - day * DAY, start_day, end_day
+
+    def _working_days(self, start_day, end_day):
+        return self.calendar.count(start_day, end_day)
+
+    def per_user(self, start, end, late_after=None):
+        """
+        Attendance rate, late days and average arrival per user
+
+        Returns:
+            list of dicts in users.json order
+        """
+        user_id, day, seconds, start_day, end_day = self._first_clock_ins(start, end)
+        late = seconds > parse_clock(late_after or self.late_after)
+        on_working_day = self.calendar.is_working(day)
+        working = self._working_days(start_day, end_day)
+
+        users = self.users_store.load()
+        uids = np.array([to_uid(u["id"]) if to_uid(u["id"]) is not None else -1 for u in users], dtype=np.int64)
+        size = int(max(uids.max(initial=0), user_id.max(initial=0))) + 1
+        rows = np.full(size, -1, dtype=np.int64)
+        rows[uids[uids >= 0]] = np.nonzero(uids >= 0)[0]
+
+        row = rows[user_id]
+        known = row >= 0
+        present = np.bincount(row[known & on_working_day], minlength=len(users))
+        arrivals = np.bincount(row[known], minlength=len(users))
+        late_days = np.bincount(row[known], weights=late[known], minlength=len(users))
+        total_seconds = np.bincount(row[known], weights=seconds[known], minlength=len(users))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            average = total_seconds / arrivals
+
+        return [
+            {
+                "userId": user["id"],
+                "userName": user["name"],
+                "presentDays": int(present[i]),
+                "workingDays": working,
+                "attendanceRate": round(float(present[i]) / working, 4) if working else None,
+                "lateDays": int(late_days[i]),
+                "averageClockIn": _clock(average[i])
+            }
+            for i, user in enumerate(users)
+        ]
+
+    def per_day(self, start, end, late_after=None):
+        """Users present, late arrivals and average arrival per calendar day"""
+        _, day, seconds, start_day, end_day = self._first_clock_ins(start, end)
+        late = seconds > parse_clock(late_after or self.late_after)
+        offset = day - start_day
+        days = end_day - start_day + 1
+
+        present = np.bincount(offset, minlength=days)
+        late_count = np.bincount(offset, weights=late, minlength=days)
+        total_seconds = np.bincount(offset, weights=seconds, minlength=days)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            average = total_seconds / present
+
+        dates = np.arange(start_day, end_day + 1).astype("datetime64[D]")
+        return [
+            {
+                "date": str(dates[i]),
+                "present": int(present[i]),
+                "late": int(late_count[i]),
+                "averageClockIn": _clock(average[i])
+            }
+            for i in range(days)
+        ]
+
+    def per_week(self, start, end, late_after=None):
+        """Present user-days, late arrivals and rate per ISO week (Mon-Sun)"""
+        _, day, seconds, start_day, end_day = self._first_clock_ins(start, end)
+        late = seconds > parse_clock(late_after or self.late_after)
+
+        # 1970-01-01 was a Thursday, so Monday-based weeks start at day - 3
+        first_monday = start_day - (start_day + 3) % 7
+        week = (day - first_monday) // 7
+        weeks = (end_day - first_monday) // 7 + 1
+
+        present = np.bincount(week[self.calendar.is_working(day)], minlength=weeks)
+        late_count = np.bincount(week, weights=late, minlength=weeks)
+        user_count = len(self.users_store.load())
+
+        result = []
+        for i in range(weeks):
+            week_start = max(first_monday + 7 * i, start_day)
+            week_end = min(first_monday + 7 * i + 6, end_day)
+            working = self._working_days(week_start, week_end)
+            possible = working * user_count
+            iso_year, iso_week, _ = date.fromisoformat(str(np.datetime64(week_start, "D"))).isocalendar()
+            result.append({
+                "week": f"{iso_year}-W{iso_week:02d}",
+                "start": str(np.datetime64(week_start, "D")),
+                "end": str(np.datetime64(week_end, "D")),
+                "workingDays": working,
+                "presentUserDays": int(present[i]),
+                "late": int(late_count[i]),
+                "attendanceRate": round(float(present[i]) / possible, 4) if possible else None
+            })
+        return result
@@ -0,0 +1,77 @@
+"""
+Attendance Month Grid
+Per-user x per-working-day status matrix shared by reports and payroll
+"""
+
+import numpy as np
+
+from user_ids import gallery_user_ids, punch_uid, to_uid
+from work_calendar import DEFAULT_CALENDAR
+
+# Compact status codes used in the grid
+STATUS_CODES = {
+    "alpha": 0,
+    "attend": 1,
+    "permission": 2,
+    "sick": 3,
+}
+PENDING = -1  # working day that hasn't happened yet
+
+
+def working_days(month, calendar=None):
+    """List of working dates (YYYY-MM-DD) in a month given as YYYY-MM"""
+    return (calendar or DEFAULT_CALENDAR).working_days(month)
+
+
+def build_status_grid(users, attendance_records, status_overrides, month, until=None, calendar=None):
+    """
+    Build the status grid for a month
+
+    Args:
+        users: list of user dicts (id, name)
+        attendance_records: punch records with integer userId and timestamp
+            (records from before user IDs are matched by name)
+        status_overrides: override dicts with integer userId, date and status
+        month: YYYY-MM
+        until: optional YYYY-MM-DD; later working days are marked PENDING
+        calendar: WorkCalendar deciding the working days (default Mon-Fri)
+
+    Returns:
+        (days, grid) where days is the list of working dates and grid is an
+        int8 array of shape (len(users), len(days)) holding STATUS_CODES
+    """
+    month_calendar = (calendar or DEFAULT_CALENDAR).month(month)
+    days = month_calendar.days
+    day_index = month_calendar.index
+    user_index = {to_uid(u["id"]): i for i, u in enumerate(users)}
+    name_to_uid = gallery_user_ids(users)
+
+    grid = np.full((len(users), len(days)), STATUS_CODES["alpha"], dtype=np.int8)
+
+    for record in attendance_records:
+        timestamp = record.get("timestamp", "")
+        if not timestamp.startswith(month):
+            continue
+        uid = punch_uid(record, name_to_uid)
+        row = user_index.get(uid) if uid is not None else None
+        col = day_index.get(timestamp[:10])
+        if row is not None and col is not None:
+            grid[row, col] = STATUS_CODES["attend"]
+
+    for override in status_overrides:
+        row = user_index.get(to_uid(override["userId"]))
+        col = day_index.get(override["date"])
+        code = STATUS_CODES.get(override["status"])
+        if row is not None and col is not None and code is not None:
+            grid[row, col] = code
+
+    if until is not None:
+        future = np.array([d > until for d in days], dtype=bool)
+        grid[:, future] = PENDING
+
+    return days, grid
+
+
+def status_counts(grid):
+    """Per-user counts of each status, as {status: int array}"""
+    return {status: (grid == code).sum(axis=1) for status, code in STATUS_CODES.items()}
@@ -0,0 +1,439 @@
+"""
+Attendance Storage
+Month-partitioned attendance history with a group-commit writer for punch bursts
+
+Layout:
+    attendance/
+        2025-07.json.gz     closed month, compressed, never appended to
+        2025-08.json.gz
+        2025-09.json        current month, plain JSON, kept in memory
+
+Punches are stored by the month of their timestamp. Appends only rewrite the
+current month's file, and month-scoped readers open just the partition they
+ask for, so request cost follows the month queried rather than the length
+of the whole history.
+"""
+
+import asyncio
+import copy
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from tracing import current_trace, record_span, span
+
+logger = logging.getLogger(__name__)
+
+MONTH_PATTERN = re.compile(r"^\d{4}-\d{2}$")
+
+
+def record_month(record):
+    """YYYY-MM partition a punch belongs to"""
+    timestamp = record.get("timestamp") or ""
+    return timestamp[:7] if len(timestamp) >= 7 else datetime.now().strftime("%Y-%m")
+
+
+class _Partition:
+    """Cached state of one month's file"""
+
+    def __init__(self, month):
+        self.month = month
+        self.records = None
+        self.mtime = None
+        self.version = 0
+        self.last_check = 0.0
+
+
+class AttendanceStore:
+    """
+    Attendance punches partitioned by month
+
+    The current month is always decoded in memory; closed months are
+    gzipped, immutable in normal operation, and decoded on demand into a
+    small LRU. `version` is bumped on every change to any partition (for
+    ETags over full-history responses); `month_version(month)` only moves
+    when that month changes.
+
+    A legacy single-file attendance.json is split into partitions on first
+    start and renamed to attendance.json.migrated.
+    """
+
+    def __init__(self, root="attendance", legacy_path="attendance.json", cache_size=6, check_interval=1.0):
+        """
+        Args:
+            root: directory holding the monthly partitions
+            legacy_path: single-file attendance.json to migrate, if present
+            cache_size: decoded closed months kept in memory
+            check_interval: seconds between mtime checks for outside edits
+        """
+        self.root = root
+        self.legacy_path = legacy_path
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+
+        self._partitions = {}
+        self._cache = OrderedDict()  # closed months, least recently used first
+        self._version = 0
+        self._lock = threading.RLock()
+
+        os.makedirs(root, exist_ok=True)
+        self._migrate_legacy()
+        self.close_months()
+
+    # ---- paths and months ----
+
+    @staticmethod
+    def current_month():
+        return datetime.now().strftime("%Y-%m")
+
+    def _path(self, month, compressed):
+        return os.path.join(self.root, f"{month}.json.gz" if compressed else f"{month}.json")
+
+    def _existing_path(self, month):
+        """Path of the month's partition file, or None"""
+        for compressed in (False, True):
+            path = self._path(month, compressed)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def months(self):
+        """Months that have a partition, oldest first"""
+        months = set()
+        for filename in os.listdir(self.root):
+            month = filename.split(".", 1)[0]
+            if MONTH_PATTERN.match(month) and filename in (f"{month}.json", f"{month}.json.gz"):
+                months.add(month)
+        return sorted(months)
+
+    # ---- reading ----
+
+    @staticmethod
+    def _read_file(path):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _partition(self, month):
+        partition = self._partitions.get(month)
+        if partition is None:
+            partition = self._partitions.setdefault(month, _Partition(month))
+        return partition
+
+    def _refresh(self, partition, force=False):
+        """Re-read a partition if it was never loaded or changed on disk"""
+        now = time.monotonic()
+        if not force and partition.records is not None and now - partition.last_check < self.check_interval:
+            return
+        partition.last_check = now
+
+        path = self._existing_path(partition.month)
+        mtime = os.stat(path).st_mtime_ns if path else None
+        if partition.records is not None and mtime == partition.mtime:
+            return
+
+        with self._lock:
+            partition.records = self._read_file(path) if path else []
+            if mtime != partition.mtime:
+                if partition.mtime is not None or partition.version:
+                    self._version += 1
+                partition.version += 1
+                partition.mtime = mtime
+
+        if partition.month != self.current_month():
+            self._touch(partition)
+
+    def _touch(self, partition):
+        """Mark a closed month as recently used, evicting the oldest"""
+        with self._lock:
+            self._cache[partition.month] = partition
+            self._cache.move_to_end(partition.month)
+            while len(self._cache) > self.cache_size:
+                _, evicted = self._cache.popitem(last=False)
+                evicted.records = None
+                evicted.last_check = 0.0
+
+    def load_month(self, month):
+        """Punches of one month (shared, do not mutate)"""
+        if not MONTH_PATTERN.match(month):
+            return []
+        partition = self._partition(month)
+        self._refresh(partition, force=partition.records is None)
+        return partition.records
+
+    def month_version(self, month):
+        """Change counter of one month's partition"""
+        if not MONTH_PATTERN.match(month):
+            return 0
+        partition = self._partition(month)
+        self._refresh(partition, force=partition.records is None)
+        return partition.version
+
+    @property
+    def version(self):
+        """Change counter, bumped on every change to any month"""
+        self._refresh(self._partition(self.current_month()))
+        return self._version
+
+    def load(self):
+        """
+        Every punch, oldest month first
+
+        Touches every partition, so only full-history endpoints should use
+        it; month-scoped code should call load_month instead.
+        """
+        records = []
+        for month in self.months():
+            records.extend(self.load_month(month))
+        return records
+
+    def load_copy(self):
+        """Deep copy of every punch for read-modify-write"""
+        return copy.deepcopy(self.load())
+
+    # ---- writing ----
+
+    def _write_file(self, path, records):
+        tmp_path = path + ".tmp"
+        if path.endswith(".gz"):
+            data = gzip.compress(json.dumps(records).encode("utf-8"), mtime=0)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            with open(tmp_path, "w") as f:
+                json.dump(records, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def save_month(self, month, records):
+        """
+        Atomically replace one month's partition
+
+        The current (and any later) month is written as plain JSON, earlier
+        months gzipped. An empty list removes the partition.
+        """
+        with self._lock:
+            compressed = month < self.current_month()
+            path = self._path(month, compressed)
+            stale = self._path(month, not compressed)
+
+            if records:
+                self._write_file(path, records)
+            elif os.path.exists(path):
+                os.remove(path)
+            if os.path.exists(stale):
+                os.remove(stale)
+
+            partition = self._partition(month)
+            partition.records = records
+            partition.mtime = os.stat(path).st_mtime_ns if records else None
+            partition.last_check = time.monotonic()
+            partition.version += 1
+            self._version += 1
+            if compressed:
+                self._touch(partition)
+
+    def save(self, records):
+        """Replace the whole history (only the months that differ are written)"""
+        by_month = {}
+        for record in records:
+            by_month.setdefault(record_month(record), []).append(record)
+
+        with self._lock:
+            for month in sorted(set(self.months()) | set(by_month)):
+                updated = by_month.get(month, [])
+                if updated != self.load_month(month):
+                    self.save_month(month, updated)
+
+    def append_many(self, records):
+        """
+        Append records and durably rewrite their month once
+
+        Written to a temp file, fsynced and swapped in with os.replace so a
+        crash never leaves a truncated partition behind.
+        """
+        by_month = {}
+        for record in records:
+            by_month.setdefault(record_month(record), []).append(record)
+
+        with self._lock:
+            for month, added in by_month.items():
+                self.save_month(month, self.load_month(month) + added)
+        self.close_months()
+
+    def rename(self, old_name, new_name):
+        """
+        Relabel every punch recorded under old_name, returns the count
+
+        This is the one routine operation that rewrites closed months.
+        """
+        renamed = 0
+        with self._lock:
+            for month in self.months():
+                if not any(r.get("name") == old_name for r in self.load_month(month)):
+                    continue
+                records = copy.deepcopy(self.load_month(month))
+                for record in records:
+                    if record.get("name") == old_name:
+                        record["name"] = new_name
+                        renamed += 1
+                self.save_month(month, records)
+        return renamed
+
+    # ---- maintenance ----
+
+    def close_months(self):
+        """Compress plain partitions of months that have ended"""
+        current = self.current_month()
+        with self._lock:
+            for month in self.months():
+                plain = self._path(month, False)
+                if month < current and os.path.exists(plain):
+                    records = self._read_file(plain)
+                    self._write_file(self._path(month, True), records)
+                    os.remove(plain)
+                    partition = self._partition(month)
+                    partition.records = None
+                    partition.mtime = None
+                    self._cache.pop(month, None)
+                    logger.info(f"Closed attendance partition {month} ({len(records)} punches)")
+
+    def _migrate_legacy(self):
+        """Split a single-file attendance.json into monthly partitions"""
+        if not self.legacy_path or not os.path.exists(self.legacy_path) or self.months():
+            return
+        with open(self.legacy_path, "r") as f:
+            records = json.load(f)
+
+        by_month = {}
+        for record in records:
+            by_month.setdefault(record_month(record), []).append(record)
+        for month, month_records in by_month.items():
+            month_records.sort(key=lambda r: r.get("timestamp") or "")
+            self._write_file(self._path(month, month < self.current_month()), month_records)
+
+        os.replace(self.legacy_path, self.legacy_path + ".migrated")
+        logger.info(
+            f"Migrated {len(records)} punches from {self.legacy_path} into "
+            f"{len(by_month)} monthly partitions under {self.root}/"
+        )
+
+
+class AttendanceWriter:
+    """
+    Single serialized writer for attendance punches (group commit)
+
+    Request handlers put punches on an asyncio queue and wait. One background
+    task drains the queue, coalesces everything that arrives within
+    flush_interval into a single durable write, and only then resolves the
+    waiting handlers. Appends can no longer overwrite each other, and the
+    write cost per punch shrinks as the burst grows.
+    """
+
+    def __init__(self, store, flush_interval=0.005, max_batch=1000):
+        """
+        Args:
+            store: AttendanceStore to write to
+            flush_interval: seconds to keep collecting after the first punch
+            max_batch: flush early once this many records are pending
+        """
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue = None
+        self._task = None
+        self.stats = {"batches": 0, "records": 0, "largest_batch": 0}
+
+    def start(self):
+        """Start the writer task on the running event loop"""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            logger.info("Attendance writer started")
+
+    async def stop(self):
+        """Flush whatever is pending and stop the writer task"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        logger.info("Attendance writer stopped")
+
+    async def append(self, records):
+        """
+        Queue records for writing and wait until they are on disk
+
+        Raises whatever the underlying write raised, so a handler never
+        acknowledges a punch that was not persisted.
+        """
+        if self._task is None or self._task.done():
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        with span("attendance.append", records=len(records)):
+            await self._queue.put((list(records), future, current_trace()))
+            await future
+
+    async def _collect_batch(self, first):
+        """Gather punches that arrive within flush_interval of the first"""
+        batch = [first]
+        pending = len(first[0])
+        stop = False
+        deadline = time.monotonic() + self.flush_interval
+
+        while pending < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+            pending += len(item[0])
+
+        return batch, stop
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+
+            batch, stop = await self._collect_batch(first)
+            records = [record for item in batch for record in item[0]]
+
+            try:
+                # File I/O runs off the event loop so requests keep flowing
+                started = time.perf_counter()
+                await loop.run_in_executor(None, self.store.append_many, records)
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                for _, _, trace in batch:
+                    record_span("attendance.write", started, elapsed_ms, trace=trace, batch=len(records))
+                self.stats["batches"] += 1
+                self.stats["records"] += len(records)
+                self.stats["largest_batch"] = max(self.stats["largest_batch"], len(records))
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_result(None)
+            except Exception as e:
+                logger.error(f"Error writing attendance batch: {e}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+            if stop:
+                return
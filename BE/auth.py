@@ -0,0 +1,235 @@
+"""
+Authentication
+Salted password hashes, an in-memory login index and signed session tokens
+
+Users carry an optional "role" in users.json ("user" when absent). Admins
+(role "admin") can use the /api/admin endpoints; the API never lets a
+client set a role, so it is granted from the server's shell:
+
+Usage:
+    python auth.py set-role <phone> <user|admin>
+
+The role is copied into the session token at login, so a change applies
+from the user's next login.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import sys
+import threading
+import time
+
+from data_store import VersionedJsonStore
+
+logger = logging.getLogger(__name__)
+
+HASH_ALGORITHM = "pbkdf2_sha256"
+HASH_ITERATIONS = 100_000
+ROLES = ("user", "admin")
+
+
+def hash_password(password, iterations=HASH_ITERATIONS):
+    """Salted PBKDF2 hash stored as 'pbkdf2_sha256$iterations$salt$hash'"""
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return "$".join([
+        HASH_ALGORITHM,
+        str(iterations),
+        base64.b64encode(salt).decode(),
+        base64.b64encode(digest).decode()
+    ])
+
+
+def verify_password(password, stored_hash):
+    """Check a password against a stored hash in constant time"""
+    try:
+        algorithm, iterations, salt, expected = stored_hash.split("$")
+    except (AttributeError, ValueError):
+        return False
+    if algorithm != HASH_ALGORITHM:
+        return False
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), base64.b64decode(salt), int(iterations))
+    return hmac.compare_digest(digest, base64.b64decode(expected))
+
+
+# Verified against unknown phones so a miss costs the same as a wrong password
+_DUMMY_HASH = hash_password(secrets.token_hex(8))
+
+
+def public_user(user):
+    """User dict without credential fields"""
+    return {k: v for k, v in user.items() if k not in ("password", "passwordHash")}
+
+
+class UserIndex:
+    """
+    phone -> user lookup kept in memory
+
+    The index is rebuilt only when the users store version changes, so a
+    login is one dict lookup plus one password hash check regardless of
+    user count.
+    """
+
+    def __init__(self, users_store):
+        """
+        Args:
+            users_store: VersionedJsonStore for users.json
+        """
+        self.users_store = users_store
+        self._by_phone = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        version = self.users_store.version
+        if version == self._version:
+            return
+        with self._lock:
+            users = self.users_store.load()
+            self._by_phone = {str(u.get("phone")): u for u in users}
+            self._version = version
+
+    def lookup(self, phone):
+        self._refresh()
+        return self._by_phone.get(str(phone))
+
+    def authenticate(self, phone, password):
+        """Return the user for valid credentials, otherwise None"""
+        user = self.lookup(phone)
+        stored_hash = user.get("passwordHash") if user else None
+        valid = verify_password(password, stored_hash or _DUMMY_HASH)
+        return user if valid and stored_hash else None
+
+    def migrate_plaintext_passwords(self):
+        """
+        Replace plaintext 'password' fields in users.json with 'passwordHash'
+
+        Safe to run on every startup; returns how many users were migrated.
+        """
+        users = self.users_store.load_copy()
+
+        migrated = 0
+        for user in users:
+            if "password" in user:
+                user["passwordHash"] = hash_password(str(user.pop("password")))
+                migrated += 1
+
+        if migrated:
+            self.users_store.save(users)
+            logger.info(f"Migrated {migrated} plaintext passwords to salted hashes")
+        return migrated
+
+
+def set_role(users_store, phone, role):
+    """
+    Set the role of the user with this phone in users.json
+
+    Returns:
+        the updated user, or None if no user has that phone
+
+    Raises:
+        ValueError: role is not one of ROLES
+    """
+    if role not in ROLES:
+        raise ValueError(f"Unknown role: {role} (expected one of {', '.join(ROLES)})")
+    users = users_store.load_copy()
+    user = next((u for u in users if str(u.get("phone")) == str(phone)), None)
+    if user is None:
+        return None
+    user["role"] = role
+    users_store.save(users)
+    logger.info(f"Role of user {user['id']} set to {role}")
+    return user
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def load_secret(path=".auth_secret"):
+    """Token signing key from AUTH_SECRET, or a generated key kept on disk"""
+    env_secret = os.environ.get("AUTH_SECRET")
+    if env_secret:
+        return env_secret.encode()
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    secret = secrets.token_bytes(32)
+    with open(path, "wb") as f:
+        f.write(secret)
+    return secret
+
+
+class SessionTokens:
+    """
+    Stateless HMAC-signed session tokens ('<payload>.<signature>')
+
+    Verification is one HMAC over a short string and never touches a data
+    file, so it costs microseconds per request.
+    """
+
+    def __init__(self, secret, ttl_seconds=12 * 3600):
+        self.secret = secret
+        self.ttl_seconds = ttl_seconds
+
+    def _sign(self, payload):
+        return _b64encode(hmac.new(self.secret, payload.encode(), hashlib.sha256).digest())
+
+    def issue(self, user):
+        """Create a token for a user, returns (token, expires_at epoch)"""
+        expires_at = int(time.time()) + self.ttl_seconds
+        claims = {
+            "sub": user["id"],
+            "name": user.get("name"),
+            "role": user.get("role", "user"),
+            "exp": expires_at
+        }
+        payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+        return f"{payload}.{self._sign(payload)}", expires_at
+
+    def verify(self, token):
+        """Claims dict for a valid, unexpired token, otherwise None"""
+        try:
+            payload, signature = token.split(".")
+        except (AttributeError, ValueError):
+            return None
+        # Bytes: compare_digest refuses non-ASCII str, and headers can carry any latin-1
+        if not hmac.compare_digest(signature.encode(), self._sign(payload).encode()):
+            return None
+        try:
+            claims = json.loads(_b64decode(payload))
+        except ValueError:
+            return None
+        if claims.get("exp", 0) < time.time():
+            return None
+        return claims
+
+
+def main():
+    if len(sys.argv) != 4 or sys.argv[1] != "set-role":
+        print("Usage: python auth.py set-role <phone> <user|admin>")
+        sys.exit(1)
+
+    _, _, phone, role = sys.argv
+    try:
+        user = set_role(VersionedJsonStore("users.json"), phone, role)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    if user is None:
+        print(f"No user with phone {phone}")
+        sys.exit(1)
+    print(f"{user['name']} ({phone}) is now {role}; takes effect at their next login")
+
+
+if __name__ == "__main__":
+    main()
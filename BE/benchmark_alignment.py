@@ -0,0 +1,156 @@
+"""
+Alignment Benchmark
+Added latency versus recognition margin and retry rate, with and without
+landmark alignment, on datasets/new_dataset
+
+Each person's first image is enrolled upright. Queries are the same images
+rotated by a range of angles (a tilted phone at the kiosk). A query counts
+as a retry when the top match is wrong or below the recognition threshold.
+
+Usage:
+    python benchmark_alignment.py [dataset_dir] [models_dir]
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from face_alignment import load_aligner
+from face_gallery import FaceGallery
+from facenet_model import FaceNetRecognitionModel
+
+ANGLES = (0, 10, 20, 30)
+
+
+@contextmanager
+def scratch_model():
+    """
+    FaceNetRecognitionModel built in an empty temp directory
+
+    The constructor loads (and may publish) gallery snapshots and creates
+    registered_faces/ relative to the working directory. Built in a scratch
+    directory with only models/ linked in, it never touches the real
+    gallery. The directory is removed afterwards.
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as workdir:
+        os.symlink(os.path.abspath("models"), os.path.join(workdir, "models"))
+        os.chdir(workdir)
+        try:
+            model = FaceNetRecognitionModel()
+        finally:
+            os.chdir(cwd)
+        yield model
+
+
+def load_dataset(dataset_dir):
+    """One image per person, keyed by the NIM prefix of the file name"""
+    images = {}
+    for filename in sorted(os.listdir(dataset_dir)):
+        if not filename.lower().endswith((".jpg", ".jpeg", ".png")):
+            continue
+        person = filename.split("_")[0]
+        if person in images:
+            continue
+        image = cv2.imread(os.path.join(dataset_dir, filename))
+        if image is not None:
+            images[person] = image
+    return images
+
+
+def rotate(image, angle):
+    h, w = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    return cv2.warpAffine(image, matrix, (w, h), borderMode=cv2.BORDER_REPLICATE)
+
+
+def crop(model, image):
+    """(face crop, extraction ms) for the largest face, or (None, 0)"""
+    faces = model.detect_faces(image)
+    if len(faces) == 0:
+        return None, 0.0
+    box = max(faces, key=lambda b: b[2] * b[3])
+    start = time.perf_counter()
+    face = model._extract_face(image, box)
+    return face, (time.perf_counter() - start) * 1000
+
+
+def run(model, images, aligner):
+    """Enroll upright images, query rotated ones; returns one row per angle"""
+    model.aligner = aligner
+
+    enrolled = {}
+    for person, image in images.items():
+        face, _ = crop(model, image)
+        if face is not None:
+            enrolled[person] = model._get_embedding(face)
+    gallery = FaceGallery(enrolled)
+
+    rows = []
+    for angle in ANGLES:
+        margins, timings = [], []
+        retries = queries = 0
+        for person in enrolled:
+            face, elapsed = crop(model, rotate(images[person], angle))
+            queries += 1
+            if face is None:
+                retries += 1
+                continue
+            timings.append(elapsed)
+
+            scores = gallery.similarities(model._get_embedding(face))[0]
+            genuine = scores[gallery.index[person]]
+            impostor = np.delete(scores, gallery.index[person]).max() if len(scores) > 1 else -1.0
+            margins.append(genuine - impostor)
+
+            best = gallery.names[int(scores.argmax())]
+            if best != person or scores.max() < model.recognition_threshold:
+                retries += 1
+
+        rows.append({
+            "angle": angle,
+            "queries": queries,
+            "retry_rate": retries / queries if queries else 0.0,
+            "median_margin": statistics.median(margins) if margins else 0.0,
+            "extract_ms": statistics.median(timings) if timings else 0.0
+        })
+    return rows
+
+
+def main():
+    dataset_dir = sys.argv[1] if len(sys.argv) > 1 else "datasets/new_dataset"
+    models_dir = sys.argv[2] if len(sys.argv) > 2 else "models"
+
+    aligner = load_aligner(models_dir)
+    if aligner is None:
+        print(f"No landmark model in {models_dir}; see face_alignment.py for the supported files")
+        sys.exit(1)
+
+    images = load_dataset(dataset_dir)
+    print(f"{len(images)} people from {dataset_dir}, landmarks: {aligner.backend}")
+
+    with scratch_model() as model:
+        results = {
+            "plain": run(model, images, None),
+            "aligned": run(model, images, aligner)
+        }
+
+    print()
+    print(f"{'angle':>5} | {'mode':>7} | {'retry rate':>10} | {'median margin':>13} | {'extract (ms)':>12}")
+    print("-" * 62)
+    for plain, aligned in zip(results["plain"], results["aligned"]):
+        for mode, row in (("plain", plain), ("aligned", aligned)):
+            print(f"{row['angle']:>5} | {mode:>7} | {row['retry_rate']:>10.1%} | "
+                  f"{row['median_margin']:>13.3f} | {row['extract_ms']:>12.2f}")
+    print()
+    print(f"alignment fallbacks (no landmarks found): {aligner.stats['fallbacks']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Compression Benchmark
+Accuracy versus scan memory and latency of the compressed gallery scan,
+on datasets/new_dataset
+
+Each person's image is enrolled as-is. Queries are augmented copies
+(mirrored, darker, brighter, tilted, blurred), the kind of variation a
+kiosk camera adds. The PCA projection is fit on the enrolled and augmented
+embeddings together, since the dataset has fewer people than components.
+
+To see how the scan scales, the gallery is padded with synthetic
+distractors (mixtures of two enrolled faces plus noise) up to each size in
+GALLERY_SIZES; accuracy is always measured on the real people.
+
+Usage:
+    python benchmark_compression.py [dataset_dir] [components]
+"""
+
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from benchmark_alignment import crop, load_dataset, rotate, scratch_model
+from face_gallery import FaceGallery, normalize_rows
+from gallery_compression import fit_projection
+
+GALLERY_SIZES = (1_000, 10_000, 100_000)
+MODES = (
+    # (label, storage, rescore_top_k); None storage = exact float32 512-d
+    ("exact", None, 0),
+    ("float32", "float32", 1),
+    ("float32+rescore", "float32", 8),
+    ("float16", "float16", 1),
+    ("float16+rescore", "float16", 8),
+    ("int8", "int8", 1),
+    ("int8+rescore", "int8", 8),
+)
+
+
+def augment(image):
+    """Camera-like variants of one enrolled image"""
+    return [
+        cv2.flip(image, 1),
+        cv2.convertScaleAbs(image, alpha=0.7, beta=0),
+        cv2.convertScaleAbs(image, alpha=1.2, beta=15),
+        rotate(image, 10),
+        cv2.GaussianBlur(image, (5, 5), 0),
+    ]
+
+
+def embed(model, images):
+    """(enrolled name -> embedding, list of (person, query embedding))"""
+    enrolled, queries = {}, []
+    for person, image in images.items():
+        face, _ = crop(model, image)
+        if face is None:
+            continue
+        enrolled[person] = model._get_embedding(face)
+        for variant in augment(image):
+            face, _ = crop(model, variant)
+            if face is not None:
+                queries.append((person, model._get_embedding(face)))
+    return enrolled, queries
+
+
+def pad_gallery(enrolled, size, seed=0):
+    """Enrolled embeddings plus synthetic distractors up to `size` rows"""
+    rng = np.random.default_rng(seed)
+    real = normalize_rows(np.stack([np.ravel(e) for e in enrolled.values()]))
+    padded = dict(enrolled)
+    count = size - len(enrolled)
+    if count > 0:
+        a = real[rng.integers(len(real), size=count)]
+        b = real[rng.integers(len(real), size=count)]
+        mix = rng.uniform(0.3, 0.7, size=(count, 1)).astype(np.float32)
+        noise = rng.normal(0, 0.5 / np.sqrt(real.shape[1]), size=a.shape).astype(np.float32)
+        rows = normalize_rows(mix * a + (1 - mix) * b + noise)
+        padded.update({f"distractor_{i}": row for i, row in enumerate(rows)})
+    return padded
+
+
+def run(embeddings, queries, projection, storage, rescore_top_k):
+    """One gallery / mode combination -> result row"""
+    compression = None
+    if storage is not None:
+        compression = {**projection, "storage": storage, "rescore_top_k": rescore_top_k, "min_gallery": 0}
+    gallery = FaceGallery(embeddings, compression=compression)
+    exact = FaceGallery(embeddings) if compression else gallery
+
+    correct = agree = 0
+    timings = []
+    for person, embedding in queries:
+        start = time.perf_counter()
+        name, _, _ = gallery.best_two(embedding)
+        timings.append((time.perf_counter() - start) * 1000)
+        correct += name == person
+        agree += name == exact.best_two(embedding)[0]
+
+    scan_bytes = gallery.compact.nbytes if gallery.compact else gallery.matrix.nbytes
+    return {
+        "accuracy": correct / len(queries) if queries else 0.0,
+        "agreement": agree / len(queries) if queries else 0.0,
+        "scan_mb": scan_bytes / (1024 * 1024),
+        "query_ms": statistics.median(timings) if timings else 0.0
+    }
+
+
+def main():
+    dataset_dir = sys.argv[1] if len(sys.argv) > 1 else "datasets/new_dataset"
+    components = int(sys.argv[2]) if len(sys.argv) > 2 else 128
+
+    images = load_dataset(dataset_dir)
+    with scratch_model() as model:
+        enrolled, queries = embed(model, images)
+    print(f"{len(enrolled)} people enrolled from {dataset_dir}, {len(queries)} augmented queries")
+
+    samples = np.stack([np.ravel(e) for e in list(enrolled.values()) + [e for _, e in queries]])
+    projection = fit_projection(samples, {"components": components})
+    print(f"PCA {projection['components']}-d on {projection['samples']} embeddings, "
+          f"explained variance {projection['explained_variance']:.3f}")
+
+    print()
+    print(f"{'gallery':>8} | {'mode':>16} | {'accuracy':>8} | {'vs exact':>9} | {'scan (MB)':>9} | {'query (ms)':>10}")
+    print("-" * 76)
+    for size in (len(enrolled),) + GALLERY_SIZES:
+        embeddings = pad_gallery(enrolled, size)
+        for label, storage, rescore_top_k in MODES:
+            row = run(embeddings, queries, projection, storage, rescore_top_k)
+            print(f"{len(embeddings):>8} | {label:>16} | {row['accuracy']:>8.1%} | {row['agreement']:>9.1%} | "
+                  f"{row['scan_mb']:>9.2f} | {row['query_ms']:>10.3f}")
+    print()
+    print("vs exact: queries whose top match equals the exact scan's; '+rescore' re-scores "
+          "the top 8 candidates against the full 512-d rows")
+
+
+if __name__ == "__main__":
+    main()
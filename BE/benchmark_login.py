@@ -0,0 +1,85 @@
+"""
+Login Benchmark
+Shows that login and session verification cost stay flat as users grow
+
+Usage:
+    python benchmark_login.py
+"""
+
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from auth import UserIndex, SessionTokens, hash_password
+from data_store import VersionedJsonStore
+
+USER_COUNTS = (10, 1_000, 10_000, 100_000)
+ATTEMPTS = 20
+
+
+def make_users_file(directory, count, password_hash):
+    """Write a synthetic users.json with `count` users"""
+    users = [
+        {
+            "id": str(i + 1),
+            "name": f"User {i + 1}",
+            "phone": str(5231800000 + i),
+            "passwordHash": password_hash,
+            "faceImage": ""
+        }
+        for i in range(count)
+    ]
+    path = os.path.join(directory, f"users_{count}.json")
+    with open(path, "w") as f:
+        json.dump(users, f)
+    return path, users
+
+
+def linear_scan_login(users_file, phone, password):
+    """The previous implementation: re-read the file and scan every user"""
+    with open(users_file, "r") as f:
+        users = json.load(f)
+    return next((u for u in users if u.get("phone") == phone and u.get("password") == password), None)
+
+
+def time_ms(fn, attempts=ATTEMPTS):
+    samples = []
+    for _ in range(attempts):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    password = "Secret123"
+    password_hash = hash_password(password)
+    tokens = SessionTokens(b"benchmark-secret")
+
+    print(f"{'users':>8} | {'old scan (ms)':>13} | {'login (ms)':>10} | {'token verify (us)':>17}")
+    print("-" * 58)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for count in USER_COUNTS:
+            users_file, users = make_users_file(directory, count, password_hash)
+            last_phone = users[-1]["phone"]
+
+            index = UserIndex(VersionedJsonStore(users_file))
+            index.lookup(last_phone)  # warm the in-memory index once
+
+            old_ms = time_ms(lambda: linear_scan_login(users_file, last_phone, password), attempts=5)
+            login_ms = time_ms(lambda: index.authenticate(last_phone, password))
+
+            token, _ = tokens.issue(users[-1])
+            verify_us = time_ms(lambda: tokens.verify(token), attempts=1000) * 1000
+
+            print(f"{count:>8} | {old_ms:>13.2f} | {login_ms:>10.2f} | {verify_us:>17.1f}")
+
+    print()
+    print("login = dict lookup + one PBKDF2 check, independent of user count")
+
+
+if __name__ == "__main__":
+    main()
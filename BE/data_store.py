@@ -0,0 +1,102 @@
+"""
+Versioned Data Stores
+JSON files cached in memory with a change counter for cheap ETags
+"""
+
+import copy
+import json
+import os
+import secrets
+import threading
+import time
+
+from tracing import span
+
+# Changes on every server start so ETags from a previous process never match
+BOOT_ID = secrets.token_hex(4)
+
+
+class VersionedJsonStore:
+    """
+    A JSON data file cached in memory with a change counter
+
+    `version` goes up on every save through this store and whenever the file
+    is found to have changed on disk. Edits made by other processes are
+    picked up by an mtime check that runs at most once per check_interval,
+    so reading `version` is normally just a memory access. That makes it
+    suitable for answering If-None-Match before touching the file at all.
+    """
+
+    def __init__(self, path, default=list, check_interval=1.0):
+        """
+        Args:
+            path: JSON file path
+            default: factory for the value used when the file doesn't exist
+            check_interval: seconds between mtime checks for outside edits
+        """
+        self.path = path
+        self.default = default
+        self.check_interval = check_interval
+
+        self._data = None
+        self._mtime = None
+        self._version = 0
+        self._last_check = 0.0
+        self._lock = threading.RLock()
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _check_external(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        mtime = self._file_mtime()
+        if self._data is None or mtime != self._mtime:
+            with self._lock:
+                if mtime is None:
+                    self._data = self.default()
+                else:
+                    with open(self.path, "r") as f:
+                        self._data = json.load(f)
+                self._mtime = mtime
+                self._version += 1
+
+    @property
+    def version(self):
+        """Change counter, bumped on every change to the data"""
+        self._check_external()
+        return self._version
+
+    def load(self):
+        """Cached data (shared, do not mutate; use load_copy for edits)"""
+        self._check_external(force=self._data is None)
+        return self._data
+
+    def load_copy(self):
+        """Deep copy of the data for read-modify-write"""
+        return copy.deepcopy(self.load())
+
+    def save(self, data):
+        """Atomically write data to disk and bump the version"""
+        with self._lock, span("store.save", file=os.path.basename(self.path)):
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+            self._data = data
+            self._mtime = self._file_mtime()
+            self._last_check = time.monotonic()
+            self._version += 1
+
+
+def make_etag(*parts):
+    """Weak ETag from the boot ID and the versions a response depends on"""
+    return 'W/"' + "-".join([BOOT_ID] + [str(p) for p in parts]) + '"'
@@ -0,0 +1,97 @@
+"""
+Live Events
+Fan-out of attendance changes to server-sent event subscribers
+"""
+
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Sent to a subscriber that fell too far behind, right before it is dropped
+RESYNC = object()
+
+
+class Subscriber:
+    """One connected client with its own bounded event buffer"""
+
+    def __init__(self, buffer_size):
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+
+
+class EventBroadcaster:
+    """
+    Publishes small delta events to every connected dashboard
+
+    Each subscriber has a bounded queue. publish() never waits: if a
+    subscriber's buffer is full it is dropped and told to resync (reload its
+    state with a normal GET), so one slow client can't hold up the others or
+    grow server memory. The cost of a change is one put per open dashboard
+    rather than a full recompute per poll.
+    """
+
+    def __init__(self, buffer_size=256):
+        self.buffer_size = buffer_size
+        self._subscribers = set()
+        self._sequence = 0
+        self.stats = {"published": 0, "dropped_subscribers": 0}
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def subscribe(self):
+        subscriber = Subscriber(self.buffer_size)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    def publish(self, event_type, data):
+        """Queue an event for every subscriber (call from the event loop)"""
+        self._sequence += 1
+        event = (self._sequence, event_type, data)
+        self.stats["published"] += 1
+
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._drop(subscriber)
+
+    def _drop(self, subscriber):
+        """Slow consumer: discard its backlog and ask it to resync"""
+        self._subscribers.discard(subscriber)
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(RESYNC)
+        self.stats["dropped_subscribers"] += 1
+        logger.info("Dropped slow event subscriber")
+
+    async def stream(self, subscriber, heartbeat=15.0):
+        """
+        Yield server-sent event frames for a subscriber
+
+        Sends a comment line every `heartbeat` seconds so proxies keep the
+        connection open. Always unsubscribes when the client goes away.
+        """
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+
+                if event is RESYNC:
+                    yield "event: resync\ndata: {}\n\n"
+                    return
+
+                sequence, event_type, data = event
+                payload = json.dumps(data, separators=(",", ":"))
+                yield f"id: {sequence}\nevent: {event_type}\ndata: {payload}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
@@ -0,0 +1,171 @@
+"""
+Face Alignment
+Warps a detected face onto a canonical 5-point template before embedding
+
+Landmarks come from whichever lightweight model is found in models/:
+    - YuNet (face_detection_yunet_2023mar.onnx), 5 points, OpenCV >= 4.5.4
+    - Facemark LBF (lbfmodel.yaml), 68 points, needs opencv-contrib
+"""
+
+import logging
+import os
+import threading
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+YUNET_MODEL = "face_detection_yunet_2023mar.onnx"
+LBF_MODEL = "lbfmodel.yaml"
+
+# Eye centers, nose tip and mouth corners (image left first) for a 112x112
+# crop, the usual ArcFace template
+_TEMPLATE_112 = np.array([
+    [38.2946, 51.6963],
+    [73.5318, 51.5014],
+    [56.0252, 71.7366],
+    [41.5493, 92.3655],
+    [70.7299, 92.2041]
+], dtype=np.float32)
+
+
+def make_template(size=160, face_fraction=0.8):
+    """
+    Template scaled to `size`, shrunk to `face_fraction` of the crop
+
+    FaceNet was trained on loose crops, so the template keeps a margin
+    around the face comparable to the 20% box padding used without
+    alignment.
+    """
+    scale = size / 112.0 * face_fraction
+    offset = size * (1.0 - face_fraction) / 2.0
+    return _TEMPLATE_112 * scale + offset
+
+
+class FaceAligner:
+    """
+    Landmarks + one similarity transform per face
+
+    Landmarks are searched only in a padded window around the detector box,
+    and the crop is produced by a single warpAffine from the source image
+    (no intermediate crop/resize), so alignment adds one small landmark
+    pass per face. The landmark model holds per-call state (YuNet's input
+    size, LBF's fit buffers), so calls into it are serialized.
+    """
+
+    def __init__(self, backend, model, target_size=(160, 160)):
+        """
+        Args:
+            backend: 'yunet' or 'lbf'
+            model: loaded OpenCV model for that backend
+            target_size: output crop size
+        """
+        self.backend = backend
+        self.model = model
+        self.target_size = target_size
+        self.template = make_template(target_size[0])
+        self.stats = {"aligned": 0, "fallbacks": 0}
+        self._lock = threading.Lock()
+
+    def landmarks(self, image, box):
+        """
+        5 landmarks (image coordinates) for the face in `box`, or None
+
+        Args:
+            image: BGR image
+            box: (x, y, w, h) detector box
+        """
+        if self.backend == "yunet":
+            return self._landmarks_yunet(image, box)
+        return self._landmarks_lbf(image, box)
+
+    def _landmarks_yunet(self, image, box):
+        x, y, w, h = [int(v) for v in box]
+        pad = max(w, h) // 2
+        x1, y1 = max(0, x - pad), max(0, y - pad)
+        x2, y2 = min(image.shape[1], x + w + pad), min(image.shape[0], y + h + pad)
+        window = image[y1:y2, x1:x2]
+        if window.size == 0:
+            return None
+
+        with self._lock:
+            self.model.setInputSize((window.shape[1], window.shape[0]))
+            _, faces = self.model.detect(window)
+        if faces is None or len(faces) == 0:
+            return None
+
+        # The detection closest to the box center is ours
+        center = np.array([x + w / 2.0 - x1, y + h / 2.0 - y1])
+        centers = faces[:, 0:2] + faces[:, 2:4] / 2.0
+        face = faces[np.argmin(np.linalg.norm(centers - center, axis=1))]
+        return face[4:14].reshape(5, 2) + np.array([x1, y1], dtype=np.float32)
+
+    def _landmarks_lbf(self, image, box):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        with self._lock:
+            ok, shapes = self.model.fit(gray, np.array([box], dtype=np.int32))
+        if not ok or len(shapes) == 0:
+            return None
+        points = shapes[0][0]
+        return np.array([
+            points[36:42].mean(axis=0),
+            points[42:48].mean(axis=0),
+            points[30],
+            points[48],
+            points[54]
+        ], dtype=np.float32)
+
+    def align(self, image, box):
+        """
+        Aligned RGB crop of the face in `box`, or None if no landmarks
+
+        Args:
+            image: BGR image
+            box: (x, y, w, h) detector box
+        """
+        points = self.landmarks(image, box)
+        if points is None:
+            self.stats["fallbacks"] += 1
+            return None
+
+        matrix, _ = cv2.estimateAffinePartial2D(points.astype(np.float32), self.template, method=cv2.LMEDS)
+        if matrix is None:
+            self.stats["fallbacks"] += 1
+            return None
+
+        face = cv2.warpAffine(image, matrix, self.target_size, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        self.stats["aligned"] += 1
+        return cv2.cvtColor(face, cv2.COLOR_BGR2RGB)
+
+
+@lru_cache(maxsize=None)
+def load_aligner(models_dir="models"):
+    """
+    Load the landmark model once per process
+
+    Returns:
+        FaceAligner, or None if no landmark model is available
+    """
+    yunet_path = os.path.join(models_dir, YUNET_MODEL)
+    if os.path.exists(yunet_path) and hasattr(cv2, "FaceDetectorYN"):
+        try:
+            model = cv2.FaceDetectorYN.create(yunet_path, "", (320, 320), 0.6)
+            logger.info("✅ Face alignment enabled (YuNet landmarks)")
+            return FaceAligner("yunet", model)
+        except Exception as e:
+            logger.warning(f"Could not load YuNet: {e}")
+
+    lbf_path = os.path.join(models_dir, LBF_MODEL)
+    if os.path.exists(lbf_path) and hasattr(cv2, "face"):
+        try:
+            model = cv2.face.createFacemarkLBF()
+            model.loadModel(lbf_path)
+            logger.info("✅ Face alignment enabled (Facemark LBF landmarks)")
+            return FaceAligner("lbf", model)
+        except Exception as e:
+            logger.warning(f"Could not load Facemark LBF: {e}")
+
+    logger.info(f"⚠️ Face alignment unavailable (no landmark model in {models_dir})")
+    return None
@@ -0,0 +1,331 @@
+"""
+Face Gallery
+Matrix view of the registered FaceNet embeddings for vectorized matching
+"""
+
+import copy
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from gallery_compression import CompactMatrix
+
+
+def normalize_rows(matrix):
+    """L2-normalize each row so a dot product equals cosine similarity"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class FaceGallery:
+    """
+    Read-only snapshot of the registered embeddings
+
+    All embeddings are stacked into one normalized matrix so a query against
+    the whole gallery is a single matrix product. The model builds a new
+    instance whenever embeddings change instead of mutating this one, so a
+    request that grabbed a reference always sees a consistent gallery.
+
+    Deletes and renames go through with_changes(), which shares the matrix
+    and marks deleted rows as tombstones instead of rebuilding it.
+
+    With a compression projection and a large enough gallery, whole-gallery
+    lookups scan a compact PCA / quantized copy first and re-score only the
+    shortlist against the full matrix (see gallery_compression.py).
+    """
+
+    def __init__(self, face_embeddings, shards=None, calibration=None, user_ids=None, compression=None):
+        """
+        Args:
+            face_embeddings: dict mapping name -> embedding vector
+            shards: optional dict mapping shard name -> iterable of names.
+                    Names that are not in the gallery are ignored.
+            calibration: optional output of gallery_calibration.calibrate
+                         with per-identity thresholds and a margin rule
+            user_ids: optional dict mapping name -> integer user ID
+            compression: optional projection from gallery_compression
+        """
+        self.names = list(face_embeddings.keys())
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+        if self.names:
+            self.matrix = normalize_rows(
+                np.stack([np.asarray(face_embeddings[name]).ravel() for name in self.names])
+            )
+        else:
+            self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.matrix.setflags(write=False)
+        self.dead = np.zeros(len(self.names), dtype=bool)  # tombstoned rows
+
+        # Integer user ID per row (-1 = not linked to a user)
+        user_ids = user_ids or {}
+        self.user_ids = np.array([user_ids.get(name, -1) for name in self.names], dtype=np.int32)
+
+        # Per-identity thresholds (NaN = use the caller's default)
+        calibration = calibration or {}
+        thresholds = calibration.get("thresholds", {})
+        self.thresholds = np.array([thresholds.get(name, np.nan) for name in self.names], dtype=np.float32)
+        self.min_margin = float(calibration.get("min_margin", 0.0))
+
+        # Compact scan copy, only where it beats the exact scan
+        self.compact = None
+        if compression is not None and len(self.names) >= compression["min_gallery"]:
+            self.compact = CompactMatrix(self.matrix, compression)
+
+        # Each shard keeps its own contiguous sub-matrix so a shard scan
+        # touches only its rows
+        self.shards = {}
+        for shard, members in (shards or {}).items():
+            rows = np.array(sorted(self.index[n] for n in set(members) if n in self.index), dtype=np.int64)
+            if len(rows) == 0:
+                continue
+            sub_matrix = self.matrix[rows]
+            sub_matrix.setflags(write=False)
+            self.shards[shard] = (rows, sub_matrix)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def tombstones(self):
+        return int(self.dead.sum())
+
+    def with_changes(self, deleted=(), renamed=None, user_ids=None):
+        """
+        New gallery sharing this one's matrix, with identities removed or
+        relabeled
+
+        Costs no matrix work: deleted rows become tombstones that never
+        match, renamed rows just get a new label. Compaction happens the
+        next time a gallery is built from scratch.
+
+        Args:
+            deleted: names to remove
+            renamed: dict mapping old name -> new name
+            user_ids: dict mapping name -> integer user ID; a renamed row
+                      takes its new name's ID (-1 if the name isn't linked)
+        """
+        gallery = copy.copy(self)
+        gallery.names = list(self.names)
+        gallery.index = dict(self.index)
+        gallery.dead = self.dead.copy()
+        if renamed:
+            gallery.user_ids = self.user_ids.copy()
+
+        for name in deleted:
+            row = gallery.index.pop(name, None)
+            if row is not None:
+                gallery.names[row] = None
+                gallery.dead[row] = True
+
+        for old, new in (renamed or {}).items():
+            row = gallery.index.pop(old, None)
+            if row is not None:
+                gallery.names[row] = new
+                gallery.index[new] = row
+                gallery.user_ids[row] = (user_ids or {}).get(new, -1)
+        return gallery
+
+    def user_id_of(self, name):
+        """Integer user ID of a registered name, or None"""
+        row = self.index.get(name)
+        if row is None or self.user_ids[row] < 0:
+            return None
+        return int(self.user_ids[row])
+
+    def _mask_dead(self, scores, rows):
+        """Push tombstoned rows below any real score"""
+        if self.dead.any():
+            dead = self.dead if rows is None else self.dead[rows]
+            scores[:, dead] = -1.0
+        return scores
+
+    def has_shard(self, shard):
+        return shard in self.shards
+
+    def _scope(self, shard):
+        """Row indices and matrix for a shard, or the whole gallery"""
+        if shard is None:
+            return None, self.matrix
+        return self.shards[shard]
+
+    def similarities(self, embeddings, shard=None):
+        """
+        Cosine similarity of each query embedding against gallery entries
+
+        Args:
+            embeddings: array of shape (n, d) or (d,)
+            shard: optional shard name to restrict the comparison to
+
+        Returns:
+            array of shape (n, entries in scope)
+        """
+        queries = normalize_rows(embeddings)
+        rows, matrix = self._scope(shard)
+        if matrix.shape[0] == 0:
+            return np.zeros((queries.shape[0], 0), dtype=np.float32)
+        return self._mask_dead(queries @ matrix.T, rows)
+
+    def best_match(self, embedding, shard=None):
+        """
+        Find the closest gallery entry for a single embedding
+
+        Args:
+            embedding: query vector
+            shard: optional shard name to restrict the search to
+
+        Returns:
+            (name, similarity) or (None, -1.0) when the scope is empty
+        """
+        if shard is None and self.compact is not None:
+            name, best, _ = self._best_two_compact(embedding)
+            return name, best
+        scores = self.similarities(embedding, shard)[0]
+        if len(scores) == 0:
+            return None, -1.0
+        best = int(np.argmax(scores))
+        rows, _ = self._scope(shard)
+        row = best if rows is None else int(rows[best])
+        return self.names[row], float(scores[best])
+
+    def threshold_for(self, name, default):
+        """Calibrated threshold of an identity, or the default"""
+        row = self.index.get(name)
+        if row is None or np.isnan(self.thresholds[row]):
+            return default
+        return float(self.thresholds[row])
+
+    def best_two(self, embedding, shard=None):
+        """
+        Closest gallery entry plus the runner-up score
+
+        Returns:
+            (name, best similarity, second best similarity); the second
+            score is -1.0 when the scope has a single entry
+        """
+        if shard is None and self.compact is not None:
+            return self._best_two_compact(embedding)
+        scores = self.similarities(embedding, shard)[0]
+        if len(scores) == 0:
+            return None, -1.0, -1.0
+        if len(scores) == 1:
+            second = -1.0
+            best = 0
+        else:
+            top = np.argpartition(scores, -2)[-2:]
+            best, runner_up = (top[1], top[0]) if scores[top[1]] >= scores[top[0]] else (top[0], top[1])
+            second = float(scores[runner_up])
+        rows, _ = self._scope(shard)
+        row = int(best) if rows is None else int(rows[best])
+        return self.names[row], float(scores[best]), second
+
+    def _best_two_compact(self, embedding):
+        """best_two over the whole gallery via the compact shortlist"""
+        query = normalize_rows(embedding)[0]
+        approx = self.compact.scores(query)
+        if self.dead.any():
+            approx[self.dead] = -np.inf
+
+        # Exact full-precision scores for the shortlist only
+        k = min(self.compact.rescore_top_k, len(approx))
+        candidates = np.argpartition(approx, -k)[-k:]
+        exact = self.matrix[candidates] @ query
+        exact[self.dead[candidates]] = -1.0
+
+        order = np.argsort(exact)[::-1]
+        best = int(candidates[order[0]])
+        second = float(exact[order[1]]) if k > 1 else -1.0
+        return self.names[best], float(exact[order[0]]), second
+
+    def decide(self, name, best, second, default_threshold):
+        """
+        Accept or reject a best match
+
+        Returns:
+            'recognized', 'ambiguous' (passes the identity threshold but is
+            too close to the runner-up) or 'below_threshold'
+        """
+        if name is None or best < self.threshold_for(name, default_threshold):
+            return 'below_threshold'
+        if best - second < self.min_margin:
+            return 'ambiguous'
+        return 'recognized'
+
+    def assign(self, embeddings, threshold, shard=None):
+        """
+        Match several faces at once with at most one face per identity
+
+        Solves the face -> identity assignment maximizing total similarity,
+        then drops pairs below the threshold (the identity's calibrated
+        threshold when it has one). A face whose best score doesn't beat its
+        runner-up by the calibrated margin is left out of the assignment, as
+        decide() rejects it for a single face. With a shard, faces are first
+        assigned within the shard and only the leftovers are matched against
+        the rest of the gallery.
+
+        Args:
+            embeddings: array of shape (n, d)
+            threshold: minimum cosine similarity for a match
+            shard: optional shard name to try first
+
+        Returns:
+            list of (name or None, similarity) in input order. For unmatched
+            faces the similarity is the best raw score seen for that face.
+        """
+        queries = normalize_rows(embeddings)
+        results = [(None, 0.0)] * queries.shape[0]
+        taken = set()
+
+        if shard is not None and shard in self.shards:
+            self._assign_scope(queries, range(queries.shape[0]), shard, threshold, results, taken)
+
+        remaining = [i for i, (name, _) in enumerate(results) if name is None]
+        if remaining:
+            self._assign_scope(queries, remaining, None, threshold, results, taken)
+
+        return results
+
+    def _assign_scope(self, queries, face_rows, shard, threshold, results, taken):
+        """Run one assignment pass over a scope, filling results in place"""
+        face_rows = list(face_rows)
+        rows, matrix = self._scope(shard)
+        if not face_rows or matrix.shape[0] == 0:
+            return
+
+        scores = self._mask_dead(queries[face_rows] @ matrix.T, rows)
+        gallery_rows = np.arange(matrix.shape[0]) if rows is None else rows
+
+        # Ambiguous faces (too close to two identities) take no part
+        if self.min_margin > 0 and matrix.shape[0] > 1:
+            top_two = np.partition(scores, -2, axis=1)[:, -2:]
+            ambiguous = top_two[:, 1] - top_two[:, 0] < self.min_margin
+            for i in np.nonzero(ambiguous)[0]:
+                face = face_rows[i]
+                results[face] = (None, max(results[face][1], float(top_two[i, 1])))
+            face_rows = [face for face, skip in zip(face_rows, ambiguous) if not skip]
+            scores = scores[~ambiguous]
+            if not face_rows:
+                return
+
+        # Identities already claimed by an earlier pass can't match again
+        if taken:
+            claimed = np.isin(gallery_rows, list(taken))
+            scores[:, claimed] = -1.0
+
+        for i, face in enumerate(face_rows):
+            best = float(scores[i].max())
+            if best > results[face][1]:
+                results[face] = (None, best)
+
+        faces, cols = linear_sum_assignment(scores, maximize=True)
+        for i, col in zip(faces, cols):
+            score = float(scores[i, col])
+            row = int(gallery_rows[col])
+            row_threshold = threshold if np.isnan(self.thresholds[row]) else float(self.thresholds[row])
+            if score >= row_threshold:
+                results[face_rows[i]] = (self.names[row], score)
+                taken.add(row)
@@ -0,0 +1,246 @@
+"""
+Face Image Store
+Content-addressed storage for enrollment images, face crops and thumbnails
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import threading
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class FaceImageStore:
+    """
+    Stores every image once under the SHA-256 of its bytes
+
+    Layout (inside the registered faces directory):
+        _objects/ab/abcdef....jpg     immutable blobs, named by content hash
+        _objects/index.json           thumbnail cache for external images
+        <name>/manifest.json          digests of a person's enrollment images
+
+    Because a blob never changes once written, it can be served with an
+    ETag equal to its digest and 'immutable' cache headers. Uploading the
+    same photo twice stores it once. Blobs all carry a .jpg name, but
+    originals are kept as uploaded (PNG, WebP, ...), so media_type() reads
+    the real type from the file header.
+
+    Thumbnails of files on disk are only made for paths inside
+    `source_dirs`; anything else (absolute paths, '..') is refused.
+    """
+
+    THUMBNAIL_SIZES = (48, 96, 192)
+    JPEG_QUALITY = 85
+
+    def __init__(self, root="registered_faces", source_dirs=("datasets",)):
+        """
+        Args:
+            root: registered faces directory holding the blob store
+            source_dirs: directories thumbnail_for_file may read from
+                         (besides root)
+        """
+        self.root = root
+        self.objects_dir = os.path.join(root, "_objects")
+        self.index_file = os.path.join(self.objects_dir, "index.json")
+        Path(self.objects_dir).mkdir(parents=True, exist_ok=True)
+        self.source_dirs = [os.path.realpath(d) for d in (root, *source_dirs)]
+
+        self._lock = threading.Lock()
+        self._media_types = {}  # digest -> MIME type, blobs never change
+        self._thumbnail_index = {}
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, "r") as f:
+                    self._thumbnail_index = json.load(f)
+            except Exception as e:
+                logger.error(f"Error loading thumbnail index: {e}")
+
+    # ----- blobs -----
+
+    def object_path(self, digest):
+        """Path of a stored blob, or None for a malformed digest"""
+        if not DIGEST_PATTERN.match(digest):
+            return None
+        return os.path.join(self.objects_dir, digest[:2], f"{digest}.jpg")
+
+    @staticmethod
+    def object_url(digest):
+        return f"/media/{digest}.jpg"
+
+    def media_type(self, digest):
+        """MIME type of a stored blob from its header (image/jpeg if unknown)"""
+        media_type = self._media_types.get(digest)
+        if media_type is None:
+            try:
+                with Image.open(self.object_path(digest)) as image:
+                    media_type = image.get_format_mimetype() or "image/jpeg"
+            except Exception:
+                media_type = "image/jpeg"
+            self._media_types[digest] = media_type
+        return media_type
+
+    def put_bytes(self, data):
+        """Store raw bytes (deduplicated) and return their digest"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def put_image(self, image):
+        """Encode a PIL image as JPEG and store it"""
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=self.JPEG_QUALITY)
+        return self.put_bytes(buffer.getvalue())
+
+    def _thumbnails(self, image):
+        """Store square-bounded thumbnails, returns {size: digest}"""
+        thumbnails = {}
+        for size in self.THUMBNAIL_SIZES:
+            thumb = image.copy()
+            thumb.thumbnail((size, size))
+            thumbnails[str(size)] = self.put_image(thumb)
+        return thumbnails
+
+    # ----- enrollments -----
+
+    def save_enrollment(self, name, face_rgb, original_bytes=None):
+        """
+        Save the images for a registered face
+
+        Args:
+            name: person's name (directory under the store root)
+            face_rgb: 160x160 RGB face crop as a numpy array
+            original_bytes: the uploaded file as received, stored unmodified
+
+        Returns:
+            manifest dict with digests of original, face crop and thumbnails
+        """
+        face = Image.fromarray(face_rgb)
+        manifest = {
+            "original": self.put_bytes(original_bytes) if original_bytes else None,
+            "face": self.put_image(face),
+            "thumbnails": self._thumbnails(face)
+        }
+
+        user_dir = os.path.join(self.root, name)
+        Path(user_dir).mkdir(parents=True, exist_ok=True)
+        tmp_path = os.path.join(user_dir, "manifest.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(user_dir, "manifest.json"))
+
+        return manifest
+
+    def get_enrollment(self, name):
+        """Manifest for a registered name, or None"""
+        path = os.path.join(self.root, name, "manifest.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def rename_enrollment(self, old_name, new_name):
+        """Move a registered name's manifest to a new name (blobs stay put)"""
+        old_dir = os.path.join(self.root, old_name)
+        new_dir = os.path.join(self.root, new_name)
+        if not os.path.isdir(old_dir) or os.path.exists(new_dir):
+            return False
+        os.rename(old_dir, new_dir)
+        return True
+
+    def delete_enrollment(self, name):
+        """
+        Forget a registered name
+
+        Only the manifest goes away; blobs are content-addressed and may be
+        shared, so they are left in place.
+        """
+        path = os.path.join(self.root, name, "manifest.json")
+        if not os.path.exists(path):
+            return False
+        os.remove(path)
+        return True
+
+    def read_object(self, digest):
+        """Bytes of a stored blob, or None"""
+        path = self.object_path(digest) if digest else None
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def enrollment_urls(self, name, size=96):
+        """URLs of the face crop and a thumbnail for a registered name"""
+        manifest = self.get_enrollment(name)
+        if not manifest:
+            return None
+        thumbnail = manifest["thumbnails"].get(str(size))
+        return {
+            "face": self.object_url(manifest["face"]),
+            "thumbnail": self.object_url(thumbnail) if thumbnail else None
+        }
+
+    # ----- thumbnails of existing files (e.g. datasets/) -----
+
+    def is_source_path(self, path):
+        """True if path resolves to a file inside one of the source directories"""
+        resolved = os.path.realpath(path)
+        return any(os.path.commonpath([resolved, d]) == d for d in self.source_dirs)
+
+    def thumbnail_for_file(self, path, size=96):
+        """
+        Digest of a thumbnail for an image file on disk, generated once
+
+        Cached by (path, mtime, size) in _objects/index.json, so the
+        multi-megabyte source is decoded only the first time. Returns None
+        for paths outside the source directories.
+        """
+        if not self.is_source_path(path):
+            return None
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+        key = f"{path}|{mtime}|{size}"
+        digest = self._thumbnail_index.get(key)
+        if digest and os.path.exists(self.object_path(digest)):
+            return digest
+
+        try:
+            with Image.open(path) as image:
+                # JPEG draft mode decodes at reduced scale, much cheaper
+                image.draft("RGB", (size * 2, size * 2))
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail((size, size))
+                digest = self.put_image(image)
+        except Exception as e:
+            logger.warning(f"Could not create thumbnail for {path}: {e}")
+            return None
+
+        with self._lock:
+            self._thumbnail_index[key] = digest
+            tmp_path = self.index_file + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._thumbnail_index, f)
+            os.replace(tmp_path, self.index_file)
+
+        return digest
+
+    def thumbnail_url_for_file(self, path, size=96):
+        digest = self.thumbnail_for_file(path, size)
+        return self.object_url(digest) if digest else None
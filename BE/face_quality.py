@@ -0,0 +1,120 @@
+"""
+Face Quality Gate
+Cheap checks on a face crop that run before the FaceNet forward pass
+"""
+
+import logging
+import threading
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS = {
+    # Variance of the Laplacian on the 160x160 crop; lower means blurry
+    "min_sharpness": 40.0,
+    # Mean gray level of the crop
+    "min_brightness": 50.0,
+    "max_brightness": 210.0,
+    # Share of crushed (<16) or blown out (>240) pixels
+    "max_clipped_fraction": 0.35,
+    # Shorter side of the detector box, in source image pixels
+    "min_face_size": 60,
+    # Detector score (DNN detector only; Haar gives no score)
+    "min_detector_confidence": 0.6
+}
+
+HINTS = {
+    "too_small": "Move closer to the camera",
+    "low_confidence": "Face the camera directly",
+    "blurry": "Hold still for a moment",
+    "too_dark": "Face the light or step out of the backlight",
+    "too_bright": "Step out of direct light"
+}
+
+
+def measure(face_rgb):
+    """
+    Sharpness and exposure metrics for a face crop
+
+    Args:
+        face_rgb: face crop as returned by _extract_face (RGB uint8)
+
+    Returns:
+        dict with sharpness, brightness and clipped_fraction
+    """
+    gray = cv2.cvtColor(face_rgb, cv2.COLOR_RGB2GRAY)
+    histogram = np.bincount(gray.ravel(), minlength=256)
+    total = gray.size
+
+    return {
+        "sharpness": float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+        "brightness": float(histogram @ np.arange(256) / total),
+        "clipped_fraction": float((histogram[:16].sum() + histogram[241:].sum()) / total)
+    }
+
+
+class QualityGate:
+    """
+    Rejects faces that would almost certainly fail recognition
+
+    Every check is a few microseconds on a 160x160 crop, against tens of
+    milliseconds for an embedding, so each rejection is one forward pass
+    saved. Counters show how often that happens per reason.
+    """
+
+    def __init__(self, settings=None, enabled=True):
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.stats = {"checked": 0, "passed": 0, "rejected": {reason: 0 for reason in HINTS}}
+
+    def check(self, face_rgb, box, detector_confidence=None):
+        """
+        Run the checks cheapest first
+
+        Args:
+            face_rgb: face crop (RGB)
+            box: (x, y, w, h) detector box in the source image
+            detector_confidence: detector score, or None if not available
+
+        Returns:
+            (reason, metrics) where reason is None when the face passed
+        """
+        if not self.enabled:
+            return None, {}
+
+        settings = self.settings
+        metrics = {"face_size": int(min(box[2], box[3]))}
+        reason = None
+
+        if metrics["face_size"] < settings["min_face_size"]:
+            reason = "too_small"
+        elif detector_confidence is not None and detector_confidence < settings["min_detector_confidence"]:
+            reason = "low_confidence"
+        else:
+            metrics.update(measure(face_rgb))
+            if metrics["brightness"] < settings["min_brightness"]:
+                reason = "too_dark"
+            elif metrics["brightness"] > settings["max_brightness"]:
+                reason = "too_bright"
+            elif metrics["clipped_fraction"] > settings["max_clipped_fraction"]:
+                reason = "too_dark" if metrics["brightness"] < 128 else "too_bright"
+            elif metrics["sharpness"] < settings["min_sharpness"]:
+                reason = "blurry"
+
+        if detector_confidence is not None:
+            metrics["detector_confidence"] = float(detector_confidence)
+
+        with self._lock:
+            self.stats["checked"] += 1
+            if reason is None:
+                self.stats["passed"] += 1
+            else:
+                self.stats["rejected"][reason] += 1
+        return reason, metrics
+
+    @property
+    def inferences_saved(self):
+        return sum(self.stats["rejected"].values())
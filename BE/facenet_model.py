@@ -10,8 +10,18 @@ import os
 from pathlib import Path
 import logging
 from keras_facenet import FaceNet
-from sklearn.metrics.pairwise import cosine_similarity
 import pickle
+import threading
+from face_gallery import FaceGallery
+from gallery_calibration import calibration_path, load_calibration, mark_stale
+from gallery_compression import compression_path, load_projection
+from gallery_snapshots import GallerySnapshots
+from face_image_store import FaceImageStore
+from face_quality import QualityGate, HINTS
+from face_alignment import load_aligner
+from replay_guard import ReplayGuard
+from image_ingest import ImagePipeline
+from tracing import span
 
 logger = logging.getLogger(__name__)
 
@@ -20,20 +30,33 @@ class FaceNetRecognitionModel:
     """
     Face recognition using FaceNet and OpenCV optimizations
     
-    Three states:
+    Five states:
     - recognized: Face detected and matched to registered user
     - unrecognized: Face detected but not in database
     - undetected: No face found in image
+    - low_quality: Face found but too blurry, dark, small or uncertain to match
+    - spoof_suspected: Looks like a photo of a screen or a re-submitted image
     """
     
-    def __init__(self, db_path='registered_faces'):
+    def __init__(self, db_path='registered_faces', image_store=None, snapshots=None, image_pipeline=None):
         """Initialize FaceNet model and OpenCV face detector"""
         self.db_path = db_path
         self.embeddings_file = 'face_embeddings_facenet.pkl'
         self.recognition_threshold = 0.45  # Cosine similarity threshold (lowered for mobile camera variance)
+        self.calibration_file = calibration_path(self.embeddings_file)
+        self.calibration = None  # per-identity thresholds, see gallery_calibration.py
+        self.compression_file = compression_path(self.embeddings_file)
+        self.compression_enabled = os.environ.get('GALLERY_COMPRESSION', '1') != '0'
+        self.compression = None  # PCA / quantized scan for large galleries, see gallery_compression.py
+        self._offline_mtimes = {}  # offline job output file -> mtime last applied
+        self.quality_gate = QualityGate(enabled=os.environ.get('FACE_QUALITY_GATE', '1') != '0')
+        self.replay_guard = ReplayGuard(enabled=os.environ.get('REPLAY_GUARD', '1') != '0')
         
         # Create database directory if it doesn't exist
         Path(self.db_path).mkdir(parents=True, exist_ok=True)
+        self.image_store = image_store or FaceImageStore(self.db_path)
+        # Stored originals are decoded exactly like uploads (EXIF orientation included)
+        self.image_pipeline = image_pipeline or ImagePipeline()
         
         logger.info("Initializing FaceNet model...")
         # Initialize FaceNet
@@ -87,23 +110,41 @@ class FaceNetRecognitionModel:
             self.detector_type = 'haar'
             logger.info("✅ Using Haar Cascade detector (fallback)")
         
+        # Optional landmark alignment (see face_alignment.py). Off by default:
+        # the gallery has to be re-enrolled with the same setting.
+        self.aligner = load_aligner() if os.environ.get('FACE_ALIGNMENT') == '1' else None
+        
         # Load registered face embeddings
         self.face_embeddings = {}
+        self.shard_members = {}  # shard name -> set of names (see set_shards)
+        self.user_ids = {}  # name -> integer user ID (see set_shards)
+        self.shard_stats = {'shard_hits': 0, 'global_fallbacks': 0}
+        self.gallery = FaceGallery({})
+        self.gallery_version = 0  # bumped whenever the gallery is rebuilt
+        self.snapshots = snapshots or GallerySnapshots()
+        self.snapshot_version = None  # snapshot the live gallery was loaded from
+        self.snapshot_journal = 0  # edits applied on top of that snapshot
+        self.compact_after = 64  # journal edits before a full snapshot is written
+        self._snapshot_lock = threading.Lock()
+        # cv2.dnn.Net keeps its input blob and outputs on the object, so
+        # concurrent recognize calls take turns on the detector
+        self._detector_lock = threading.Lock()
         self._load_embeddings()
         
         logger.info(f"Database path: {self.db_path}")
         logger.info(f"Loaded {len(self.face_embeddings)} registered faces")
     
     def _detect_faces_dnn(self, image):
-        """Detect faces using OpenCV DNN"""
+        """Detect faces using OpenCV DNN, returns (box, confidence) pairs"""
         h, w = image.shape[:2]
         
         # Prepare blob
         blob = cv2.dnn.blobFromImage(image, 1.0, (300, 300), 
                                      (104.0, 177.0, 123.0), False, False)
         
-        self.face_detector.setInput(blob)
-        detections = self.face_detector.forward()
+        with self._detector_lock:
+            self.face_detector.setInput(blob)
+            detections = self.face_detector.forward()
         
         faces = []
         for i in range(detections.shape[2]):
@@ -118,30 +159,40 @@ class FaceNetRecognitionModel:
                 x1, y1 = max(0, x1), max(0, y1)
                 x2, y2 = min(w, x2), min(h, y2)
                 
-                faces.append((x1, y1, x2 - x1, y2 - y1))
+                faces.append(((x1, y1, x2 - x1, y2 - y1), float(confidence)))
         
         return faces
     
     def _detect_faces_haar(self, image):
         """Detect faces using Haar Cascade"""
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        faces = self.face_detector.detectMultiScale(
-            gray,
-            scaleFactor=1.1,
-            minNeighbors=5,
-            minSize=(30, 30)
-        )
+        with self._detector_lock:
+            faces = self.face_detector.detectMultiScale(
+                gray,
+                scaleFactor=1.1,
+                minNeighbors=5,
+                minSize=(30, 30)
+            )
         return faces
     
-    def detect_faces(self, image):
-        """Detect faces in image using configured detector"""
+    def detect_faces_scored(self, image):
+        """Detect faces as (box, confidence) pairs; confidence is None for Haar"""
         if self.detector_type == 'dnn':
             return self._detect_faces_dnn(image)
         else:
-            return self._detect_faces_haar(image)
+            return [(tuple(box), None) for box in self._detect_faces_haar(image)]
+    
+    def detect_faces(self, image):
+        """Detect faces in image using configured detector"""
+        return [box for box, _ in self.detect_faces_scored(image)]
     
     def _extract_face(self, image, box, target_size=(160, 160)):
-        """Extract and preprocess face from image"""
+        """Extract and preprocess face from image (aligned when enabled)"""
+        if self.aligner is not None:
+            face = self.aligner.align(image, box)
+            if face is not None:
+                return face
+        
         x, y, w, h = box
         
         # Add padding
@@ -167,13 +218,101 @@ class FaceNetRecognitionModel:
     
     def _get_embedding(self, face):
         """Get FaceNet embedding for a face"""
-        # FaceNet expects batch input
-        face_batch = np.expand_dims(face, axis=0)
-        embedding = self.facenet.embeddings(face_batch)
-        return embedding[0]
+        return self._get_embeddings([face])[0]
+    
+    def _get_embeddings(self, faces):
+        """Get FaceNet embeddings for several faces in one forward pass"""
+        face_batch = np.stack(faces)
+        return self.facenet.embeddings(face_batch)
+    
+    def _refresh_gallery(self):
+        """Rebuild the matching matrix after embeddings change"""
+        self.gallery = FaceGallery(
+            self.face_embeddings, self.shard_members, self.calibration, self.user_ids, self.compression
+        )
+        self.gallery_version += 1
+    
+    def set_shards(self, shard_members, user_ids=None):
+        """
+        Define named gallery shards (e.g. per cohort or per kiosk building)
+        
+        Args:
+            shard_members: dict mapping shard name -> iterable of names
+            user_ids: optional dict mapping name -> integer user ID, returned
+                      by recognize so punches can be keyed by ID
+        """
+        self.shard_members = {shard: set(names) for shard, names in shard_members.items()}
+        if user_ids is not None:
+            self.user_ids = dict(user_ids)
+        self._refresh_gallery()
+        logger.info(f"Configured {len(self.gallery.shards)} gallery shards")
+    
+    def reload_calibration(self):
+        """
+        Re-read the offline calibration file and publish it with the gallery
+        
+        The snapshot's copy is what every process serves (and what relabels
+        are journaled against), so a calibration file newer than the one in
+        the current snapshot goes out as a new snapshot instead of being
+        applied to this process only.
+        
+        Returns:
+            True if a new calibration was applied
+        """
+        calibration = load_calibration(self.calibration_file)
+        if calibration is None:
+            return False
+        with self._snapshot_lock:
+            if calibration.get('created') == (self.calibration or {}).get('created'):
+                return False
+            self.calibration = calibration
+            if self.face_embeddings or self.snapshot_version is not None:
+                self.snapshot_version = self.snapshots.publish(
+                    self.face_embeddings, calibration, note='calibration updated'
+                )
+                self.snapshot_journal = 0
+            self._refresh_gallery()
+        logger.info(f"Loaded calibration for {len(calibration.get('thresholds', {}))} identities")
+        return True
+    
+    def reload_compression(self):
+        """Re-read the offline PCA projection and rebuild the compact gallery scan"""
+        self.compression = load_projection(self.compression_file) if self.compression_enabled else None
+        if self.compression:
+            logger.info(f"Loaded {self.compression['components']}-d {self.compression['storage']} gallery projection")
+        self._refresh_gallery()
+    
+    def sync_offline_files(self):
+        """
+        Apply calibration / projection files rewritten by the offline jobs
+        
+        Checked at startup and with every snapshot check, so re-running
+        gallery_calibration.py or gallery_compression.py takes effect
+        without a restart.
+        
+        Returns:
+            True if either file changed
+        """
+        changed = False
+        for path, reload in ((self.calibration_file, self.reload_calibration),
+                             (self.compression_file, self.reload_compression)):
+            mtime = os.path.getmtime(path) if os.path.exists(path) else None
+            if mtime != self._offline_mtimes.get(path):
+                self._offline_mtimes[path] = mtime
+                reload()
+                changed = True
+        return changed
     
     def _load_embeddings(self):
-        """Load saved face embeddings"""
+        """Load the current gallery snapshot, or import the legacy pickle"""
+        try:
+            if self.snapshots.current_version() is not None:
+                self.reload_gallery()
+                self.sync_offline_files()
+                return
+        except Exception as e:
+            logger.error(f"Error loading gallery snapshot, falling back to {self.embeddings_file}: {e}")
+        
         if os.path.exists(self.embeddings_file):
             try:
                 with open(self.embeddings_file, 'rb') as f:
@@ -184,28 +323,253 @@ class FaceNetRecognitionModel:
                 self.face_embeddings = {}
         else:
             self.face_embeddings = {}
+        if self.face_embeddings:
+            self.snapshot_version = self.snapshots.publish(
+                self.face_embeddings, load_calibration(self.calibration_file),
+                note=f'imported from {self.embeddings_file}'
+            )
+            self.reload_gallery(self.snapshot_version)
+        self.sync_offline_files()
+    
+    def reload_gallery(self, version=None):
+        """
+        Load a snapshot (the current one by default) and swap it in
+        
+        The new gallery matrix is built off to the side and published with
+        a single attribute assignment, so in-flight recognize calls finish
+        on the gallery they started with and never wait for the reload.
+        
+        Returns:
+            the version now being served
+        """
+        with self._snapshot_lock:
+            version, embeddings, calibration = self.snapshots.load(version)
+            if version is None:
+                return self.snapshot_version
+            gallery = FaceGallery(embeddings, self.shard_members, calibration, self.user_ids, self.compression)
+            
+            self.face_embeddings = embeddings
+            self.calibration = calibration
+            self.gallery = gallery
+            self.gallery_version += 1
+            self.snapshot_version = version
+            self.snapshot_journal = self.snapshots.journal_length(version)
+        logger.info(f"Serving gallery snapshot v{version} ({len(embeddings)} faces)")
+        return version
+    
+    def check_for_snapshot(self):
+        """
+        Reload if another process published, edited or rolled back a
+        snapshot, or an offline job rewrote the calibration / projection
+        """
+        reloaded = False
+        current = self.snapshots.current_version()
+        if current is not None and (
+            current != self.snapshot_version or self.snapshots.journal_length(current) != self.snapshot_journal
+        ):
+            self.reload_gallery(current)
+            reloaded = True
+        return self.sync_offline_files() or reloaded
     
-    def _save_embeddings(self):
-        """Save face embeddings to disk"""
+    def rollback_gallery(self, version):
+        """Make an older snapshot current and serve it immediately"""
+        self.snapshots.set_current(version)
+        return self.reload_gallery(version)
+    
+    def _save_embeddings(self, note=None):
+        """Save face embeddings to disk and publish them as a new snapshot"""
         try:
             with open(self.embeddings_file, 'wb') as f:
                 pickle.dump(self.face_embeddings, f)
             logger.info(f"Saved {len(self.face_embeddings)} embeddings to {self.embeddings_file}")
         except Exception as e:
             logger.error(f"Error saving embeddings: {e}")
+        self.snapshot_version = self.snapshots.publish(self.face_embeddings, self.calibration, note=note)
+        self.snapshot_journal = 0
+    
+    def _journal_edit(self, op, embeddings, gallery):
+        """Record one edit in the snapshot journal, then swap in the results"""
+        if self.snapshot_version is None:
+            self.snapshot_version = self.snapshots.publish(self.face_embeddings, self.calibration)
+        self.snapshot_journal = self.snapshots.append_journal(self.snapshot_version, op)
+        self.face_embeddings = embeddings
+        self.gallery = gallery
+        self.gallery_version += 1
+    
+    def delete_identity(self, name):
+        """
+        Remove a registered identity
+        
+        The gallery row becomes a tombstone and one line is appended to the
+        snapshot journal; neither the matrix nor the snapshot is rewritten.
+        
+        Returns:
+            True if the name was registered
+        """
+        with self._snapshot_lock:
+            if name not in self.face_embeddings:
+                return False
+            embeddings = dict(self.face_embeddings)
+            del embeddings[name]
+            self.calibration = mark_stale(self.calibration)
+            if self.calibration and name in self.calibration.get('thresholds', {}):
+                thresholds = dict(self.calibration['thresholds'])
+                del thresholds[name]
+                self.calibration = {**self.calibration, 'thresholds': thresholds}
+            self._journal_edit({'op': 'delete', 'name': name}, embeddings,
+                               self.gallery.with_changes(deleted=[name]))
+        logger.info(f"Deleted face for {name}")
+        return True
+    
+    def relabel_identity(self, old_name, new_name):
+        """
+        Give a registered identity a new name, keeping its embedding
+        
+        Its calibrated threshold moves with it. The journal op renames the
+        threshold too when other processes reload the snapshot, and the next
+        published snapshot stores the calibration under the new name.
+        
+        Returns:
+            True if old_name was registered
+            
+        Raises:
+            ValueError: new_name is already registered
+        """
+        with self._snapshot_lock:
+            if old_name not in self.face_embeddings:
+                return False
+            if new_name in self.face_embeddings:
+                raise ValueError(f"{new_name} is already registered")
+            embeddings = dict(self.face_embeddings)
+            embeddings[new_name] = embeddings.pop(old_name)
+            
+            self.calibration = mark_stale(self.calibration)
+            if self.calibration and old_name in self.calibration.get('thresholds', {}):
+                thresholds = dict(self.calibration['thresholds'])
+                thresholds[new_name] = thresholds.pop(old_name)
+                self.calibration = {**self.calibration, 'thresholds': thresholds}
+            # The new name keeps its own user ID when it has one (relabel
+            # onto an existing user), otherwise inherits the old name's
+            if old_name in self.user_ids or new_name in self.user_ids:
+                self.user_ids = dict(self.user_ids)
+                old_id = self.user_ids.pop(old_name, None)
+                if new_name not in self.user_ids:
+                    self.user_ids[new_name] = old_id
+            self.shard_members = {
+                shard: {new_name if n == old_name else n for n in names}
+                for shard, names in self.shard_members.items()
+            }
+            
+            self._journal_edit({'op': 'relabel', 'old': old_name, 'new': new_name}, embeddings,
+                               self.gallery.with_changes(renamed={old_name: new_name}, user_ids=self.user_ids))
+        logger.info(f"Relabeled face {old_name} -> {new_name}")
+        return True
+    
+    @property
+    def needs_compaction(self):
+        """Journal or tombstones have grown enough to rewrite the snapshot"""
+        gallery = self.gallery
+        return (self.snapshot_journal >= self.compact_after
+                or gallery.tombstones > max(16, len(gallery) // 10))
+    
+    def compact_gallery(self, job=None):
+        """Publish a snapshot with the journal applied and drop tombstones"""
+        with self._snapshot_lock:
+            before = self.gallery.tombstones
+            self._save_embeddings(note='compaction')
+            self._refresh_gallery()
+        return {'version': self.snapshot_version, 'tombstones_removed': before}
+    
+    def _enrollment_face(self, name):
+        """Face crop for re-embedding, from the stored original or crop"""
+        manifest = self.image_store.get_enrollment(name)
+        if not manifest:
+            return None
+        
+        original = self.image_store.read_object(manifest.get('original'))
+        if original is not None:
+            try:
+                image = self.image_pipeline.ingest_bytes(original).bgr
+            except Exception as e:
+                logger.warning(f"Stored original of {name} could not be decoded: {e}")
+                image = None
+            if image is not None:
+                faces = self.detect_faces(image)
+                if len(faces) > 0:
+                    box = max(faces, key=lambda b: b[2] * b[3])
+                    face = self._extract_face(image, box)
+                    if face is not None:
+                        return face
+        
+        crop = self.image_store.read_object(manifest.get('face'))
+        if crop is None:
+            return None
+        face = cv2.imdecode(np.frombuffer(crop, np.uint8), cv2.IMREAD_COLOR)
+        if face is None:
+            return None
+        return cv2.cvtColor(cv2.resize(face, (160, 160)), cv2.COLOR_BGR2RGB)
+    
+    def reembed_all(self, job=None, batch_size=32):
+        """
+        Recompute every template from the stored enrollment images
+        
+        Meant for a FaceNet or preprocessing upgrade. Faces are embedded in
+        batches while the old gallery keeps serving; the new embeddings are
+        published as one snapshot at the end, since old and new templates
+        can't be compared with each other. Identities without stored images
+        keep their current embedding.
+        
+        Args:
+            job: optional gallery_maintenance.Job for progress reporting
+            batch_size: faces per FaceNet forward pass
+        """
+        names = list(self.face_embeddings.keys())
+        if job is not None:
+            job.progress(0, len(names))
+        
+        updated = {}
+        skipped = []
+        for start in range(0, len(names), batch_size):
+            batch = []
+            for name in names[start:start + batch_size]:
+                face = self._enrollment_face(name)
+                if face is None:
+                    skipped.append(name)
+                else:
+                    batch.append((name, face))
+            if batch:
+                embeddings = self._get_embeddings([face for _, face in batch])
+                for (name, _), embedding in zip(batch, embeddings):
+                    updated[name] = embedding
+            if job is not None:
+                job.progress(min(start + batch_size, len(names)))
+        
+        with self._snapshot_lock:
+            # Identities deleted or relabeled while we worked keep that change
+            self.face_embeddings = {
+                name: updated.get(name, embedding) for name, embedding in self.face_embeddings.items()
+            }
+            self.calibration = mark_stale(self.calibration)
+            self._save_embeddings(note='re-embed')
+            self._refresh_gallery()
+        
+        logger.info(f"Re-embedded {len(updated)} faces ({len(skipped)} without stored images)")
+        return {'version': self.snapshot_version, 'reembedded': len(updated), 'skipped': skipped}
     
     @property
     def registered_faces(self):
         """Get dictionary of registered faces (for compatibility)"""
         return {name: True for name in self.face_embeddings.keys()}
     
-    def register_face(self, image, name):
+    def register_face(self, image, name, original_bytes=None):
         """
         Register a new face
         
         Args:
             image: numpy array (BGR format from cv2)
             name: str, person's name
+            original_bytes: optional uploaded file bytes, kept as the
+                            content-addressed original
             
         Returns:
             dict with status and message
@@ -239,15 +603,20 @@ class FaceNetRecognitionModel:
             # Get embedding
             embedding = self._get_embedding(face)
             
-            # Save embedding
-            self.face_embeddings[name] = embedding
-            self._save_embeddings()
+            # Save embedding (copy-on-write: readers keep the old dict)
+            with self._snapshot_lock:
+                embeddings = dict(self.face_embeddings)
+                embeddings[name] = embedding
+                self.face_embeddings = embeddings
+                self.calibration = mark_stale(self.calibration)
+                self._save_embeddings(note=f'register {name}')
+                self._refresh_gallery()
             
-            # Also save image for reference
-            user_dir = os.path.join(self.db_path, name)
-            Path(user_dir).mkdir(parents=True, exist_ok=True)
-            img_path = os.path.join(user_dir, f"{name}_1.jpg")
-            cv2.imwrite(img_path, image)
+            # Keep the face crop, thumbnails and the untouched original
+            if original_bytes is None:
+                _, encoded = cv2.imencode('.jpg', image)
+                original_bytes = encoded.tobytes()
+            self.image_store.save_enrollment(name, face, original_bytes)
             
             logger.info(f"Registered face for {name}")
             return {
@@ -262,20 +631,29 @@ class FaceNetRecognitionModel:
                 'message': f'Error: {str(e)}'
             }
     
-    def recognize(self, image):
+    def recognize(self, image, shard=None):
         """
         Recognize face in image
         
         Args:
             image: numpy array (BGR format from cv2)
+            shard: optional shard hint; the shard is searched first and the
+                   whole gallery only if no shard member meets the threshold
+            
+        The best match has to pass its identity's calibrated threshold and
+        beat the runner-up by the calibrated margin. Matches failing only
+        the margin come back unrecognized with reason 'ambiguous'.
             
         Returns:
-            dict with status, message, name, and confidence
-            - status: 'recognized', 'unrecognized', or 'undetected'
+            dict with status, message, name, user_id (integer ID of the
+            matched user, if linked) and confidence
+            - status: 'recognized', 'unrecognized', 'low_quality' (message
+              holds a hint for the user), 'spoof_suspected', or 'undetected'
         """
         try:
             # Detect faces
-            faces = self.detect_faces(image)
+            with span("model.detect"):
+                faces = self.detect_faces_scored(image)
             
             if len(faces) == 0:
                 return {
@@ -286,15 +664,12 @@ class FaceNetRecognitionModel:
                     'face_detected': False
                 }
             
-            # Use the first/largest face
-            if len(faces) > 1:
-                # Get largest face
-                faces = sorted(faces, key=lambda x: x[2] * x[3], reverse=True)
-            
-            face_box = faces[0]
+            # Use the largest face
+            face_box, detector_confidence = max(faces, key=lambda f: f[0][2] * f[0][3])
             
             # Extract face
-            face = self._extract_face(image, face_box)
+            with span("model.extract"):
+                face = self._extract_face(image, face_box)
             
             if face is None:
                 return {
@@ -305,11 +680,33 @@ class FaceNetRecognitionModel:
                     'face_detected': False
                 }
             
+            # Skip the forward pass for faces that can't match anyway
+            with span("model.quality"):
+                reason, quality = self.quality_gate.check(face, face_box, detector_confidence)
+            if reason is not None:
+                return {
+                    'status': 'low_quality',
+                    'message': HINTS[reason],
+                    'name': None,
+                    'confidence': 0.0,
+                    'face_detected': True,
+                    'reason': reason,
+                    'quality': quality
+                }
+            
+            # Screen recaptures are also caught before spending an embedding
+            with span("model.screen_check"):
+                spoof, _ = self.replay_guard.check_screen(face)
+            if spoof is not None:
+                return self._spoof_result(spoof)
+            
             # Get embedding
-            embedding = self._get_embedding(face)
+            with span("model.embed"):
+                embedding = self._get_embedding(face)
             
             # Check if database has any faces
-            if len(self.face_embeddings) == 0:
+            gallery = self.gallery
+            if len(gallery) == 0:
                 return {
                     'status': 'unrecognized',
                     'message': 'Face not recognized',
@@ -318,27 +715,33 @@ class FaceNetRecognitionModel:
                     'face_detected': True
                 }
             
-            # Compare with all registered faces
-            best_match_name = None
-            best_similarity = -1
-            
-            for name, stored_embedding in self.face_embeddings.items():
-                # Calculate cosine similarity
-                similarity = cosine_similarity(
-                    embedding.reshape(1, -1),
-                    stored_embedding.reshape(1, -1)
-                )[0][0]
+            # Compare with the hinted shard first, then the whole gallery
+            decision = 'below_threshold'
+            with span("model.match"):
+                if shard is not None and gallery.has_shard(shard):
+                    best_match_name, best_similarity, second = gallery.best_two(embedding, shard)
+                    decision = gallery.decide(best_match_name, best_similarity, second, self.recognition_threshold)
+                    if decision == 'recognized':
+                        self.shard_stats['shard_hits'] += 1
+                    else:
+                        self.shard_stats['global_fallbacks'] += 1
                 
-                if similarity > best_similarity:
-                    best_similarity = similarity
-                    best_match_name = name
+                if decision != 'recognized':
+                    best_match_name, best_similarity, second = gallery.best_two(embedding)
+                    decision = gallery.decide(best_match_name, best_similarity, second, self.recognition_threshold)
             
-            # Check if best match meets threshold
-            if best_similarity >= self.recognition_threshold:
+            # Check if best match meets its threshold and margin
+            if decision == 'recognized':
+                with span("model.replay_check"):
+                    spoof = self.replay_guard.check_replay(best_match_name, embedding, face)
+                if spoof is not None:
+                    return self._spoof_result(spoof, best_similarity)
+                
                 return {
                     'status': 'recognized',
                     'message': f'Welcome, {best_match_name}!',
                     'name': best_match_name,
+                    'user_id': gallery.user_id_of(best_match_name),
                     'confidence': float(best_similarity),
                     'face_detected': True
                 }
@@ -348,7 +751,8 @@ class FaceNetRecognitionModel:
                     'message': 'Face not recognized',
                     'name': None,
                     'confidence': float(best_similarity),
-                    'face_detected': True
+                    'face_detected': True,
+                    'reason': decision
                 }
                 
         except Exception as e:
@@ -360,3 +764,154 @@ class FaceNetRecognitionModel:
                 'confidence': 0.0,
                 'face_detected': False
             }
+    
+    def _spoof_result(self, reason, confidence=0.0):
+        """Response for a face flagged by the replay guard"""
+        return {
+            'status': 'spoof_suspected',
+            'message': 'Please look at the camera in person',
+            'name': None,
+            'confidence': float(confidence),
+            'face_detected': True,
+            'reason': reason
+        }
+    
+    def recognize_all(self, image, shard=None):
+        """
+        Recognize every face in an image (group photo / classroom mode)
+        
+        All detected faces are embedded in one FaceNet batch and matched
+        against the gallery in one matrix operation, with each registered
+        identity assigned to at most one face. A face too close to two
+        identities (the calibrated margin) stays unrecognized, and every face
+        goes through the same screen and replay checks as recognize(), so a
+        photo sent here can't record a punch the single-face path would
+        refuse.
+        
+        Args:
+            image: numpy array (BGR format from cv2)
+            shard: optional shard hint, matched before the whole gallery
+            
+        Returns:
+            dict with overall status, message, and a 'faces' list where each
+            entry has box, status, name and confidence
+            - status: 'recognized' if at least one face matched,
+              'spoof_suspected' if none matched and at least one face was
+              flagged by the replay guard,
+              'unrecognized' if faces were found but none matched,
+              'low_quality' if every face failed the quality gate,
+              'undetected' if no usable face was found
+        """
+        try:
+            with span("model.detect"):
+                faces = self.detect_faces_scored(image)
+            
+            crops = []
+            boxes = []
+            rejected = []
+            for box, detector_confidence in faces:
+                face = self._extract_face(image, box)
+                if face is None:
+                    continue
+                reason, _ = self.quality_gate.check(face, box, detector_confidence)
+                if reason is not None:
+                    rejected.append({
+                        'box': [int(v) for v in box],
+                        'status': 'low_quality',
+                        'name': None,
+                        'confidence': 0.0,
+                        'reason': reason
+                    })
+                    continue
+                spoof, _ = self.replay_guard.check_screen(face)
+                if spoof is not None:
+                    rejected.append({
+                        'box': [int(v) for v in box],
+                        'status': 'spoof_suspected',
+                        'name': None,
+                        'confidence': 0.0,
+                        'reason': spoof
+                    })
+                    continue
+                crops.append(face)
+                boxes.append([int(v) for v in box])
+            
+            if len(crops) == 0 and any(r['status'] == 'spoof_suspected' for r in rejected):
+                return {
+                    'status': 'spoof_suspected',
+                    'message': 'Please look at the camera in person',
+                    'faces': rejected,
+                    'face_count': len(rejected),
+                    'recognized_count': 0
+                }
+            
+            if len(crops) == 0 and rejected:
+                return {
+                    'status': 'low_quality',
+                    'message': HINTS[rejected[0]['reason']],
+                    'faces': rejected,
+                    'face_count': len(rejected),
+                    'recognized_count': 0
+                }
+            
+            if len(crops) == 0:
+                return {
+                    'status': 'undetected',
+                    'message': 'No face detected in image',
+                    'faces': [],
+                    'face_count': 0,
+                    'recognized_count': 0
+                }
+            
+            gallery = self.gallery
+            with span("model.embed", faces=len(crops)):
+                embeddings = self._get_embeddings(crops)
+            with span("model.match", faces=len(crops)):
+                matches = gallery.assign(embeddings, self.recognition_threshold, shard)
+            
+            results = []
+            for box, face, embedding, (name, similarity) in zip(boxes, crops, embeddings, matches):
+                spoof = self.replay_guard.check_replay(name, embedding, face) if name else None
+                if spoof is not None:
+                    results.append({
+                        'box': box,
+                        'status': 'spoof_suspected',
+                        'name': None,
+                        'confidence': similarity,
+                        'reason': spoof
+                    })
+                    continue
+                results.append({
+                    'box': box,
+                    'status': 'recognized' if name else 'unrecognized',
+                    'name': name,
+                    'user_id': gallery.user_id_of(name) if name else None,
+                    'confidence': similarity
+                })
+            results.extend(rejected)
+            
+            recognized_count = sum(1 for r in results if r['name'])
+            if recognized_count:
+                status = 'recognized'
+            elif any(r['status'] == 'spoof_suspected' for r in results):
+                status = 'spoof_suspected'
+            else:
+                status = 'unrecognized'
+            return {
+                'status': status,
+                'message': (f'Recognized {recognized_count} of {len(results)} faces' if status != 'spoof_suspected'
+                            else 'Please look at the camera in person'),
+                'faces': results,
+                'face_count': len(results),
+                'recognized_count': recognized_count
+            }
+            
+        except Exception as e:
+            logger.error(f"Error recognizing faces: {str(e)}")
+            return {
+                'status': 'undetected',
+                'message': 'Error processing image',
+                'faces': [],
+                'face_count': 0,
+                'recognized_count': 0
+            }
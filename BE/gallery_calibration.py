@@ -0,0 +1,153 @@
+"""
+Gallery Calibration
+Offline job deriving per-identity thresholds and a margin test from the gallery
+
+Fit on the current gallery snapshot (journal included) unless a pickle
+is given explicitly.
+
+Usage:
+    python gallery_calibration.py [embeddings.pkl]
+"""
+
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+
+from face_gallery import normalize_rows
+from gallery_snapshots import EMBEDDINGS_FILE, load_offline_gallery
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS = {
+    # Threshold used for identities without calibration
+    "base_threshold": 0.45,
+    # An identity's threshold sits this far above its closest impostor...
+    "impostor_gap": 0.05,
+    # ...but never outside these bounds (and never below base_threshold)
+    "min_threshold": 0.45,
+    "max_threshold": 0.75,
+    # Best match must beat the runner-up by this much to be accepted
+    "min_margin": 0.04
+}
+
+
+def calibration_path(embeddings_file):
+    """Calibration is stored next to the embeddings it was computed from"""
+    return os.path.splitext(embeddings_file)[0] + ".calibration.json"
+
+
+def calibrate(face_embeddings, settings=None):
+    """
+    Compute per-identity thresholds from pairwise gallery similarity
+
+    All pairwise cosine similarities come from one matrix product. Each
+    identity's threshold is placed just above its most similar other
+    identity (its closest impostor), so look-alikes need a higher score.
+    Thresholds never drop below the base threshold: a well-separated
+    identity keeps the global default.
+
+    Args:
+        face_embeddings: dict mapping name -> embedding
+        settings: overrides for DEFAULT_SETTINGS
+
+    Returns:
+        calibration dict (JSON serializable)
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    names = list(face_embeddings.keys())
+
+    calibration = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "settings": settings,
+        "min_margin": settings["min_margin"],
+        "thresholds": {},
+        "nearest_impostor": {},
+        "stats": {"identities": len(names)}
+    }
+    if len(names) < 2:
+        return calibration
+
+    matrix = normalize_rows(np.stack([np.asarray(face_embeddings[n]).ravel() for n in names]))
+    similarities = matrix @ matrix.T
+    np.fill_diagonal(similarities, -1.0)
+
+    nearest = similarities.argmax(axis=1)
+    nearest_score = similarities[np.arange(len(names)), nearest]
+    thresholds = np.clip(
+        nearest_score + settings["impostor_gap"],
+        max(settings["min_threshold"], settings["base_threshold"]),
+        settings["max_threshold"]
+    )
+
+    off_diagonal = similarities[~np.eye(len(names), dtype=bool)]
+    calibration["thresholds"] = {n: round(float(t), 4) for n, t in zip(names, thresholds)}
+    calibration["nearest_impostor"] = {
+        n: {"name": names[j], "similarity": round(float(score), 4)}
+        for n, j, score in zip(names, nearest, nearest_score)
+    }
+    calibration["stats"].update({
+        "impostor_mean": round(float(off_diagonal.mean()), 4),
+        "impostor_std": round(float(off_diagonal.std()), 4),
+        "impostor_max": round(float(off_diagonal.max()), 4),
+        "above_base_threshold": int((thresholds > settings["base_threshold"]).sum())
+    })
+    return calibration
+
+
+def mark_stale(calibration):
+    """
+    Copy of a calibration flagged as computed from an earlier gallery
+
+    Registering, deleting, relabeling or re-embedding identities moves the
+    nearest impostors the thresholds were derived from. The flag and the
+    change count stay until this job is run again.
+    """
+    if not calibration:
+        return calibration
+    return {**calibration, "stale": True, "changes_since": calibration.get("changes_since", 0) + 1}
+
+
+def load_calibration(path):
+    """Load a calibration file, or None if missing or unreadable"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Error loading calibration: {e}")
+        return None
+
+
+def save_calibration(calibration, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(calibration, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def main():
+    embeddings_file = sys.argv[1] if len(sys.argv) > 1 else None
+    try:
+        face_embeddings = load_offline_gallery(embeddings_file)
+    except FileNotFoundError as e:
+        print(f"Gallery not found: {e}")
+        sys.exit(1)
+
+    calibration = calibrate(face_embeddings)
+    path = calibration_path(embeddings_file or EMBEDDINGS_FILE)
+    save_calibration(calibration, path)
+
+    stats = calibration["stats"]
+    print(f"Calibrated {stats['identities']} identities -> {path}")
+    if stats["identities"] >= 2:
+        print(f"  impostor similarity: mean {stats['impostor_mean']}, max {stats['impostor_max']}")
+        print(f"  thresholds above base: {stats['above_base_threshold']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Gallery Compression
+PCA projection and scalar-quantized storage for the gallery scan
+
+Offline, a PCA projection is fit on the gallery and saved next to the
+embeddings (face_embeddings_facenet.pca.npz). Online, FaceGallery keeps a
+compact copy of its matrix, projected to `components` dimensions and stored
+as float16 or int8, and scans it block by block to shortlist the top
+candidates. Those few are re-scored against the full-precision 512-d rows,
+so the score used for the decision is still exact.
+
+A 512-d float32 row is 2 KB; at 128-d int8 it is 132 bytes including its
+scale, so a 100k-identity scan reads about 13 MB instead of 205 MB.
+
+Fit on the current gallery snapshot (journal included) unless a pickle
+is given explicitly; pass '-' to use the snapshot with later arguments.
+
+Usage:
+    python gallery_compression.py [embeddings.pkl|-] [components] [float32|float16|int8]
+"""
+
+import logging
+import os
+import sys
+
+import numpy as np
+
+from gallery_snapshots import EMBEDDINGS_FILE, load_offline_gallery
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SETTINGS = {
+    # Dimensions kept by the projection (capped by the number of samples)
+    "components": 128,
+    # How the projected rows are stored: float32, float16 or int8
+    "storage": "int8",
+    # Shortlisted candidates re-scored in full precision
+    "rescore_top_k": 8,
+    # Rows dequantized per block; keeps the float32 scratch in cache
+    "block_rows": 4096,
+    # Smaller galleries are scanned exactly; the compact path doesn't pay off
+    "min_gallery": 2048
+}
+
+STORAGE_TYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+def _unit_rows(rows):
+    """L2-normalize rows (face_gallery imports this module, so no import back)"""
+    rows = np.asarray(rows, dtype=np.float32)
+    if rows.ndim == 1:
+        rows = rows.reshape(1, -1)
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return rows / norms
+
+
+def compression_path(embeddings_file):
+    """Projection is stored next to the embeddings it was fit on"""
+    return os.path.splitext(embeddings_file)[0] + ".pca.npz"
+
+
+def fit_projection(samples, settings=None):
+    """
+    Fit a PCA projection on gallery embeddings
+
+    Args:
+        samples: array (n, d) or dict name -> embedding
+        settings: overrides for DEFAULT_SETTINGS
+
+    Returns:
+        projection dict (mean, components, explained variance + settings)
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    if settings["storage"] not in STORAGE_TYPES:
+        raise ValueError(f"Unknown storage type: {settings['storage']}")
+    if isinstance(samples, dict):
+        samples = np.stack([np.asarray(v).ravel() for v in samples.values()])
+    samples = _unit_rows(samples)
+    if samples.shape[0] < 2:
+        raise ValueError("Need at least two embeddings to fit a projection")
+
+    mean = samples.mean(axis=0)
+    _, singular, vt = np.linalg.svd(samples - mean, full_matrices=False)
+    components = min(settings["components"], samples.shape[0] - 1, samples.shape[1])
+    variance = singular ** 2
+
+    return {
+        **settings,
+        "components": components,
+        "mean": mean.astype(np.float32),
+        "basis": vt[:components].astype(np.float32),
+        "explained_variance": float(variance[:components].sum() / variance.sum()),
+        "samples": int(samples.shape[0])
+    }
+
+
+def save_projection(projection, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **{k: np.asarray(v) for k, v in projection.items()})
+    os.replace(tmp_path, path)
+
+
+def load_projection(path):
+    """Projection dict, or None if there is no (readable) file"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            projection = {k: data[k] for k in data.files}
+    except Exception as e:
+        logger.error(f"Error loading gallery projection: {e}")
+        return None
+    for key in ("components", "rescore_top_k", "block_rows", "min_gallery", "samples"):
+        projection[key] = int(projection[key])
+    projection["storage"] = str(projection["storage"])
+    projection["explained_variance"] = float(projection["explained_variance"])
+    return projection
+
+
+class CompactMatrix:
+    """Projected, quantized copy of a normalized gallery matrix"""
+
+    def __init__(self, matrix, projection):
+        """
+        Args:
+            matrix: L2-normalized gallery rows (n, d) float32
+            projection: output of fit_projection / load_projection
+        """
+        self.mean = projection["mean"]
+        self.basis = projection["basis"]
+        self.storage = projection["storage"]
+        self.block_rows = projection["block_rows"]
+        self.rescore_top_k = projection["rescore_top_k"]
+
+        reduced = self.project(matrix)
+        self.scale = None
+        if self.storage == "int8":
+            # Symmetric per-row scale: row = data * scale
+            scale = np.abs(reduced).max(axis=1) / 127.0
+            scale[scale == 0] = 1.0
+            self.data = np.round(reduced / scale[:, None]).astype(np.int8)
+            self.scale = scale.astype(np.float32)
+        else:
+            self.data = reduced.astype(STORAGE_TYPES[self.storage])
+        self.data.setflags(write=False)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def project(self, rows):
+        """Normalized rows (n, d) -> normalized reduced rows (n, components)"""
+        return _unit_rows((_unit_rows(rows) - self.mean) @ self.basis.T)
+
+    def scores(self, query):
+        """
+        Approximate cosine similarity of one normalized query to every row
+
+        Non-float32 storage is widened one block at a time into a small
+        scratch buffer, so the full-size matrix is only ever read in its
+        compact form.
+        """
+        reduced = self.project(query)[0]
+        n = len(self)
+        out = np.empty(n, dtype=np.float32)
+        if self.data.dtype == np.float32:
+            np.dot(self.data, reduced, out=out)
+        else:
+            scratch = np.empty((min(self.block_rows, n), self.data.shape[1]), dtype=np.float32)
+            for start in range(0, n, self.block_rows):
+                stop = min(start + self.block_rows, n)
+                block = scratch[:stop - start]
+                block[...] = self.data[start:stop]
+                np.dot(block, reduced, out=out[start:stop])
+        if self.scale is not None:
+            out *= self.scale
+        return out
+
+    def describe(self):
+        return {
+            "rows": len(self),
+            "components": int(self.data.shape[1]),
+            "storage": self.storage,
+            "rescore_top_k": self.rescore_top_k,
+            "scan_bytes": int(self.nbytes)
+        }
+
+
+def main():
+    embeddings_file = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] != "-" else None
+    try:
+        face_embeddings = load_offline_gallery(embeddings_file)
+    except FileNotFoundError as e:
+        print(f"Gallery not found: {e}")
+        sys.exit(1)
+
+    settings = {}
+    if len(sys.argv) > 2:
+        settings["components"] = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        settings["storage"] = sys.argv[3]
+
+    projection = fit_projection(face_embeddings, settings)
+    path = compression_path(embeddings_file or EMBEDDINGS_FILE)
+    save_projection(projection, path)
+
+    print(f"Fit {projection['components']}-d {projection['storage']} projection on "
+          f"{projection['samples']} embeddings -> {path}")
+    print(f"  explained variance: {projection['explained_variance']:.3f}")
+    print(f"  compact scan used for galleries of {projection['min_gallery']}+ identities")
+
+
+if __name__ == "__main__":
+    main()
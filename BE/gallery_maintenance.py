@@ -0,0 +1,117 @@
+"""
+Gallery Maintenance
+Background jobs for gallery upkeep (re-embedding, compaction, relabeling)
+"""
+
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """Progress record of one background job"""
+
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.params = params
+        self.status = "queued"
+        self.total = 0
+        self.done = 0
+        self.result = None
+        self.error = None
+        self.created = datetime.now().isoformat(timespec="seconds")
+        self.started = None
+        self.finished = None
+
+    def progress(self, done, total=None):
+        """Called by the job function as it works through its batches"""
+        self.done = done
+        if total is not None:
+            self.total = total
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status,
+            "done": self.done,
+            "total": self.total,
+            "percent": round(100.0 * self.done / self.total, 1) if self.total else None,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished
+        }
+
+
+class GalleryJobs:
+    """
+    One worker thread running gallery jobs in submission order
+
+    Jobs never overlap, so a re-embed and a compaction can't both publish
+    snapshots at once. Recognition keeps running on the current gallery
+    while a job works; results are swapped in when the job finishes.
+    """
+
+    def __init__(self, history=50):
+        """
+        Args:
+            history: finished jobs kept for GET /api/gallery/jobs
+        """
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gallery-job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, kind, fn, **params):
+        """
+        Queue fn(job, **params) and return the job right away
+
+        Args:
+            kind: short job type shown to the admin (e.g. 'reembed')
+            fn: callable doing the work; reports progress via job.progress()
+                and returns a JSON serializable result
+        """
+        job = Job(kind, params)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.history:
+                oldest_id, oldest = next(iter(self._jobs.items()))
+                if oldest.status in ("queued", "running"):
+                    break
+                del self._jobs[oldest_id]
+
+        self._executor.submit(self._run, job, fn, params)
+        return job
+
+    def _run(self, job, fn, params):
+        job.status = "running"
+        job.started = datetime.now().isoformat(timespec="seconds")
+        try:
+            job.result = fn(job, **params)
+            job.status = "done"
+            logger.info(f"Gallery job {job.kind} {job.id} finished")
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logger.error(f"Gallery job {job.kind} {job.id} failed: {e}")
+        finally:
+            job.finished = datetime.now().isoformat(timespec="seconds")
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return [job.to_dict() for job in reversed(self._jobs.values())]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
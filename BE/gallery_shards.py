@@ -0,0 +1,72 @@
+"""
+Gallery Shards
+Builds named gallery shards from NIM prefixes and maps kiosks to shards
+"""
+
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    # Every user is also placed in a cohort shard named after the first
+    # digits of their NIM (e.g. "5231811"), 0 disables cohort shards
+    "cohort_prefix_length": 7,
+    # Extra named shards, e.g. {"building-a": {"prefixes": ["5231811"]}}
+    "shards": {},
+    # Kiosk ID -> shard name
+    "kiosks": {}
+}
+
+
+def load_shard_config(path="gallery_shards.json"):
+    """Load shard config, falling back to defaults for missing keys"""
+    config = dict(DEFAULT_CONFIG)
+    if os.path.exists(path):
+        try:
+            with open(path, "r") as f:
+                config.update(json.load(f))
+        except Exception as e:
+            logger.error(f"Error loading shard config: {e}")
+    return config
+
+
+def build_shards(users, config):
+    """
+    Group user names into shards by NIM (phone) prefix
+
+    Args:
+        users: list of user dicts from users.json
+        config: shard config from load_shard_config
+
+    Returns:
+        dict mapping shard name -> set of user names
+    """
+    shards = {}
+    prefix_length = config.get("cohort_prefix_length", 0)
+    named = config.get("shards", {})
+
+    for user in users:
+        nim = str(user.get("phone", ""))
+        name = user.get("name")
+        if not nim or not name:
+            continue
+
+        if prefix_length and len(nim) >= prefix_length:
+            shards.setdefault(nim[:prefix_length], set()).add(name)
+
+        for shard, rule in named.items():
+            if any(nim.startswith(prefix) for prefix in rule.get("prefixes", [])):
+                shards.setdefault(shard, set()).add(name)
+
+    return shards
+
+
+def resolve_shard(config, kiosk_id=None, cohort=None):
+    """Pick the shard hint for a request: explicit cohort wins over kiosk"""
+    if cohort:
+        return cohort
+    if kiosk_id:
+        return config.get("kiosks", {}).get(kiosk_id)
+    return None
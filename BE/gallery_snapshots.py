@@ -0,0 +1,269 @@
+"""
+Gallery Snapshots
+Versioned, immutable copies of the face gallery with a manifest
+
+Layout:
+    gallery_snapshots/
+        manifest.json       {"current": 3, "versions": [...]}
+        v000001.npz         names + embedding matrix (+ calibration)
+        v000001.journal     deletes / relabels applied on top of v000001
+        ...
+
+A snapshot file is never modified after it is written. Publishing writes the
+new file first and then swaps the manifest with os.replace, so a reader sees
+either the old or the new version, never a partial one. Rolling back only
+moves the 'current' pointer.
+
+Small edits (delete, relabel) are appended to the version's journal, one
+JSON line each, instead of rewriting the snapshot. Publishing a new snapshot
+with the edits applied compacts the journal away.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+from datetime import datetime
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Legacy gallery pickle; offline calibration / projection files are named after it
+EMBEDDINGS_FILE = "face_embeddings_facenet.pkl"
+
+
+class GallerySnapshots:
+    """Snapshot directory shared by every process serving the gallery"""
+
+    def __init__(self, root="gallery_snapshots", keep=20):
+        """
+        Args:
+            root: directory holding the manifest and snapshot files
+            keep: number of versions kept for rollback
+        """
+        self.root = root
+        self.keep = keep
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _write_json(self, path, data):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def manifest(self):
+        """Current manifest, or an empty one"""
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"current": None, "versions": []}
+
+    def current_version(self):
+        return self.manifest().get("current")
+
+    def _journal_path(self, version):
+        return os.path.join(self.root, f"v{version:06d}.journal")
+
+    def read_journal(self, version):
+        """Edits recorded on top of a snapshot version, oldest first"""
+        try:
+            with open(self._journal_path(version), "r") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def journal_length(self, version):
+        return len(self.read_journal(version)) if version is not None else 0
+
+    def append_journal(self, version, op):
+        """
+        Durably record one edit against a snapshot version
+
+        Args:
+            version: snapshot the edit applies to
+            op: dict like {"op": "delete", "name": ...} or
+                {"op": "relabel", "old": ..., "new": ...}
+
+        Returns:
+            number of edits now in the journal
+        """
+        with self._lock:
+            with open(self._journal_path(version), "a") as f:
+                f.write(json.dumps(op) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        return self.journal_length(version)
+
+    @staticmethod
+    def apply_journal(face_embeddings, ops, calibration=None):
+        """
+        Replay journal edits on a name -> embedding dict (in place)
+
+        The per-identity thresholds in `calibration`, if given, follow the
+        same deletes and relabels so they stay keyed by the served names,
+        and each edit marks the calibration stale (see
+        gallery_calibration.mark_stale).
+        """
+        thresholds = (calibration or {}).get("thresholds", {})
+        for op in ops:
+            if calibration:
+                calibration["stale"] = True
+                calibration["changes_since"] = calibration.get("changes_since", 0) + 1
+            if op["op"] == "delete":
+                face_embeddings.pop(op["name"], None)
+                thresholds.pop(op["name"], None)
+            elif op["op"] == "relabel" and op["old"] in face_embeddings:
+                face_embeddings[op["new"]] = face_embeddings.pop(op["old"])
+                if op["old"] in thresholds:
+                    thresholds[op["new"]] = thresholds.pop(op["old"])
+        return face_embeddings
+
+    def _entry(self, manifest, version):
+        entry = next((v for v in manifest["versions"] if v["version"] == version), None)
+        if entry is None:
+            raise KeyError(f"Gallery snapshot {version} not found")
+        return entry
+
+    def publish(self, face_embeddings, calibration=None, note=None):
+        """
+        Write a new snapshot and make it current
+
+        Args:
+            face_embeddings: dict mapping name -> embedding
+            calibration: optional calibration dict stored with the snapshot
+            note: free text shown in the version list (e.g. 'register Budi')
+
+        Returns:
+            the new version number
+        """
+        names = list(face_embeddings.keys())
+        if names:
+            matrix = np.stack([np.asarray(face_embeddings[n], dtype=np.float32).ravel() for n in names])
+        else:
+            matrix = np.zeros((0, 512), dtype=np.float32)
+
+        with self._lock:
+            manifest = self.manifest()
+            version = max([v["version"] for v in manifest["versions"]], default=0) + 1
+            filename = f"v{version:06d}.npz"
+            path = os.path.join(self.root, filename)
+
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(
+                    f,
+                    names=np.array(names, dtype=str),
+                    embeddings=matrix,
+                    calibration=np.array(json.dumps(calibration or {}))
+                )
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+
+            with open(path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+
+            manifest["versions"].append({
+                "version": version,
+                "file": filename,
+                "sha256": digest,
+                "count": len(names),
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "note": note
+            })
+            manifest["current"] = version
+            removed = self._prune(manifest)
+            self._write_json(self.manifest_path, manifest)
+
+        for filename in removed:
+            try:
+                os.remove(os.path.join(self.root, filename))
+            except OSError:
+                pass
+
+        logger.info(f"Published gallery snapshot v{version} ({len(names)} faces)")
+        return version
+
+    def _prune(self, manifest):
+        """Drop the oldest versions beyond `keep` (never the current one)"""
+        removed = []
+        while len(manifest["versions"]) > self.keep:
+            oldest = manifest["versions"][0]
+            if oldest["version"] == manifest["current"]:
+                break
+            manifest["versions"].pop(0)
+            removed.append(oldest["file"])
+            removed.append(os.path.basename(self._journal_path(oldest["version"])))
+        return removed
+
+    def load(self, version=None):
+        """
+        Read a snapshot (the current one by default)
+
+        The version's journal is replayed on top of the embeddings and the
+        calibration thresholds, so the result reflects every delete and
+        relabel made since the snapshot was published.
+
+        Returns:
+            (version, face_embeddings dict, calibration dict or None),
+            or (None, {}, None) if no snapshot exists yet
+        """
+        manifest = self.manifest()
+        version = manifest.get("current") if version is None else version
+        if version is None:
+            return None, {}, None
+
+        entry = self._entry(manifest, version)
+        with np.load(os.path.join(self.root, entry["file"])) as data:
+            names = [str(n) for n in data["names"]]
+            matrix = data["embeddings"]
+            calibration = json.loads(str(data["calibration"])) or None
+
+        face_embeddings = {name: matrix[i] for i, name in enumerate(names)}
+        self.apply_journal(face_embeddings, self.read_journal(version), calibration)
+        return version, face_embeddings, calibration
+
+    def set_current(self, version):
+        """Point the manifest at an existing version (rollback / roll forward)"""
+        with self._lock:
+            manifest = self.manifest()
+            self._entry(manifest, version)
+            manifest["current"] = version
+            self._write_json(self.manifest_path, manifest)
+        logger.info(f"Gallery snapshot v{version} is now current")
+
+
+def load_offline_gallery(embeddings_file=None, root="gallery_snapshots"):
+    """
+    Gallery an offline job (calibration, compression) is fit on
+
+    The current snapshot with its journal replayed is what the servers
+    serve. The legacy pickle misses every delete and relabel made since it
+    was last written, so it is only read when passed explicitly.
+
+    Args:
+        embeddings_file: optional pickle to read instead of the snapshot
+        root: snapshot directory
+
+    Returns:
+        dict mapping name -> embedding
+
+    Raises:
+        FileNotFoundError: the pickle or any snapshot is missing
+    """
+    if embeddings_file is not None:
+        with open(embeddings_file, "rb") as f:
+            return pickle.load(f)
+
+    version, face_embeddings, _ = GallerySnapshots(root).load()
+    if version is None:
+        raise FileNotFoundError(f"No gallery snapshot in {root}")
+    return face_embeddings
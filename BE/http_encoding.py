@@ -0,0 +1,123 @@
+"""
+HTTP Encoding
+Opt-in response compression, fast JSON rendering and the columnar format
+"""
+
+import gzip
+import json
+import logging
+
+from fastapi.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+    from fastapi.responses import ORJSONResponse
+except ImportError:  # optional dependency
+    orjson = None
+    ORJSONResponse = None
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+# Media type clients send in Accept to get compact columnar month grids
+COLUMNAR_MEDIA_TYPE = "application/vnd.pam.columnar+json"
+
+# orjson when installed, otherwise FastAPI's default encoder
+FastJSONResponse = ORJSONResponse or JSONResponse
+
+
+def dumps(content):
+    """Serialize to JSON bytes with orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, separators=(",", ":")).encode()
+
+
+def wants_columnar(request):
+    return COLUMNAR_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+class CompressionMiddleware:
+    """
+    Compress complete (non-streaming) responses with brotli or gzip
+
+    Picks brotli when the client accepts it and the brotli package is
+    installed, gzip otherwise. Streaming responses such as server-sent events
+    and small bodies are passed through untouched.
+    """
+
+    def __init__(self, app, minimum_size=1024, gzip_level=6, brotli_quality=5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def _choose_encoding(self, scope):
+        accept = ""
+        for key, value in scope.get("headers", []):
+            if key == b"accept-encoding":
+                accept = value.decode("latin-1")
+                break
+        if brotli is not None and "br" in accept:
+            return "br"
+        if "gzip" in accept:
+            return "gzip"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = self._choose_encoding(scope)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def compressing_send(message):
+            nonlocal start_message, passthrough
+
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            headers = dict(start_message.get("headers", []))
+            body = message.get("body", b"")
+            streaming = message.get("more_body", False)
+
+            # Streams, tiny bodies and already-encoded bodies go out as-is
+            if streaming or len(body) < self.minimum_size or b"content-encoding" in headers:
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            if encoding == "br":
+                compressed = brotli.compress(body, quality=self.brotli_quality)
+            else:
+                compressed = gzip.compress(body, compresslevel=self.gzip_level)
+
+            new_headers = [
+                (k, v) for k, v in start_message.get("headers", [])
+                if k not in (b"content-length", b"content-encoding")
+            ]
+            new_headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(compressed)).encode()),
+                (b"vary", b"Accept-Encoding")
+            ]
+            await send({**start_message, "headers": new_headers})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, compressing_send)
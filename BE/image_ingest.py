@@ -0,0 +1,185 @@
+"""
+Image Ingest
+One decode path from an uploaded image to the BGR array the model takes
+
+    validate -> read -> open -> orient -> rgb -> bgr
+
+Every stage is a function of an IngestContext. The pipeline times each
+stage per image and keeps running totals for /api/health. Request
+handlers (ingest_upload), batch jobs (ingest_many) and in-memory frames
+(ingest_bytes) all use the same stages, so an optimization to one stage
+applies to every endpoint at once.
+"""
+
+import io
+import logging
+import threading
+import time
+
+import cv2
+import numpy as np
+from fastapi import HTTPException
+from PIL import ImageOps
+
+from tracing import record_span
+from upload_limits import open_image, DEFAULT_MAX_IMAGE_PIXELS
+
+logger = logging.getLogger(__name__)
+
+EXIF_ORIENTATION = 0x0112
+
+
+class IngestContext:
+    """State of one image moving through the pipeline"""
+
+    def __init__(self, source, filename=None, content_type=None, keep_bytes=False,
+                 max_pixels=DEFAULT_MAX_IMAGE_PIXELS):
+        """
+        Args:
+            source: readable, seekable file object holding the encoded image
+            filename / content_type: as sent by the client, if any
+            keep_bytes: also keep the encoded bytes (enrollment stores them)
+            max_pixels: largest width * height accepted
+        """
+        self.source = source
+        self.filename = filename
+        self.content_type = content_type
+        self.keep_bytes = keep_bytes
+        self.max_pixels = max_pixels
+
+        self.original_bytes = None
+        self.image = None  # PIL image while decoding
+        self.size = None  # (width, height) after orientation
+        self.bgr = None  # final uint8 HxWx3 array
+        self.error = None  # set instead of raising in batch mode
+        self.timings = {}  # stage -> milliseconds
+
+
+# ---- stages ----
+
+def validate_type(ctx):
+    """Refuse uploads that don't claim to be images"""
+    if ctx.content_type is not None and not ctx.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="File must be an image (JPEG, PNG)")
+
+
+def read_original(ctx):
+    """Keep the encoded bytes when the caller stores them"""
+    if ctx.keep_bytes:
+        ctx.source.seek(0)
+        ctx.original_bytes = ctx.source.read()
+
+
+def open_header(ctx):
+    """Read the header only and enforce the pixel limit"""
+    ctx.image = open_image(ctx.source, ctx.max_pixels)
+
+
+def orient(ctx):
+    """Apply the EXIF orientation, only when it isn't already upright"""
+    try:
+        if ctx.image.getexif().get(EXIF_ORIENTATION, 1) != 1:
+            ctx.image = ImageOps.exif_transpose(ctx.image)
+    except Exception as e:
+        logger.warning(f"Could not apply EXIF orientation: {e}")
+    ctx.size = ctx.image.size
+
+
+def to_rgb(ctx):
+    """Decode the pixels, converting only if the image isn't RGB already"""
+    if ctx.image.mode != "RGB":
+        ctx.image = ctx.image.convert("RGB")
+    else:
+        ctx.image.load()
+
+
+def to_bgr(ctx):
+    """One copy out of PIL, then channel swap in place"""
+    rgb = np.array(ctx.image)
+    ctx.bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR, dst=rgb)
+    ctx.image.close()
+    ctx.image = None
+
+
+DEFAULT_STAGES = [
+    ("validate", validate_type),
+    ("read", read_original),
+    ("open", open_header),
+    ("orient", orient),
+    ("rgb", to_rgb),
+    ("bgr", to_bgr),
+]
+
+
+class ImagePipeline:
+    """Ordered, timed ingest stages shared by every image endpoint"""
+
+    def __init__(self, stages=None, max_pixels=DEFAULT_MAX_IMAGE_PIXELS):
+        """
+        Args:
+            stages: list of (name, fn(ctx)) pairs; DEFAULT_STAGES if None
+            max_pixels: largest width * height accepted
+        """
+        self.stages = list(stages or DEFAULT_STAGES)
+        self.max_pixels = max_pixels
+        self._totals = {}  # stage -> [count, total ms]
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, fn, after=None):
+        """Insert a stage after the named one (at the end by default)"""
+        position = len(self.stages)
+        if after is not None:
+            position = [n for n, _ in self.stages].index(after) + 1
+        self.stages.insert(position, (name, fn))
+
+    def run(self, ctx):
+        """Run every stage on ctx; stage errors propagate"""
+        for name, fn in self.stages:
+            started = time.perf_counter()
+            fn(ctx)
+            ctx.timings[name] = round((time.perf_counter() - started) * 1000, 3)
+            record_span(f"ingest.{name}", started, ctx.timings[name])
+
+        with self._lock:
+            for name, ms in ctx.timings.items():
+                total = self._totals.setdefault(name, [0, 0.0])
+                total[0] += 1
+                total[1] += ms
+        return ctx
+
+    def ingest_upload(self, upload, keep_bytes=False):
+        """FastAPI UploadFile -> IngestContext (decoded from its spooled file)"""
+        return self.run(IngestContext(
+            upload.file, upload.filename, upload.content_type, keep_bytes, self.max_pixels
+        ))
+
+    def ingest_bytes(self, data, filename=None, keep_bytes=False):
+        """Encoded image bytes (e.g. a stored original or a stream frame) -> IngestContext"""
+        return self.run(IngestContext(io.BytesIO(data), filename, None, keep_bytes, self.max_pixels))
+
+    def ingest_many(self, paths):
+        """
+        Decode image files one by one for batch jobs
+
+        Yields:
+            IngestContext per path; unreadable files get ctx.error set
+            instead of stopping the batch
+        """
+        for path in paths:
+            with open(path, "rb") as f:
+                ctx = IngestContext(f, filename=path, max_pixels=self.max_pixels)
+                try:
+                    self.run(ctx)
+                except HTTPException as e:
+                    ctx.error = e.detail
+                except Exception as e:
+                    ctx.error = str(e)
+            yield ctx
+
+    def stats(self):
+        """Average milliseconds per stage since start"""
+        with self._lock:
+            return {
+                name: {"count": count, "avg_ms": round(total / count, 3) if count else None}
+                for name, (count, total) in self._totals.items()
+            }
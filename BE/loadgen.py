@@ -0,0 +1,426 @@
+"""
+Load Generator
+Deterministic traffic shapes (or a recorded request log) against the API
+
+A run is a schedule of requests fixed up front from a profile and a seed:
+clock-in waves as kiosks fill up in the morning, with dashboard polls of
+/api/users and the month grid running underneath. The same profile and
+seed always give the same schedule, so a concurrency or performance fix
+can be compared against the run before it. A schedule can be written out
+with --record and played back later; recorded production logs in the same
+JSON-lines format replay the same way.
+
+Requests are fired open-loop at their scheduled time, in-process through
+the ASGI app (against a scratch copy of the data files) or against a
+running server with --url. Clock-in/out uploads are images from
+datasets/new_dataset. The report gives latency percentiles per endpoint
+and checks that every acknowledged punch was written to attendance exactly
+once.
+
+Log format, one request per line:
+    {"at": 12.5, "method": "POST", "path": "/api/clock-in", "image": "5221911012_Debora_10.jpg"}
+    {"at": 13.0, "method": "GET", "path": "/api/users"}
+("timestamp" in ISO format may be given instead of "at")
+
+The in-process scratch copy is removed after the integrity check unless
+--keep is given.
+
+Usage:
+    python loadgen.py [--profile morning] [--seed 1] [--speed 1.0] [--keep]
+    python loadgen.py --replay requests.log.jsonl
+    python loadgen.py --url http://localhost:8000 --data-dir .
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+import httpx
+
+from attendance_store import AttendanceStore
+
+DATASET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "datasets", "new_dataset")
+
+PROFILES = {
+    # Three arrival waves (shift buses / class changes) plus dashboards polling
+    "morning": {
+        "duration": 60,
+        "waves": [
+            {"start": 2, "spread": 10, "punches": 40},
+            {"start": 20, "spread": 6, "punches": 60},
+            {"start": 40, "spread": 12, "punches": 30}
+        ],
+        "clock_out_share": 0.05,
+        "polls": {"/api/users": 1.0, "/api/attendance/status/month/{month}": 0.5}
+    },
+    # Evenly spread punches, for comparing against the burst
+    "steady": {
+        "duration": 60,
+        "waves": [{"start": 0, "spread": 60, "punches": 60, "uniform": True}],
+        "clock_out_share": 0.5,
+        "polls": {"/api/users": 0.5, "/api/attendance/status/month/{month}": 0.25}
+    },
+    # Short smoke run
+    "smoke": {
+        "duration": 5,
+        "waves": [{"start": 0, "spread": 3, "punches": 8}],
+        "clock_out_share": 0.25,
+        "polls": {"/api/users": 1.0, "/api/attendance/status/month/{month}": 1.0}
+    }
+}
+
+PUNCH_PATHS = ("/api/clock-in", "/api/clock-out")
+
+
+def dataset_images(dataset_dir=DATASET_DIR):
+    return sorted(
+        f for f in os.listdir(dataset_dir) if f.lower().endswith((".jpg", ".jpeg", ".png"))
+    )
+
+
+def build_schedule(profile, images, seed=1):
+    """
+    Deterministic list of requests for a profile
+
+    Punch arrivals within a wave follow a triangular distribution peaking
+    early in the wave; polls are Poisson at their per-second rate.
+
+    Returns:
+        list of {"at", "method", "path", "image"?} sorted by "at"
+    """
+    rng = random.Random(seed)
+    month = datetime.now().strftime("%Y-%m")
+    schedule = []
+
+    for wave in profile["waves"]:
+        start, spread = wave["start"], wave["spread"]
+        for _ in range(wave["punches"]):
+            if wave.get("uniform"):
+                at = rng.uniform(start, start + spread)
+            else:
+                at = rng.triangular(start, start + spread, start + spread / 3)
+            path = PUNCH_PATHS[1] if rng.random() < profile["clock_out_share"] else PUNCH_PATHS[0]
+            schedule.append({"at": at, "method": "POST", "path": path, "image": rng.choice(images)})
+
+    for template, rate in profile["polls"].items():
+        at = rng.expovariate(rate)
+        while at < profile["duration"]:
+            schedule.append({"at": at, "method": "GET", "path": template.format(month=month)})
+            at += rng.expovariate(rate)
+
+    schedule.sort(key=lambda r: r["at"])
+    for request in schedule:
+        request["at"] = round(request["at"], 3)
+    return schedule
+
+
+def load_log(path):
+    """Recorded JSON-lines log -> schedule with "at" offsets from the first request"""
+    schedule = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            request = json.loads(line)
+            if "at" not in request:
+                request["at"] = datetime.fromisoformat(request["timestamp"]).timestamp()
+            request.setdefault("method", "GET")
+            schedule.append(request)
+
+    schedule.sort(key=lambda r: r["at"])
+    if schedule:
+        first = schedule[0]["at"]
+        for request in schedule:
+            request["at"] -= first
+    return schedule
+
+
+def save_log(schedule, path):
+    with open(path, "w") as f:
+        for request in schedule:
+            f.write(json.dumps(request) + "\n")
+
+
+def endpoint_of(request):
+    """Group label: path with IDs and months collapsed"""
+    path = re.sub(r"/\d{4}-\d{2}(?=/|$)", "/{month}", request["path"].split("?")[0])
+    path = re.sub(r"/\d+(?=/|$)", "/{id}", path)
+    return f"{request['method']} {path}"
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LoadRun:
+    """Fires a schedule open-loop and collects per-request results"""
+
+    def __init__(self, client, images_dir=DATASET_DIR, speed=1.0, token=None):
+        """
+        Args:
+            client: httpx.AsyncClient (ASGI transport or a base_url)
+            images_dir: where "image" entries are read from
+            speed: schedule time is divided by this (2.0 = twice as fast)
+            token: optional session token for the portal endpoints
+        """
+        self.client = client
+        self.images_dir = images_dir
+        self.speed = speed
+        self.headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self.results = []  # (endpoint, status, ms, late_ms)
+        self.punches = []  # acknowledged (name, type, timestamp)
+        self.etags = {}  # path -> last ETag, as a polling dashboard keeps it
+        self._image_cache = {}
+
+    def _image(self, name):
+        data = self._image_cache.get(name)
+        if data is None:
+            with open(os.path.join(self.images_dir, name), "rb") as f:
+                data = self._image_cache[name] = f.read()
+        return data
+
+    async def _send(self, request, started):
+        path = request["path"]
+        headers = dict(self.headers)
+        scheduled = started + request["at"] / self.speed
+        late_ms = max(0.0, (time.perf_counter() - scheduled) * 1000)
+
+        begin = time.perf_counter()
+        try:
+            if request.get("image"):
+                files = {"file": (request["image"], self._image(request["image"]), "image/jpeg")}
+                response = await self.client.request(request["method"], path, files=files, headers=headers)
+            else:
+                if path in self.etags:
+                    headers["If-None-Match"] = self.etags[path]
+                response = await self.client.request(request["method"], path, headers=headers)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            response, status = None, f"error:{type(e).__name__}"
+        elapsed = (time.perf_counter() - begin) * 1000
+        self.results.append((endpoint_of(request), status, elapsed, late_ms))
+
+        if response is None:
+            return
+        if "etag" in response.headers:
+            self.etags[path] = response.headers["etag"]
+        if path in PUNCH_PATHS and status == 200:
+            body = response.json()
+            if body.get("status") == "recognized":
+                punch_type = "clock-in" if path == PUNCH_PATHS[0] else "clock-out"
+                self.punches.append((body["name"], punch_type, body["timestamp"]))
+
+    async def run(self, schedule):
+        """Send every request at its scheduled offset; returns wall seconds"""
+        started = time.perf_counter()
+        tasks = []
+        for request in schedule:
+            delay = started + request["at"] / self.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self._send(request, started)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+    def report(self):
+        """Per-endpoint latency percentiles and status counts"""
+        by_endpoint = {}
+        for endpoint, status, ms, late_ms in self.results:
+            row = by_endpoint.setdefault(endpoint, {"ms": [], "statuses": Counter(), "late_ms": []})
+            row["ms"].append(ms)
+            row["late_ms"].append(late_ms)
+            row["statuses"][status] += 1
+
+        report = {}
+        for endpoint, row in sorted(by_endpoint.items()):
+            ms = sorted(row["ms"])
+            report[endpoint] = {
+                "count": len(ms),
+                "statuses": dict(row["statuses"]),
+                "p50_ms": percentile(ms, 50),
+                "p90_ms": percentile(ms, 90),
+                "p99_ms": percentile(ms, 99),
+                "max_ms": ms[-1],
+                "mean_ms": statistics.mean(ms),
+                "max_late_ms": max(row["late_ms"])
+            }
+        return report
+
+
+def check_integrity(data_dir, punches, since):
+    """
+    Compare acknowledged punches with what reached the attendance files
+
+    Returns:
+        dict with counts of lost (acknowledged, not stored), duplicated
+        (stored more than once) and unacknowledged (stored, never
+        acknowledged, e.g. from other clients) punches
+    """
+    store = AttendanceStore(
+        os.path.join(data_dir, "attendance"), legacy_path=os.path.join(data_dir, "attendance.json")
+    )
+    stored = Counter(
+        (r.get("name"), r.get("type"), r.get("timestamp"))
+        for r in store.load()
+        if r.get("timestamp", "") >= since
+    )
+    acknowledged = Counter(punches)
+
+    lost = acknowledged - stored
+    duplicated = {key: count for key, count in stored.items() if count > 1}
+    return {
+        "acknowledged": sum(acknowledged.values()),
+        "stored": sum(stored.values()),
+        "lost": sum(lost.values()),
+        "duplicated": sum(count - 1 for count in duplicated.values()),
+        "unacknowledged": sum((stored - acknowledged).values()),
+        "examples": {
+            "lost": [list(k) for k in list(lost)[:5]],
+            "duplicated": [list(k) for k in list(duplicated)[:5]]
+        }
+    }
+
+
+# Large directories the server only reads; linked into the scratch dir, not copied
+READ_ONLY_ASSETS = ("datasets", "models")
+
+
+def scratch_workdir(source_dir):
+    """
+    Copy the data files (not the code) to a temp dir for an in-process run,
+    so the run never writes to the real attendance files
+    """
+    workdir = tempfile.mkdtemp(prefix="loadgen-")
+    for entry in os.listdir(source_dir):
+        src = os.path.join(source_dir, entry)
+        dst = os.path.join(workdir, entry)
+        if entry in READ_ONLY_ASSETS:
+            os.symlink(src, dst)
+        elif os.path.isdir(src):
+            if entry not in ("__pycache__", ".git"):
+                shutil.copytree(src, dst)
+        elif not entry.endswith(".py"):
+            shutil.copy2(src, dst)
+    return workdir
+
+
+async def run_in_process(schedule, args):
+    """Run against the ASGI app in this process, on a scratch copy of the data"""
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    workdir = scratch_workdir(source_dir)
+    os.environ.setdefault("GALLERY_WATCH_INTERVAL", "0")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    # Imported only now: app opens its data files relative to the cwd
+    import app as app_module
+
+    print(f"In-process run on scratch data in {workdir}")
+    await app_module.app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=app_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadgen", timeout=None) as client:
+            load_run = LoadRun(client, speed=args.speed, token=args.token)
+            wall = await load_run.run(schedule)
+    finally:
+        # Flushes the attendance writer before the files are checked
+        await app_module.app.router.shutdown()
+        os.chdir(cwd)
+    return load_run, wall, workdir
+
+
+async def run_over_http(schedule, args):
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+        load_run = LoadRun(client, speed=args.speed, token=args.token)
+        wall = await load_run.run(schedule)
+    return load_run, wall, args.data_dir
+
+
+def print_report(load_run, wall, integrity):
+    report = load_run.report()
+    total = sum(row["count"] for row in report.values())
+    print()
+    print(f"{total} requests in {wall:.1f} s ({total / wall:.1f} req/s)")
+    print()
+    print(f"{'endpoint':<48} | {'n':>5} | {'p50':>8} | {'p90':>8} | {'p99':>8} | {'max':>8} | statuses")
+    print("-" * 110)
+    for endpoint, row in report.items():
+        statuses = ", ".join(f"{k}:{v}" for k, v in sorted(row["statuses"].items(), key=str))
+        print(f"{endpoint:<48} | {row['count']:>5} | {row['p50_ms']:>8.1f} | {row['p90_ms']:>8.1f} | "
+              f"{row['p99_ms']:>8.1f} | {row['max_ms']:>8.1f} | {statuses}")
+    print("(milliseconds)")
+
+    print()
+    if integrity is None:
+        print("Integrity: skipped (pass --data-dir with the server's data directory to check)")
+    else:
+        ok = integrity["lost"] == 0 and integrity["duplicated"] == 0
+        print(f"Integrity: {'OK' if ok else 'FAILED'} - {integrity['acknowledged']} punches acknowledged, "
+              f"{integrity['stored']} stored, {integrity['lost']} lost, {integrity['duplicated']} duplicated, "
+              f"{integrity['unacknowledged']} from other clients")
+        for kind in ("lost", "duplicated"):
+            for example in integrity["examples"][kind]:
+                print(f"  {kind}: {example}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic load generator / replay harness")
+    parser.add_argument("--profile", default="morning", choices=sorted(PROFILES))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--replay", help="JSON-lines request log to replay instead of a profile")
+    parser.add_argument("--record", help="write the schedule to this JSON-lines file")
+    parser.add_argument("--speed", type=float, default=1.0, help="time compression (2.0 = twice as fast)")
+    parser.add_argument("--url", help="base URL of a running server (default: in-process)")
+    parser.add_argument("--data-dir", help="server data directory, for the integrity check with --url")
+    parser.add_argument("--token", help="session token for the portal endpoints")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the in-process scratch data directory")
+    args = parser.parse_args()
+
+    if args.replay:
+        schedule = load_log(args.replay)
+        print(f"Replaying {len(schedule)} requests from {args.replay}")
+    else:
+        schedule = build_schedule(PROFILES[args.profile], dataset_images(), args.seed)
+        print(f"Profile '{args.profile}' (seed {args.seed}): {len(schedule)} requests")
+    if args.record:
+        save_log(schedule, args.record)
+        print(f"Schedule written to {args.record}")
+
+    since = datetime.now().isoformat()
+    runner = run_over_http if args.url else run_in_process
+    load_run, wall, data_dir = asyncio.run(runner(schedule, args))
+
+    integrity = check_integrity(data_dir, load_run.punches, since) if data_dir else None
+    if not args.url:
+        if args.keep:
+            print(f"Scratch data kept in {data_dir}")
+        else:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    report = print_report(load_run, wall, integrity)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"wall_s": wall, "endpoints": report, "integrity": integrity}, f, indent=2)
+
+    if integrity is not None and (integrity["lost"] or integrity["duplicated"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Payroll Engine
+Computes monthly salary slips from recorded attendance
+"""
+
+import json
+import logging
+import threading
+from datetime import date
+
+import numpy as np
+
+from attendance_grid import build_status_grid, status_counts
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES = {
+    # Fixed share of basic salary always deducted (tax / insurance)
+    "fixed_deduction_rate": 0.10,
+    # Share of one day's basic salary deducted per day with this status
+    "day_deduction_rates": {
+        "alpha": 1.0,
+        "permission": 0.5,
+        "sick": 0.0
+    }
+}
+
+
+class PayrollEngine:
+    """
+    Salary slips derived from the attendance month grid
+
+    salaries.json supplies each user's basicSalary and allowances; the
+    deduction is computed from how many alpha / permission / sick days the
+    user has in the month, under the rules in payroll_rules.json. A month is
+    computed for all users at once with array arithmetic, and the results
+    are memoized per (userId, month). Punches and status overrides only
+    invalidate the month (and user) they touch. A month that hasn't ended
+    is counted up to today, so it is recomputed for everyone once the date
+    moves on.
+    """
+
+    def __init__(self, attendance_store, users_store, salaries_store, statuses_store, rules_store, calendar=None):
+        """
+        Args:
+            attendance_store / users_store / salaries_store / statuses_store /
+            rules_store: VersionedJsonStore instances for the data files
+            calendar: WorkCalendar shared with the month grid (default Mon-Fri)
+        """
+        self.attendance_store = attendance_store
+        self.users_store = users_store
+        self.salaries_store = salaries_store
+        self.statuses_store = statuses_store
+        self.rules_store = rules_store
+        self.calendar = calendar
+
+        self._lock = threading.Lock()
+        self._slips = {}  # (userId, month) -> slip dict
+        self._months = {}  # memoized month -> last day counted
+        self._stale = set()  # (userId, month) invalidated since computed
+        self._source_signature = None
+
+    def _signature(self):
+        """Versions of the inputs that are not invalidated explicitly"""
+        calendar_version = self.calendar.version if self.calendar is not None else 0
+        return (self.users_store.version, self.salaries_store.version, self.rules_store.version, calendar_version)
+
+    def _rules(self):
+        rules = json.loads(json.dumps(DEFAULT_RULES))
+        custom = dict(self.rules_store.load())
+        rules["day_deduction_rates"].update(custom.pop("day_deduction_rates", {}))
+        rules.update(custom)
+        return rules
+
+    @staticmethod
+    def _base_salaries(salaries, users, month):
+        """basicSalary / allowances per user for a month, as arrays"""
+        latest = {}
+        for row in sorted(salaries, key=lambda r: r.get("month", "")):
+            # Use the row for this month, or the latest one before it; rows
+            # for later months don't apply yet
+            if row.get("month", "") <= month:
+                latest[row.get("userId")] = row
+
+        basic = np.array([latest.get(u["id"], {}).get("basicSalary", 0) for u in users], dtype=np.float64)
+        allowances = np.array([latest.get(u["id"], {}).get("allowances", 0) for u in users], dtype=np.float64)
+        has_salary = np.array([u["id"] in latest for u in users], dtype=bool)
+        return basic, allowances, has_salary
+
+    def _compute_month(self, month, until):
+        """Compute every user's slip for a month in one vectorized pass"""
+        users = self.users_store.load()
+        salaries = self.salaries_store.load()
+        overrides = self.statuses_store.load()
+        rules = self._rules()
+
+        # Days still ahead in the current month aren't counted yet
+        days, grid = build_status_grid(
+            users, self.attendance_store.load_month(month), overrides, month, until=until, calendar=self.calendar
+        )
+        counts = status_counts(grid)
+        elapsed_days = (grid >= 0).sum(axis=1)
+
+        basic, allowances, has_salary = self._base_salaries(salaries, users, month)
+        daily_rate = basic / max(len(days), 1)
+
+        absence_deductions = np.zeros(len(users), dtype=np.float64)
+        for status, rate in rules["day_deduction_rates"].items():
+            if status in counts:
+                absence_deductions += counts[status] * rate * daily_rate
+
+        fixed_deductions = basic * rules["fixed_deduction_rate"]
+        deductions = np.round(fixed_deductions + absence_deductions)
+        net = basic + allowances - deductions
+
+        slips = {}
+        for i, user in enumerate(users):
+            if not has_salary[i]:
+                continue
+            slips[(user["id"], month)] = {
+                "userId": user["id"],
+                "month": month,
+                "basicSalary": int(basic[i]),
+                "allowances": int(allowances[i]),
+                "deductions": int(deductions[i]),
+                "netSalary": int(net[i]),
+                "breakdown": {
+                    "fixedDeductions": int(round(fixed_deductions[i])),
+                    "absenceDeductions": int(round(absence_deductions[i]))
+                },
+                "attendance": {
+                    "workingDays": len(days),
+                    "countedDays": int(elapsed_days[i]),
+                    **{status: int(count[i]) for status, count in counts.items()}
+                }
+            }
+        return slips
+
+    def _ensure_month(self, month):
+        with self._lock:
+            signature = self._signature()
+            if signature != self._source_signature:
+                self._slips.clear()
+                self._months.clear()
+                self._stale.clear()
+                self._source_signature = signature
+
+            # Every slip of a month shares one cutoff: once the date moves
+            # past the one a month was counted to, recompute all of it
+            today = date.today().isoformat()
+            if month in self._months and self._months[month] != today and month >= self._months[month][:7]:
+                self._drop_month(month)
+
+            stale = {key for key in self._stale if key[1] == month}
+            if month in self._months and not stale:
+                return
+
+            computed = self._compute_month(month, today)
+            if month not in self._months:
+                self._slips.update(computed)
+            else:
+                # Only the invalidated users get their slip replaced
+                for key in stale:
+                    if key in computed:
+                        self._slips[key] = computed[key]
+                    else:
+                        self._slips.pop(key, None)
+
+            self._months[month] = today
+            self._stale -= stale
+
+    def slip(self, user_id, month):
+        """Salary slip for one user and month (YYYY-MM), or None"""
+        self._ensure_month(month)
+        return self._slips.get((user_id, month))
+
+    def month_slips(self, month):
+        """Salary slips of every user with a salary for the month"""
+        self._ensure_month(month)
+        return [slip for (_, slip_month), slip in self._slips.items() if slip_month == month]
+
+    def _drop_month(self, month):
+        self._months.pop(month, None)
+        self._slips = {k: v for k, v in self._slips.items() if k[1] != month}
+        self._stale = {k for k in self._stale if k[1] != month}
+
+    def invalidate(self, month, user_id=None):
+        """Mark memoized slips of a month stale, for one user or everyone"""
+        with self._lock:
+            if user_id is None:
+                self._drop_month(month)
+            elif month in self._months:
+                self._stale.add((user_id, month))
+
+    def invalidate_all(self):
+        """Drop every memoized slip (e.g. after attendance was rewritten)"""
+        with self._lock:
+            self._slips.clear()
+            self._months.clear()
+            self._stale.clear()
+
+    def invalidate_punch(self, record):
+        """Invalidate after a clock-in/out record was written"""
+        month = record["timestamp"][:7]
+        if record.get("userId") is None:
+            self.invalidate(month)
+        else:
+            self.invalidate(month, str(record["userId"]))
@@ -0,0 +1,193 @@
+"""
+Profiling
+On-demand sampling profiler for a running server
+
+SamplingProfiler starts a daemon thread that reads every thread's Python
+stack (sys._current_frames) every `interval` seconds for the length of the
+window, and aggregates the samples per function in the layout of a cProfile
+report: self samples (function on top of the stack) and cumulative samples
+(function anywhere on the stack). cProfile itself only instruments the
+thread that enables it, and here the decode, model and file work runs on
+threadpool workers, so sampling all threads is what reaches it. Time spent
+inside C code (OpenCV DNN, TensorFlow, JSON encoding) is attributed to the
+Python function that called it.
+
+Threads parked waiting for work (idle threadpool workers, the event loop's
+selector) are left out of the counts. With memory=True, tracemalloc runs
+for the same window and the report lists the source lines that allocated
+the most memory.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+MAX_SECONDS = 300
+DEFAULT_INTERVAL = 0.005
+
+# (file name, function) pairs where a thread is waiting rather than working
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+    ("base_events.py", "_run_once")
+}
+
+
+def _function_key(code):
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def _describe(key):
+    filename, line, name = key
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+
+class SamplingProfiler:
+    """Start / stop stack sampler over all threads, one window at a time"""
+
+    def __init__(self, interval=DEFAULT_INTERVAL, top=40):
+        """
+        Args:
+            interval: seconds between samples
+            top: rows kept per table in the report
+        """
+        self.interval = interval
+        self.top = top
+        self.last_report = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self._self = Counter()
+        self._cumulative = Counter()
+        self._threads = Counter()
+        self._samples = 0
+        self._started_at = None
+        self._deadline = None
+        self._memory = False
+        self._memory_baseline = None
+        self._owns_tracemalloc = False
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds=30, memory=False):
+        """
+        Begin a profiling window that ends after `seconds` (or on stop())
+
+        Raises:
+            RuntimeError: a window is already running
+        """
+        seconds = min(max(float(seconds), self.interval), MAX_SECONDS)
+        with self._lock:
+            if self.running:
+                raise RuntimeError("Profiler already running")
+            self._reset()
+            self._stop.clear()
+            self._started_at = time.time()
+            self._deadline = time.monotonic() + seconds
+            self._memory = memory
+            if memory:
+                self._owns_tracemalloc = not tracemalloc.is_tracing()
+                if self._owns_tracemalloc:
+                    tracemalloc.start(1)
+                self._memory_baseline = tracemalloc.take_snapshot()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+        logger.info(f"Sampling profiler started for {seconds:g} s (memory: {memory})")
+        return self.status()
+
+    def stop(self):
+        """End the window early; returns the report (or the last one)"""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+        return self.last_report
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self._sample(own_id)
+            if time.monotonic() >= self._deadline:
+                break
+        self.last_report = self._build_report()
+        logger.info(f"Sampling profiler stopped after {self._samples} samples")
+
+    def _sample(self, own_id):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                continue
+
+            self._self[_function_key(code)] += 1
+            seen = set()
+            while frame is not None:
+                key = _function_key(frame.f_code)
+                if key not in seen:
+                    seen.add(key)
+                    self._cumulative[key] += 1
+                frame = frame.f_back
+            self._threads[names.get(thread_id, str(thread_id))] += 1
+        self._samples += 1
+
+    def _table(self, counter):
+        total = sum(self._threads.values()) or 1
+        return [
+            {"function": _describe(key), "samples": count, "percent": round(100.0 * count / total, 1)}
+            for key, count in counter.most_common(self.top)
+        ]
+
+    def _memory_report(self):
+        if not self._memory:
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+        # The sample counters themselves aren't of interest
+        own = [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+        stats = snapshot.filter_traces(own).compare_to(self._memory_baseline.filter_traces(own), "lineno")
+        return [
+            {
+                "where": f"{os.path.basename(s.traceback[0].filename)}:{s.traceback[0].lineno}",
+                "size_kb": round(s.size_diff / 1024, 1),
+                "count": s.count_diff
+            }
+            for s in stats[:self.top]
+            if s.size_diff > 0
+        ]
+
+    def _build_report(self):
+        return {
+            "started_at": self._started_at,
+            "seconds": round(time.time() - self._started_at, 3),
+            "interval_ms": self.interval * 1000,
+            "samples": self._samples,
+            "busy_samples_by_thread": dict(self._threads.most_common()),
+            "top_self": self._table(self._self),
+            "top_cumulative": self._table(self._cumulative),
+            "memory": self._memory_report()
+        }
+
+    def status(self):
+        return {
+            "running": self.running,
+            "started_at": self._started_at if self.running else None,
+            "remaining_s": round(max(0.0, self._deadline - time.monotonic()), 1) if self.running else None,
+            "memory": self._memory if self.running else None,
+            "has_report": self.last_report is not None
+        }
@@ -0,0 +1,215 @@
+"""
+Request Tracing
+Per-request timing spans kept in an in-memory ring buffer
+
+TraceMiddleware gives every request an ID (the client's X-Request-ID if
+sent, otherwise a new one) and returns it in the response. A sampled
+request (TRACE_SAMPLE_RATE, or X-Trace: 1 from a caller the app trusts to
+force tracing, i.e. an admin) also gets a Trace in a context variable.
+Code along the way records spans into it with `span()` or
+`record_span()`: image ingest stages, admission wait, the model stages in
+recognize and the attendance write. The context variable follows the
+request into run_in_threadpool, so spans recorded on worker threads land
+in the right trace. With no trace active, `span()` only does one
+context-variable lookup.
+
+Finished traces go into a TraceBuffer (a fixed-size deque), which the
+admin endpoints query by request ID, path or duration.
+"""
+
+import contextvars
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+FORCE_TRACE_HEADER = "X-Trace"
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Trace:
+    """Spans recorded for one request"""
+
+    def __init__(self, request_id, method, path):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.spans = []  # list.append is atomic, so worker threads can add
+        self.status = None
+        self.duration_ms = None
+
+    def add_span(self, name, started, elapsed_ms, **attrs):
+        """
+        Args:
+            name: stage name, e.g. "ingest.open" or "model.embed"
+            started: time.perf_counter() when the stage began
+            elapsed_ms: stage duration
+            attrs: extra values to keep with the span (batch size, ...)
+        """
+        self.spans.append({
+            "name": name,
+            "start_ms": round((started - self._started) * 1000, 3),
+            "ms": round(elapsed_ms, 3),
+            "thread": threading.current_thread().name,
+            **attrs
+        })
+
+    def finish(self, status):
+        self.status = status
+        self.duration_ms = round((time.perf_counter() - self._started) * 1000, 3)
+
+    def to_dict(self):
+        return {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at,
+            "status": self.status,
+            "duration_ms": self.duration_ms,
+            "spans": sorted(self.spans, key=lambda s: s["start_ms"])
+        }
+
+
+def current_trace():
+    """Trace of the request being handled, or None when it isn't sampled"""
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time the body of a `with` block as a span of the current trace"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, started, (time.perf_counter() - started) * 1000, **attrs)
+
+
+def record_span(name, started, elapsed_ms, trace=None, **attrs):
+    """Add an already-timed stage to a trace (the current one by default)"""
+    trace = trace or _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, started, elapsed_ms, **attrs)
+
+
+class TraceBuffer:
+    """The last `capacity` finished traces"""
+
+    def __init__(self, capacity=500):
+        self._traces = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self.recorded = 0
+
+    def add(self, trace):
+        with self._lock:
+            self._traces.append(trace)
+            self.recorded += 1
+
+    def get(self, request_id):
+        with self._lock:
+            for trace in reversed(self._traces):
+                if trace.request_id == request_id:
+                    return trace.to_dict()
+        return None
+
+    def recent(self, limit=50, path=None, min_ms=None):
+        """
+        Newest first, optionally only paths starting with `path` and
+        requests that took at least `min_ms`
+        """
+        with self._lock:
+            traces = list(self._traces)
+        found = []
+        for trace in reversed(traces):
+            if path is not None and not trace.path.startswith(path):
+                continue
+            if min_ms is not None and (trace.duration_ms or 0) < min_ms:
+                continue
+            found.append(trace.to_dict())
+            if len(found) >= limit:
+                break
+        return found
+
+    def stats(self):
+        with self._lock:
+            return {"buffered": len(self._traces), "capacity": self._traces.maxlen, "recorded": self.recorded}
+
+
+class TraceMiddleware:
+    """Assign request IDs and record sampled requests into a TraceBuffer"""
+
+    def __init__(self, app, buffer, sample_rate=0.0, can_force=None):
+        """
+        Args:
+            app: ASGI app
+            buffer: TraceBuffer receiving finished traces
+            sample_rate: fraction of requests traced (0 = only forced ones)
+            can_force: fn(Authorization header value) -> bool deciding
+                       whether X-Trace: 1 is honored; None ignores X-Trace
+        """
+        self.app = app
+        self.buffer = buffer
+        self.sample_rate = sample_rate
+        self.can_force = can_force
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        forced = False
+        authorization = None
+        for key, value in scope.get("headers", []):
+            if key == b"x-request-id":
+                candidate = value.decode("latin-1")
+                if REQUEST_ID_PATTERN.match(candidate):
+                    request_id = candidate
+            elif key == b"x-trace":
+                forced = value == b"1"
+            elif key == b"authorization":
+                authorization = value.decode("latin-1")
+        # Forced traces fill the buffer at the caller's will, so only
+        # callers the app trusts may ask for one
+        forced = forced and self.can_force is not None and self.can_force(authorization)
+        request_id = request_id or uuid.uuid4().hex[:16]
+        header = (REQUEST_ID_HEADER.lower().encode(), request_id.encode())
+
+        trace = None
+        if forced or (self.sample_rate > 0 and random.random() < self.sample_rate):
+            trace = Trace(request_id, scope["method"], scope["path"])
+        status = None
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": list(message.get("headers", [])) + [header]}
+            await send(message)
+
+        if trace is None:
+            await self.app(scope, receive, send_with_id)
+            return
+
+        token = _current_trace.set(trace)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _current_trace.reset(token)
+            trace.finish(status or 500)
+            self.buffer.add(trace)
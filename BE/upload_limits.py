@@ -0,0 +1,129 @@
+"""
+Upload Limits
+Byte and pixel caps for image uploads
+
+Starlette already streams multipart bodies into a SpooledTemporaryFile (kept
+in memory up to 1 MB, then on disk). UploadLimitMiddleware caps how many
+bytes a request may send at all: up front from Content-Length, and again
+while the body streams for clients that send none. open_image() then reads
+only the image header from the spooled file to check its dimensions and
+decodes straight from that file, so an upload is never copied into a bytes
+object and a decompression bomb is refused before any pixel is decoded.
+"""
+
+import json
+import logging
+
+from fastapi import HTTPException
+from PIL import Image, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+DEFAULT_MAX_IMAGE_PIXELS = 24_000_000  # a 6000x4000 photo
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+class UploadLimitMiddleware:
+    """Answer 413 to any request whose body exceeds max_bytes"""
+
+    def __init__(self, app, max_bytes=DEFAULT_MAX_UPLOAD_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": f"Upload larger than {self.max_bytes / (1024 * 1024):.1f} MB"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close")
+            ]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        for key, value in scope.get("headers", []):
+            if key == b"content-length":
+                try:
+                    declared = int(value)
+                except ValueError:
+                    declared = 0
+                if declared > self.max_bytes:
+                    logger.warning(f"Rejected {scope['path']} upload of {declared} bytes")
+                    await self._reject(send)
+                    return
+                break
+
+        received = 0
+        exceeded = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    exceeded = True
+                    raise _BodyTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal started
+            # Once the cap is hit the app's own error response is replaced
+            if exceeded and not started:
+                return
+            started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except _BodyTooLarge:
+            pass
+        if exceeded and not started:
+            logger.warning(f"Rejected streamed {scope['path']} upload past {self.max_bytes} bytes")
+            await self._reject(send)
+
+
+def open_image(source, max_pixels=DEFAULT_MAX_IMAGE_PIXELS):
+    """
+    Open an uploaded image from its spooled file, header only
+
+    Args:
+        source: FastAPI UploadFile or a seekable file object
+        max_pixels: largest width * height accepted
+
+    Returns:
+        lazily decoded PIL Image reading from the upload's file
+
+    Raises:
+        HTTPException: 400 if the file isn't an image, 413 if it has more
+                       than max_pixels pixels
+    """
+    fileobj = getattr(source, "file", source)
+    fileobj.seek(0)
+    try:
+        image = Image.open(fileobj)
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail="Image has too many pixels")
+    except (UnidentifiedImageError, OSError):
+        raise HTTPException(status_code=400, detail="File is not a readable image")
+
+    width, height = image.size
+    if width * height > max_pixels:
+        logger.warning(f"Rejected {width}x{height} image upload ({getattr(source, 'filename', None)})")
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image is {width}x{height}; at most {max_pixels // 1_000_000} megapixels are accepted"
+        )
+    return image
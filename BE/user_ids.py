@@ -0,0 +1,144 @@
+"""
+User IDs
+Integer user IDs as the join key between users, punches, status overrides
+and the face gallery
+
+users.json keeps its string "id" (that is what the API and the admin /
+portal clients use); everywhere else the same ID is stored as an int
+"userId", so joins are dict lookups on small ints instead of name string
+comparisons in nested loops.
+
+Usage (one-off backfill; the server also runs it on startup):
+    python user_ids.py
+"""
+
+import copy
+import logging
+import threading
+
+from attendance_store import AttendanceStore
+from data_store import VersionedJsonStore
+
+logger = logging.getLogger(__name__)
+
+
+def to_uid(value):
+    """Integer user ID from a users.json id / userId value, or None"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def gallery_user_ids(users):
+    """Registered (gallery) name -> integer user ID"""
+    return {u["name"]: to_uid(u["id"]) for u in users if to_uid(u.get("id")) is not None}
+
+
+def punch_uid(record, name_to_uid):
+    """
+    Integer user ID of a punch
+
+    Punches recorded before IDs existed (and not backfilled yet) carry only
+    a name; they are matched through `name_to_uid` (see gallery_user_ids).
+    """
+    uid = record.get("userId")
+    if uid is None:
+        uid = name_to_uid.get(record.get("name"))
+    return uid
+
+
+def backfill_user_ids(attendance_store, statuses_store, users_store):
+    """
+    Give every punch and status override an integer userId
+
+    Punches recorded before IDs existed are matched by name once, here, one
+    monthly partition at a time; only months that change are rewritten.
+    Overrides have their string userId converted. Idempotent, so it is safe
+    on every startup.
+
+    Returns:
+        (punches updated, overrides updated)
+    """
+    name_to_uid = gallery_user_ids(users_store.load())
+
+    punches = 0
+    for month in attendance_store.months():
+        records = attendance_store.load_month(month)
+        if not any("userId" not in r and r.get("name") in name_to_uid for r in records):
+            continue
+        records = copy.deepcopy(records)
+        for record in records:
+            if "userId" not in record:
+                uid = name_to_uid.get(record.get("name"))
+                if uid is not None:
+                    record["userId"] = uid
+                    punches += 1
+        attendance_store.save_month(month, records)
+
+    overrides = statuses_store.load_copy()
+    converted = 0
+    for override in overrides:
+        uid = to_uid(override.get("userId"))
+        if uid is not None and not isinstance(override["userId"], int):
+            override["userId"] = uid
+            converted += 1
+    if converted:
+        statuses_store.save(overrides)
+
+    if punches or converted:
+        logger.info(f"Backfilled integer user IDs on {punches} punches and {converted} status overrides")
+    return punches, converted
+
+
+class UserRecordIndex:
+    """
+    Records of a data store grouped by integer userId
+
+    Rebuilt in one pass only when the store version changes, so per-user
+    lookups in request handlers are a dict get.
+    """
+
+    def __init__(self, store):
+        """
+        Args:
+            store: VersionedJsonStore whose records carry "userId"
+        """
+        self.store = store
+        self._groups = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def groups(self):
+        """dict userId -> list of records, in file order"""
+        version = self.store.version
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    groups = {}
+                    for record in self.store.load():
+                        uid = record.get("userId")
+                        if isinstance(uid, int):
+                            groups.setdefault(uid, []).append(record)
+                    self._groups = groups
+                    self._version = version
+        return self._groups
+
+    def get(self, uid):
+        return self.groups().get(uid, [])
+
+
+def main():
+    attendance_store = AttendanceStore()
+    statuses_store = VersionedJsonStore("attendance_statuses.json")
+    users_store = VersionedJsonStore("users.json")
+
+    punches, overrides = backfill_user_ids(attendance_store, statuses_store, users_store)
+    missing = sum(1 for r in attendance_store.load() if "userId" not in r)
+    print(f"Backfilled {punches} punches and {overrides} status overrides")
+    if missing:
+        print(f"{missing} punches have a name that matches no user and were left as they are")
+
+
+if __name__ == "__main__":
+    main()
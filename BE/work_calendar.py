@@ -0,0 +1,169 @@
+"""
+Work Calendar
+Working days per month with configurable weekends and public holidays
+
+work_calendar.json:
+    {
+        "weekend": ["Sat", "Sun"],
+        "holidays": [
+            {"date": "2025-03-31", "name": "Idul Fitri"},
+            {"date": "12-25", "name": "Christmas"}      # MM-DD repeats yearly
+        ]
+    }
+
+Each month is computed once per version of the file and cached as the list
+of working dates, their day numbers (days since 1970-01-01, the scale the
+analytics use) and a bitmask of working days of the month. The month grid,
+payroll and analytics all ask this one calendar, so a holiday added to the
+file applies everywhere at once.
+"""
+
+import logging
+import re
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+DEFAULT_WEEKEND = ["Sat", "Sun"]
+MONTH_PATTERN = re.compile(r"^\d{4}-\d{2}$")
+HOLIDAY_YEARS = (2000, 2101)  # range yearly MM-DD holidays are expanded over
+
+
+class MonthCalendar:
+    """Working days of one month"""
+
+    def __init__(self, month, day_numbers, holidays):
+        """
+        Args:
+            month: YYYY-MM
+            day_numbers: int64 array of working days as days since 1970-01-01
+            holidays: dict YYYY-MM-DD -> name of holidays falling on a
+                      weekday of this month
+        """
+        self.month = month
+        self.day_numbers = day_numbers
+        self.days = [str(d) for d in day_numbers.astype("datetime64[D]")]
+        self.index = {d: i for i, d in enumerate(self.days)}
+        self.holidays = holidays
+
+        # Bit n-1 is set when day n of the month is a working day
+        first = np.datetime64(month + "-01", "D").astype(np.int64)
+        self.mask = 0
+        for offset in (day_numbers - first).tolist():
+            self.mask |= 1 << offset
+
+    def __len__(self):
+        return len(self.days)
+
+    def is_working_day(self, day_of_month):
+        return bool(self.mask >> (day_of_month - 1) & 1)
+
+
+class WorkCalendar:
+    """Holiday-aware working-day calendar shared by grid, payroll and analytics"""
+
+    def __init__(self, store=None):
+        """
+        Args:
+            store: VersionedJsonStore for work_calendar.json (default=dict);
+                   None means Mon-Fri with no holidays
+        """
+        self.store = store
+        self._months = {}
+        self._busdaycal = None
+        self._settings_version = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        """Changes whenever the calendar file does (for ETags and memo keys)"""
+        return self.store.version if self.store is not None else 0
+
+    def _settings(self):
+        """(busdaycalendar, holidays dict) for the current file, rebuilt on change"""
+        version = self.version
+        if version != self._settings_version:
+            with self._lock:
+                if version != self._settings_version:
+                    config = dict(self.store.load()) if self.store is not None else {}
+                    weekend = config.get("weekend", DEFAULT_WEEKEND)
+                    weekmask = [day not in weekend for day in WEEKDAYS]
+
+                    holidays = {}
+                    for entry in config.get("holidays", []):
+                        if isinstance(entry, str):
+                            entry = {"date": entry}
+                        day, name = entry["date"], entry.get("name", "")
+                        if len(day) == 10:
+                            holidays[day] = name
+                            continue
+                        # MM-DD: expand over the years the app can be asked about
+                        for year in range(*HOLIDAY_YEARS):
+                            try:
+                                holidays.setdefault(str(np.datetime64(f"{year}-{day}", "D")), name)
+                            except ValueError:
+                                pass  # 02-29 in a common year
+
+                    self._weekmask = weekmask
+                    self._holidays = holidays
+                    self._busdaycal = np.busdaycalendar(weekmask=weekmask, holidays=list(holidays))
+                    self._months = {}
+                    self._settings_version = version
+                    logger.info(f"Work calendar loaded: weekend {weekend}, {len(holidays)} holiday dates")
+        return self._busdaycal, self._holidays
+
+    def month(self, month):
+        """
+        MonthCalendar for YYYY-MM, cached until the calendar file changes
+
+        Raises:
+            ValueError: month is not YYYY-MM
+        """
+        if not MONTH_PATTERN.match(month):
+            raise ValueError(f"Invalid month: {month}")
+        busdaycal, holidays = self._settings()
+        cached = self._months.get(month)
+        if cached is not None:
+            return cached
+
+        first = np.datetime64(month, "M").astype("datetime64[D]")
+        all_days = np.arange(first, (np.datetime64(month, "M") + 1).astype("datetime64[D]"))
+        working = np.is_busday(all_days, busdaycal=busdaycal)
+
+        # Holidays that took a working day away (not ones on a weekend)
+        weekday = (all_days.astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday
+        taken = [str(d) for d, w, b in zip(all_days, weekday, working) if self._weekmask[w] and not b]
+        calendar = MonthCalendar(month, all_days[working].astype(np.int64), {d: holidays[d] for d in taken})
+        self._months[month] = calendar
+        return calendar
+
+    def working_days(self, month):
+        """List of working dates (YYYY-MM-DD) in a month"""
+        return self.month(month).days
+
+    def count(self, start_day, end_day):
+        """
+        Working days from start_day through end_day (inclusive)
+
+        Args:
+            start_day / end_day: days since 1970-01-01
+        """
+        if end_day < start_day:
+            return 0
+        busdaycal, _ = self._settings()
+        return int(np.busday_count(
+            np.datetime64(start_day, "D"), np.datetime64(end_day + 1, "D"), busdaycal=busdaycal
+        ))
+
+    def is_working(self, day_numbers):
+        """Boolean mask of the working days among day numbers (days since 1970-01-01)"""
+        busdaycal, _ = self._settings()
+        days = np.asarray(day_numbers, dtype=np.int64).astype("datetime64[D]")
+        return np.is_busday(days, busdaycal=busdaycal)
+
+
+# Mon-Fri, no holidays; used when no calendar is passed in
+DEFAULT_CALENDAR = WorkCalendar()